@@ -1,17 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import sys, os, re, shlex, shutil, glob, subprocess, collections
+import sys, os, re, shlex, shutil, glob, gzip, subprocess, collections
 from os import path
 from datetime import datetime
 import numpy as np
-from scipy import interpolate
-import matplotlib as mpl
 from . import six
 
 
-# Test afni installation
-has_afni = bool(re.search('version', subprocess.check_output(['afni', '-ver']).decode('utf-8'), re.IGNORECASE))
+# Test afni installation (lazily, so that importing mripy does not spawn `afni -ver`)
+_has_afni = None
+
+def check_afni():
+    '''
+    Whether afni is installed. The probe runs on first use only, and is memoized.
+    '''
+    global _has_afni
+    if _has_afni is None:
+        try:
+            _has_afni = bool(re.search('version', subprocess.check_output(['afni', '-ver'], 
+                stderr=subprocess.STDOUT).decode('utf-8'), re.IGNORECASE))
+        except (OSError, subprocess.CalledProcessError):
+            _has_afni = False
+    return _has_afni
+
+
+def __getattr__(name):
+    # `afni.has_afni` is still available as a module attribute, evaluated on first access (PEP 562, Python 3.7+)
+    if name == 'has_afni':
+        return check_afni()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # # Find afni path
 # config_dir = path.expanduser('~/.mripy')
 # if not path.exists(config_dir):
@@ -257,11 +277,185 @@ def infer_surf_dset_variants(fname, hemis=SPEC_HEMIS):
     return fname
 
 
-def get_ORIENT(fname, format='str'):
+_HEAD_attribute = re.compile(r'type\s*=\s*(\S+)\s+name\s*=\s*(\S+)\s+count\s*=\s*(\d+)\s')
+
+def read_HEAD(fname):
+    '''
+    Parse all attributes of an AFNI .HEAD file in a single read, in process.
+
+    Returns
+    -------
+    attributes : OrderedDict
+        {name: value}, where value is an int/float array for numeric attributes, 
+        or a str as printed by 3dAttribute for string attributes (i.e., each 
+        substring ends with "~").
+
+    References
+    ----------
+    [1] https://afni.nimh.nih.gov/pub/dist/doc/program_help/README.attributes.html
+    '''
+    with open(fname, 'r', encoding='utf-8', errors='replace') as fi:
+        text = fi.read()
+    attributes = collections.OrderedDict()
+    matches = list(_HEAD_attribute.finditer(text))
+    for k, match in enumerate(matches):
+        kind, name, count = match.group(1), match.group(2), int(match.group(3))
+        value = text[match.end():(matches[k+1].start() if k+1 < len(matches) else len(text))]
+        if kind == 'string-attribute':
+            start = value.index("'") + 1
+            attributes[name] = value[start:start+count]
+        elif kind == 'integer-attribute':
+            attributes[name] = np.int_(value.split()[:count])
+        else: # float-attribute
+            attributes[name] = np.float_(value.split()[:count])
+    return attributes
+
+
+def write_HEAD(fname, attributes):
+    '''
+    Write attributes into an AFNI .HEAD file (the reverse of `read_HEAD`).
+
+    Parameters
+    ----------
+    attributes : dict
+        {name: value}, where str values are written as string attributes 
+        (with a terminating "~" appended if missing), integer values as 
+        integer attributes, and other numbers as float attributes.
+    '''
+    blocks = []
+    for name, value in attributes.items():
+        if isinstance(value, six.string_types):
+            value = value if value.endswith('~') else value + '~'
+            blocks.append(f"\ntype = string-attribute\nname = {name}\ncount = {len(value)}\n'{value}\n")
+        else:
+            values = np.atleast_1d(value)
+            if np.issubdtype(values.dtype, np.integer):
+                kind, items = 'integer', [str(v) for v in values]
+            else:
+                kind, items = 'float', ['{0:.9g}'.format(v) for v in values]
+            lines = [' ' + ' '.join(items[k:k+5]) for k in range(0, len(items), 5)]
+            blocks.append(f"\ntype = {kind}-attribute\nname = {name}\ncount = {len(values)}\n" + '\n'.join(lines) + '\n')
+    with open(fname, 'w') as fo:
+        fo.write(''.join(blocks))
+
+
+def affine_to_attributes(affine):
+    '''
+    Geometry attributes of an AFNI dataset whose voxel to world transform (RAS+, 
+    as in NIFTI) is `affine`. For an oblique affine, ORIENT_SPECIFIC and DELTA 
+    describe the closest cardinal grid, and IJK_TO_DICOM_REAL the real one.
+
+    Returns
+    -------
+    attributes : OrderedDict
+        ORIENT_SPECIFIC, ORIGIN, DELTA and IJK_TO_DICOM_REAL.
+    oblique : bool
+    '''
+    mat = np.diag([-1, -1, 1]) @ np.asarray(affine, dtype=float)[:3,:] # RAS+ (NIFTI) to RAI (AFNI)
+    axes = np.argmax(np.abs(mat[:,:3]), axis=0)
+    on_axis = mat[axes,[0,1,2]]
+    DELTA = np.sign(on_axis) * np.linalg.norm(mat[:,:3], axis=0)
+    oblique = len(set(axes)) < 3 or bool(np.any(np.abs(mat[:,:3]).sum(axis=0) - np.abs(on_axis) > 1e-4*np.abs(DELTA)))
+    code = np.array([[0, 1], [3, 2], [4, 5]]) # R2L/L2R, A2P/P2A, I2S/S2I for positive/negative DELTA
+    attributes = collections.OrderedDict()
+    attributes['ORIENT_SPECIFIC'] = code[axes,np.int_(DELTA<0)]
+    attributes['ORIGIN'] = mat[axes,3]
+    attributes['DELTA'] = DELTA
+    attributes['IJK_TO_DICOM_REAL'] = mat.ravel()
+    return attributes, oblique
+
+
+def _read_nifti_attributes(fname):
+    '''
+    Derive the geometry attributes (as seen by AFNI) from a NIFTI header via nibabel.
+    Return None for oblique datasets, or when qform and sform disagree, 
+    where AFNI's own rules are more involved.
+    '''
+    import nibabel
+    hdr = nibabel.load(fname).header
+    qform, qcode = hdr.get_qform(coded=True)
+    sform, scode = hdr.get_sform(coded=True)
+    if qcode and scode and not np.allclose(qform, sform, atol=1e-4):
+        return None
+    affine = qform if qcode else sform
+    if affine is None:
+        return None
+    geometry, oblique = affine_to_attributes(affine)
+    if oblique:
+        return None
+    dim = hdr['dim']
+    if dim[0] > 4 and np.prod(dim[5:dim[0]+1]) > 1:
+        return None
+    nt = int(dim[4]) if dim[0] >= 4 else 1
+    attributes = collections.OrderedDict()
+    attributes['DATASET_DIMENSIONS'] = np.r_[dim[1:4], 0, 0].astype(int)
+    attributes['DATASET_RANK'] = np.r_[3, nt, np.zeros(6)].astype(int)
+    attributes.update(geometry)
+    if nt > 1:
+        TR = float(hdr['pixdim'][4]) * {'msec': 1e-3, 'usec': 1e-6}.get(hdr.get_xyzt_units()[1], 1)
+        attributes['TAXIS_NUMS'] = np.int_([nt, 0, 77002]) # UNITS_SEC_TYPE
+        attributes['TAXIS_FLOATS'] = np.float_([0, TR, 0, 0, 0])
+    return attributes
+
+
+_header_cache = {} # {path: (mtime_ns, size, attributes)}
+
+def read_header(fname, use_cache=True):
+    '''
+    Read all attributes of an AFNI (e.g., dset+orig, dset+orig.HEAD) or NIFTI dataset 
+    at once, without spawning 3dAttribute or 3dinfo.
+
+    The parsed header is cached for the lifetime of the process, keyed by the path, 
+    mtime and size of the header file, so that repeated geometry queries on the same 
+    dataset are free (and a modified dataset is re-read).
+
+    Returns None if the header cannot be read natively (e.g., with sub-brick selectors,
+    or for oblique NIFTI), in which case the getters below fall back to AFNI programs.
+    '''
+    if re.search(r"[\[\]<>{}']", fname):
+        return None
+    if fname.endswith('.nii') or fname.endswith('.nii.gz'):
+        header_file, reader = fname, _read_nifti_attributes
+    else:
+        match = re.match(r'(.+\+(?:orig|tlrc|acpc))(?:\.|\.HEAD|\.BRIK|\.BRIK\.gz)?$', fname)
+        if not match:
+            return None
+        header_file, reader = match.group(1) + '.HEAD', read_HEAD
+    try:
+        stat = os.stat(header_file)
+    except OSError:
+        return None
+    key = path.realpath(header_file)
+    if use_cache and key in _header_cache and _header_cache[key][:2] == (stat.st_mtime_ns, stat.st_size):
+        return _header_cache[key][2]
+    try:
+        attributes = reader(header_file)
+    except ImportError: # nibabel is not available
+        return None
+    _header_cache[key] = (stat.st_mtime_ns, stat.st_size, attributes)
+    return attributes
+
+
+def clear_header_cache():
+    _header_cache.clear()
+
+
+def _get_attribute(fname, name, dtype, attributes=None):
+    if attributes is None:
+        attributes = read_header(fname)
+    if attributes is not None and name in attributes:
+        return np.array(attributes[name], dtype=dtype) # Copy, so the cache is never modified
+    res = check_output(['3dAttribute', name, fname])[-2]
+    return np.fromiter(map(dtype, res.split()), dtype)
+
+
+def get_ORIENT(fname, format='str', attributes=None):
     '''
     Parameters
     ----------
     format : str, {'code', 'str', 'mat', 'sorter'}
+    attributes : dict
+        Attributes already read by `read_header`, if any.
 
     References
     ----------
@@ -280,8 +474,7 @@ def get_ORIENT(fname, format='str'):
         On the other hand, NIFTI images have an affine relating the voxel coordinates 
         to world coordinates in RAS+ space, or LPI in AFNI's term.
     '''
-    res = check_output(['3dAttribute', 'ORIENT_SPECIFIC', fname])[-2]
-    ORIENT = np.fromiter(map(int, res.split()), int)
+    ORIENT = _get_attribute(fname, 'ORIENT_SPECIFIC', int, attributes)
     code2str = np.array(['R', 'L', 'P', 'A', 'I', 'S'])
     code2mat = np.array([[ 1, 0, 0],
                          [-1, 0, 0],
@@ -300,31 +493,30 @@ def get_ORIENT(fname, format='str'):
         return np.argsort(code2axis[ORIENT])
 
 
-def get_DIMENSION(fname):
+def get_DIMENSION(fname, attributes=None):
     '''
     [x, y, z, t, 0]
     '''
-    res = check_output(['3dAttribute', 'DATASET_DIMENSIONS', fname])[-2]
-    DIMENSION = np.fromiter(map(int, res.split()), int)
+    DIMENSION = _get_attribute(fname, 'DATASET_DIMENSIONS', int, attributes)
     return DIMENSION
 
 
-def get_ORIGIN(fname):
-    res = check_output(['3dAttribute', 'ORIGIN', fname])[-2]
-    ORIGIN = np.fromiter(map(float, res.split()), float)
+def get_ORIGIN(fname, attributes=None):
+    ORIGIN = _get_attribute(fname, 'ORIGIN', float, attributes)
     return ORIGIN
 
 
-def get_DELTA(fname):
-    res = check_output(['3dAttribute', 'DELTA', fname])[-2]
-    DELTA = np.fromiter(map(float, res.split()), float)
+def get_DELTA(fname, attributes=None):
+    DELTA = _get_attribute(fname, 'DELTA', float, attributes)
     return DELTA
 
 
-def get_affine(fname):
-    ORIENT = get_ORIENT(fname, format='sorter')
-    ORIGIN = get_ORIGIN(fname)
-    DELTA = get_DELTA(fname)
+def get_affine(fname, attributes=None):
+    if attributes is None:
+        attributes = read_header(fname) # Read the header only once
+    ORIENT = get_ORIENT(fname, format='sorter', attributes=attributes)
+    ORIGIN = get_ORIGIN(fname, attributes=attributes)
+    DELTA = get_DELTA(fname, attributes=attributes)
     MAT = np.c_[np.diag(DELTA), ORIGIN][ORIENT,:]
     return MAT
 
@@ -339,6 +531,9 @@ def get_dims(fname):
     Dimensions (number of voxels) of the data matrix.
     See also: get_head_dims
     '''
+    attributes = read_header(fname)
+    if attributes is not None and 'DATASET_RANK' in attributes:
+        return np.r_[attributes['DATASET_DIMENSIONS'][:3], attributes['DATASET_RANK'][1]]
     # res = check_output(['@GetAfniDims', fname])[-2] # There can be leading warnings for oblique datasets
     res = check_output(['3dinfo', '-n4', fname])[-2] # `@GetAfniDims` may not work for things like `dset.nii'[0..10]'`
     return np.int_(res.split()) # np.fromiter(map(int, res.split()), int)
@@ -349,6 +544,10 @@ def get_head_dims(fname):
     Dimensions (number of voxels) along R-L, A-P, I-S axes.
     See also: get_dims
     '''
+    attributes = read_header(fname)
+    if attributes is not None and 'DATASET_RANK' in attributes:
+        sorter = get_ORIENT(fname, format='sorter', attributes=attributes)
+        return np.r_[attributes['DATASET_DIMENSIONS'][:3][sorter], attributes['DATASET_RANK'][1]]
     res = check_output(['3dinfo', '-orient', '-n4', fname])[-2]
     res = res.split()
     orient = res[0]
@@ -362,6 +561,10 @@ def get_head_delta(fname):
     '''
     Resolution (voxel size) along R-L, A-P, I-S axes.
     '''
+    attributes = read_header(fname)
+    if attributes is not None:
+        sorter = get_ORIENT(fname, format='sorter', attributes=attributes)
+        return np.abs(get_DELTA(fname, attributes=attributes))[sorter]
     res = check_output(['3dinfo', '-orient', '-d3', fname])[-2]
     res = res.split()
     orient = res[0]
@@ -375,12 +578,22 @@ def get_head_extents(fname):
     '''
     Spatial extent along R, L, A, P, I and S.
     '''
+    attributes = read_header(fname)
+    if attributes is not None:
+        sorter = get_ORIENT(fname, format='sorter', attributes=attributes)
+        first = get_ORIGIN(fname, attributes=attributes)
+        last = first + get_DELTA(fname, attributes=attributes) * (get_DIMENSION(fname, attributes=attributes)[:3] - 1)
+        return np.c_[np.minimum(first, last), np.maximum(first, last)][sorter].ravel() # Centers of the outermost voxels
     res = check_output(['3dinfo', '-extent', fname])[-2]
     return np.float_(res.split())
 
 
 def get_brick_labels(fname, label2index=False):
-    res = check_output(['3dAttribute', 'BRICK_LABS', fname])[-2]
+    attributes = read_header(fname)
+    if attributes is not None and 'BRICK_LABS' in attributes:
+        res = attributes['BRICK_LABS']
+    else:
+        res = check_output(['3dAttribute', 'BRICK_LABS', fname])[-2]
     labels = res.split('~')[:-1] # Each label ends with "~"
     if label2index:
         return {label: k for k, label in enumerate(labels)}
@@ -393,11 +606,23 @@ def set_brick_labels(fname, labels):
 
 
 def get_TR(fname):
+    attributes = read_header(fname)
+    if attributes is not None:
+        if 'TAXIS_FLOATS' not in attributes:
+            return 0.0 # No time axis
+        units = attributes['TAXIS_NUMS'][2] if 'TAXIS_NUMS' in attributes else 77002
+        if units in [77001, 77002]: # UNITS_MSEC_TYPE, UNITS_SEC_TYPE
+            return float(attributes['TAXIS_FLOATS'][1]) * (1e-3 if units == 77001 else 1)
     return float(check_output(['3dinfo', '-TR', fname])[-2])
 
 
 def get_attribute(fname, name, type=None):
-    res = check_output(['3dAttribute', name, fname])[-2]
+    attributes = read_header(fname)
+    if attributes is not None and name in attributes:
+        value = attributes[name]
+        res = value if isinstance(value, str) else ' '.join(map(str, value)) + ' ' # Same as 3dAttribute output
+    else:
+        res = check_output(['3dAttribute', name, fname])[-2]
     if type == 'int':
         return np.int_(res[:-1].split())
     elif type == 'float':
@@ -416,20 +641,90 @@ def set_attribute(fname, name, value, type=None):
         check_output(['3drefit', '-atrfloat', name, f"{' '.join([str(v) for v in values])}", fname])
 
 
+# NIFTI-1 header (348 bytes), for reading/editing fields in process
+NIFTI1_HEADER = np.dtype([('sizeof_hdr', 'i4'), ('data_type', 'S10'), ('db_name', 'S18'),
+    ('extents', 'i4'), ('session_error', 'i2'), ('regular', 'S1'), ('dim_info', 'u1'),
+    ('dim', 'i2', 8), ('intent_p1', 'f4'), ('intent_p2', 'f4'), ('intent_p3', 'f4'),
+    ('intent_code', 'i2'), ('datatype', 'i2'), ('bitpix', 'i2'), ('slice_start', 'i2'),
+    ('pixdim', 'f4', 8), ('vox_offset', 'f4'), ('scl_slope', 'f4'), ('scl_inter', 'f4'),
+    ('slice_end', 'i2'), ('slice_code', 'u1'), ('xyzt_units', 'u1'), ('cal_max', 'f4'), ('cal_min', 'f4'),
+    ('slice_duration', 'f4'), ('toffset', 'f4'), ('glmax', 'i4'), ('glmin', 'i4'),
+    ('descrip', 'S80'), ('aux_file', 'S24'), ('qform_code', 'i2'), ('sform_code', 'i2'),
+    ('quatern_b', 'f4'), ('quatern_c', 'f4'), ('quatern_d', 'f4'),
+    ('qoffset_x', 'f4'), ('qoffset_y', 'f4'), ('qoffset_z', 'f4'),
+    ('srow_x', 'f4', 4), ('srow_y', 'f4', 4), ('srow_z', 'f4', 4),
+    ('intent_name', 'S16'), ('magic', 'S4')])
+
+
+def _read_nifti1_header(fname):
+    '''
+    Return the NIFTI-1 header as a numpy record (in the byte order of the file), 
+    or None for anything else (e.g., NIFTI-2).
+    '''
+    with (gzip.open if fname.endswith('.gz') else open)(fname, 'rb') as fi:
+        b = fi.read(NIFTI1_HEADER.itemsize)
+    if len(b) < NIFTI1_HEADER.itemsize:
+        return None
+    for dtype in [NIFTI1_HEADER.newbyteorder('<'), NIFTI1_HEADER.newbyteorder('>')]:
+        hdr = np.frombuffer(b, dtype=dtype)[0]
+        if hdr['sizeof_hdr'] == NIFTI1_HEADER.itemsize:
+            return hdr
+    return None
+
+
 def get_nifti_field(fname, name, type=None):
-    res = check_output(['nifti_tool', '-disp_hdr', '-field', name, '-infiles', fname])[-2]
+    '''
+    Read a NIFTI header field in process (reading only the first 348 bytes), 
+    falling back to nifti_tool for NIFTI-2 files.
+    '''
+    hdr = _read_nifti1_header(fname) if name in NIFTI1_HEADER.names else None
+    if hdr is None:
+        res = check_output(['nifti_tool', '-disp_hdr', '-field', name, '-infiles', fname])[-2]
+        if type == 'int':
+            return np.int_(res.split()[3:])
+        elif type == 'float':
+            return np.float_(res.split()[3:])
+        else:
+            return res[37:]
+    value = hdr[name]
     if type == 'int':
-        return np.int_(res.split()[3:])
+        return np.int_(np.atleast_1d(value))
     elif type == 'float':
-        return np.float_(res.split()[3:])
+        return np.float_(np.atleast_1d(value))
+    elif isinstance(value, bytes):
+        return value.decode('latin-1')
     else:
-        return res[37:]
+        return ' '.join(str(v) for v in np.atleast_1d(value))
 
 
 def set_nifti_field(fname, name, value, out_file=None):
+    '''
+    Modify a NIFTI header field. For uncompressed NIFTI-1 files, only the field 
+    itself is overwritten in place (in a copy if `out_file` is given), which takes 
+    microseconds regardless of the size of the data. Compressed or NIFTI-2 files
+    are handled by nifti_tool.
+    '''
     values = np.atleast_1d(value)
-    check_output(['nifti_tool', '-mod_hdr', '-mod_field', name, f"{' '.join([str(v) for v in values])}", '-infiles', fname] 
-        + (['-overwrite'] if out_file is None else ['-prefix', out_file]))
+    hdr = None
+    if name in NIFTI1_HEADER.names and not fname.endswith('.gz') and (out_file is None or not out_file.endswith('.gz')):
+        hdr = _read_nifti1_header(fname)
+    if hdr is None:
+        check_output(['nifti_tool', '-mod_hdr', '-mod_field', name, f"{' '.join([str(v) for v in values])}", '-infiles', fname] 
+            + (['-overwrite'] if out_file is None else ['-prefix', out_file]))
+        return
+    field_dtype, offset = hdr.dtype.fields[name][:2]
+    if field_dtype.kind == 'S':
+        b = np.array(value.encode('latin-1') if isinstance(value, str) else value, dtype=field_dtype).tobytes()
+    else:
+        new_value = np.array(np.atleast_1d(hdr[name]), dtype=field_dtype.base)
+        new_value[:len(values)] = values # Unspecified trailing values are kept
+        b = new_value.tobytes()
+    if out_file is not None:
+        shutil.copyfile(fname, out_file)
+        fname = out_file
+    with open(fname, 'r+b') as fo:
+        fo.seek(offset)
+        fo.write(b)
 
 
 def get_S2E_mat(fname, mat='S2E'):
@@ -515,6 +810,7 @@ def add_colormap(cmap, name=None, cyclic=False, index=None, categorical=False):
     '''
     cmap : list of RGB colors | matplotlib.colors.LinearSegmentedColormap
     '''
+    import matplotlib as mpl
     if name is None:
         if isinstance(cmap, mpl.colors.LinearSegmentedColormap):
             name = cmap.name
@@ -564,6 +860,8 @@ def write_colorscale_file(fname, pal_name, colors, locations=None, interp=None):
         locations = np.linspace(0, 1, len(colors))
     if interp is None:
         interp = 'linear'
+    from scipy import interpolate
+    import matplotlib as mpl
     cmap = interpolate.interp1d(locations, colors, kind=interp, axis=0, bounds_error=False, fill_value='extrapolate')
     clist = [mpl.colors.to_hex(color) for color in cmap(np.linspace(0, 1, 256))]
     with open(fname, 'w') as fout:
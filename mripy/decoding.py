@@ -4,9 +4,6 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 from os import path
 from collections import OrderedDict
 import numpy as np
-from scipy import stats
-import pandas as pd
-from sklearn import model_selection, metrics
 from . import six, utils
 
 
@@ -42,6 +39,7 @@ def permute_within_group(y, groups):
 
 
 def cross_validate_ext(model, X, y, groups=None, cv=None, pred_kws=None, method=None):
+    from sklearn import model_selection
     if cv is None:
         cv = model_selection.LeaveOneGroupOut() # One group of each run
     if method is None:
@@ -64,6 +62,8 @@ def cross_validate_ext(model, X, y, groups=None, cv=None, pred_kws=None, method=
 
 
 def cross_validate_with_permutation(model, X, y, groups, rois=None, n_permutations=1000, scoring=None, cv=None):
+    import pandas as pd
+    from sklearn import model_selection, metrics
     if rois is None:
         X, y, groups, rois = [X], [y], [groups], ['NA']
     if cv is None:
@@ -100,6 +100,8 @@ def compute_critical_value(x, y, permute='permute', data=None, alpha=0.05, tail=
     data : pd.DataFrame(x, y, permute)
         permute == 0 is originally observed data, >= 1 is permutation data.
     '''
+    import pandas as pd
+    from scipy import stats
     # Mean performance for each condition and each permutation
     by = [x, permute] if isinstance(x, six.string_types) else list(x) + [permute]
     df = data[data[permute]>0].groupby(by=by)[y].mean() # This is a Series with MultiIndex
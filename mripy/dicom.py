@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import glob, re, itertools, inspect
-import gzip
-from datetime import datetime
+import os, glob, re, itertools, inspect
+import zlib, struct, json, base64, sqlite3, multiprocessing
+from datetime import datetime, date, time
 from collections import OrderedDict
 from os import path
 import numpy as np
@@ -12,6 +12,24 @@ import six
 
 encoding = 'utf-8'
 
+# Fast paths for the most frequent VRs (the generic strptime/array route costs 
+# tens of microseconds per element, which adds up over tens of thousands of files).
+def _parse_DA(s):
+    if len(s) == 8 and s.isdigit():
+        return date(int(s[:4]), int(s[4:6]), int(s[6:]))
+    return datetime.strptime(s, '%Y%m%d').date()
+
+def _parse_TM(s):
+    if len(s) > 7 and s[6] == '.' and s[:6].isdigit() and s[7:].isdigit():
+        return time(int(s[:2]), int(s[2:4]), int(s[4:6]), int(s[7:13].ljust(6, '0')))
+    return datetime.strptime(s, '%H%M%S.%f').time()
+
+def _parse_multi_value(s, dtype):
+    if '\\' in s:
+        return dtype(s.split('\\'))
+    else:
+        return dtype(s)
+
 vr_parsers = {
     'CS': lambda x: str.strip(x.decode(encoding)), # Code String
     'SH': lambda x: str.strip(x.decode(encoding)), # Short String
@@ -23,11 +41,11 @@ vr_parsers = {
     'PN': lambda x: str.strip(x.decode(encoding)), # Person Name
     'AS': lambda x: str.strip(x.decode(encoding)), # Age String ??? e.g., 039Y
 
-    'DA': lambda x: datetime.strptime(x.decode(encoding), '%Y%m%d').date(), # Date
-    'TM': lambda x: datetime.strptime(x.decode(encoding).strip(), '%H%M%S.%f').time(), # Time
+    'DA': lambda x: _parse_DA(x.decode(encoding)), # Date
+    'TM': lambda x: _parse_TM(x.decode(encoding).strip()), # Time
 
-    'IS': lambda x: np.int_(x.decode(encoding).split('\\')).squeeze()[()], # Integer String
-    'DS': lambda x: np.float_(x.decode(encoding).split('\\')).squeeze()[()], # Decimal String
+    'IS': lambda x: _parse_multi_value(x.decode(encoding), np.int_), # Integer String
+    'DS': lambda x: _parse_multi_value(x.decode(encoding), np.float_), # Decimal String
 
     'SS': lambda x: np.frombuffer(x, dtype=np.int16).squeeze()[()], # Signed Short
     'US': lambda x: np.frombuffer(x, dtype=np.uint16).squeeze()[()], # Unsigned Short
@@ -42,22 +60,107 @@ vr_parsers = {
 # https://nipy.org/nibabel/dicom/siemens_csa.html
 # https://neurostars.org/t/determining-bids-phaseencodingdirection-from-dicom/612 # For PhaseEncodingDirection
 def parse_Siemens_CSA(b):
-    return {}
-
-def parse_Siemens_CSA2(b):
-    def parse_value(pattern, b, default=None):
-        match = re.search(pattern, b)        
-        return match.group(1) if match else default
-    CSA2 = {
-        'ReferenceAmplitude': float(parse_value(rb'sTXSPEC\.asNucleusInfo\[0\]\.flReferenceAmplitude\s+=\s+(\S+)\s', b, default=np.nan)),
-        'PhasePartialFourier': re.search(rb'sKSpace\.ucPhasePartialFourier\s+=\s+(\S+)\s', b).group(1).decode(encoding),
-        'SlicePartialFourier': re.search(rb'sKSpace\.ucSlicePartialFourier\s+=\s+(\S+)\s', b).group(1).decode(encoding),
-        'RefLinesPE': int(parse_value(rb'sPat\.lRefLinesPE\s+=\s+(\S+)\s', b, default=0)),
-        'PATMode': re.search(rb'sPat.ucPATMode\s+=\s+(\S+)\s', b).group(1).decode(encoding),
-        'RefScanMode': re.search(rb'sPat\.ucRefScanMode\s+=\s+(\S+)\s', b).group(1).decode(encoding),
-        'TotalScanTimeSec': float(re.search(rb'lTotalScanTimeSec\s+=\s+(\S+)\s', b).group(1)),
-        # 'SlicePosition': np.float_(re.findall(rb'sSliceArray\.asSlice\[\d+\]\.sPosition\.\w{4}\s+=\s(\S+)\s', b)).reshape(-1,3), # Unfortunately, no temporal order
-    }
+    '''
+    Extract fields from the Siemens CSA Image Header (in the same "SV10" layout as CSA2).
+    Currently only SliceNormalVector (LPS), which gives the slice direction of a mosaic.
+    '''
+    CSA = {}
+    spans = find_Siemens_CSA2_item(b, 'SliceNormalVector', all_items=True)
+    if spans is not None and len(spans) == 3:
+        CSA['SliceNormalVector'] = np.array([float(b[start:stop].split(b'\x00', 1)[0]) for start, stop in spans])
+    return CSA
+
+# Fields extracted from the "### ASCCONV BEGIN ###" section of the MrPhoenixProtocol
+# name in header['CSA2'] -> (ASCCONV key, converter, default if absent)
+CSA2_fields = OrderedDict([
+    ('ReferenceAmplitude', ('sTXSPEC.asNucleusInfo[0].flReferenceAmplitude', float, np.nan)),
+    ('PhasePartialFourier', ('sKSpace.ucPhasePartialFourier', str, None)),
+    ('SlicePartialFourier', ('sKSpace.ucSlicePartialFourier', str, None)),
+    ('RefLinesPE', ('sPat.lRefLinesPE', int, 0)),
+    ('PATMode', ('sPat.ucPATMode', str, None)),
+    ('RefScanMode', ('sPat.ucRefScanMode', str, None)),
+    ('TotalScanTimeSec', ('lTotalScanTimeSec', float, None)),
+    # 'SlicePosition': sSliceArray.asSlice[n].sPosition.dSag/dCor/dTra # Unfortunately, no temporal order
+])
+
+_CSA2_tag_struct = struct.Struct('<64si4s3i') # name, vm, VR, syngodt, n_items, xx
+_CSA2_item_struct = struct.Struct('<4i') # The 2nd int is the item length for CSA2
+
+def find_Siemens_CSA2_item(b, name, all_items=False):
+    '''
+    Walk the tag directory of a CSA2 ("SV10") blob without decoding any value, 
+    and return the (start, stop) offsets of the first item of tag `name`.
+
+    Layout: "SV10", 4 unused bytes, n_tags (uint32), 4 unused bytes, then for each tag 
+    an 84-byte description followed by n_items items, each with a 16-byte header and
+    its value padded to a multiple of 4 bytes.
+    Return None if the tag is absent or the blob is not in CSA2 format.
+    If `all_items`, return a list of the (start, stop) offsets of all non-empty items instead.
+    '''
+    if b[:4] != b'SV10':
+        return None
+    name = name.encode(encoding)
+    n_tags = _uint32_struct.unpack_from(b, 8)[0]
+    pos = 16
+    try:
+        for k in range(n_tags):
+            tag_name, vm, VR, syngodt, n_items, xx = _CSA2_tag_struct.unpack_from(b, pos)
+            pos += _CSA2_tag_struct.size
+            found = (tag_name.split(b'\x00', 1)[0] == name)
+            spans = []
+            for m in range(n_items):
+                item_length = _CSA2_item_struct.unpack_from(b, pos)[1]
+                pos += _CSA2_item_struct.size
+                if found and not all_items:
+                    return pos, pos + item_length
+                elif found and item_length > 0:
+                    spans.append((pos, pos + item_length))
+                pos += (item_length + 3) // 4 * 4
+            if found and all_items:
+                return spans
+    except struct.error: # Truncated or malformed blob
+        pass
+    return None
+
+
+def parse_Siemens_CSA2(b, keys=None):
+    '''
+    Extract CSA2_fields from the MrPhoenixProtocol of the Siemens CSA Series Header.
+
+    The CSA2 tag directory is walked once to locate the protocol (see `find_Siemens_CSA2_item`), 
+    and only the requested keys are then looked up within its ASCCONV section.
+
+    Parameters
+    ----------
+    b : bytes
+    keys : list
+        Names in CSA2_fields, default is all of them.
+    '''
+    if keys is None:
+        keys = CSA2_fields.keys()
+    span = find_Siemens_CSA2_item(b, 'MrPhoenixProtocol')
+    start, stop = span if span is not None else (0, len(b)) # Fallback to the whole blob
+    begin = b.find(b'### ASCCONV BEGIN', start, stop)
+    if begin >= 0:
+        start = begin
+        end = b.find(b'### ASCCONV END', start, stop)
+        if end >= 0:
+            stop = end
+    CSA2 = {}
+    for key in keys:
+        ascconv_key, converter, default = CSA2_fields[key]
+        target = b'\n' + ascconv_key.encode(encoding)
+        value = default
+        pos = b.find(target, start, stop)
+        while pos >= 0:
+            pos += len(target)
+            eol = b.find(b'\n', pos, stop)
+            name_end, sep, rest = b[pos:eol if eol >= 0 else stop].partition(b'=')
+            if sep and not name_end.strip(): # Exact key match rather than prefix match
+                value = converter(rest.split()[0].decode(encoding))
+                break
+            pos = b.find(target, pos, stop)
+        CSA2[key] = value
     return CSA2
 
 Siemens = {
@@ -126,8 +229,16 @@ tag_parsers = {
     '0020,0011': ('SeriesNumber', vr_parsers['IS']),
     '0020,0012': ('AcquisitionNumber', vr_parsers['IS']),
     '0020,0013': ('InstanceNumber', vr_parsers['IS']),
+    '0020,0032': ('ImagePositionPatient', vr_parsers['DS']), # x, y, z (LPS) of the center of the first (upper left) voxel
+    '0020,0037': ('ImageOrientationPatient', vr_parsers['DS']), # Direction cosines of the first row and the first column
     '0020,4000': ('ImageComments', vr_parsers['LT']),
-    '0028,0030': ('PixelSpacing', vr_parsers['DS']),
+    '0028,0010': ('Rows', vr_parsers['US']),
+    '0028,0011': ('Columns', vr_parsers['US']),
+    '0028,0030': ('PixelSpacing', vr_parsers['DS']), # Row spacing (between rows), column spacing (between columns)
+    '0028,0100': ('BitsAllocated', vr_parsers['US']),
+    '0028,0103': ('PixelRepresentation', vr_parsers['US']), # 0 for unsigned, 1 for signed
+    '0028,1052': ('RescaleIntercept', vr_parsers['DS']),
+    '0028,1053': ('RescaleSlope', vr_parsers['DS']),
     '0029,1010': ('CSA', parse_Siemens_CSA), # Siemens private element
     '0029,1020': ('CSA2', parse_Siemens_CSA2), # Siemens private element
 }
@@ -156,41 +267,230 @@ custom_parsers = {
 }
 
 
-def parse_SQ_data_element(fi):
+# Precompiled lookup table for the data element walker, keyed by the integer tag
+# (group << 16 | element), so that each element costs a single dict lookup.
+def compile_tag_parsers(*parsers):
+    table = {}
+    for p in parsers:
+        for tag, (name, parser) in p.items():
+            group, element = tag.split(',')
+            table[int(group, 16) << 16 | int(element, 16)] = (name, parser)
+    return table
+
+tag_table = compile_tag_parsers(tag_parsers, Siemens_parsers)
+_tag_table_sources = (dict(tag_parsers), dict(Siemens_parsers))
+
+def get_tag_table():
+    '''
+    Return `tag_table`, recompiled if `tag_parsers` or `Siemens_parsers` have been 
+    modified since (e.g., entries added at runtime), as they used to be merged on every call.
+    '''
+    global tag_table, _tag_table_sources
+    if (tag_parsers, Siemens_parsers) != _tag_table_sources: # Cheap: ~100 tuples compared by identity
+        tag_table = compile_tag_parsers(tag_parsers, Siemens_parsers)
+        _tag_table_sources = (dict(tag_parsers), dict(Siemens_parsers))
+    return tag_table
+
+HEADER_CHUNK_SIZE = 65536 # Large enough for typical Siemens headers (incl. CSA)
+GZIP_CHUNK_SIZE = 8192 # Decompression is costly, so start small and let the buffer grow
+PIXEL_DATA = 0x7FE00010 # 7FE0,0010
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = b'\xfe\xff\x00\xe0' # FFFE,E000
+ITEM_DELIMITATION = b'\xfe\xff\x0d\xe0\x00\x00\x00\x00' # FFFE,E00D with zero length
+SEQUENCE_DELIMITATION = b'\xfe\xff\xdd\xe0' # FFFE,E0DD
+# VRs with 2 reserved bytes followed by a 4-byte length (Table 7.1-1)
+long_VRs = frozenset([b'OB', b'OD', b'OF', b'OL', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT'])
+_element_struct = struct.Struct('<HH2sH') # group, element, VR, 2-byte length
+_uint32_struct = struct.Struct('<I')
+
+
+def parse_SQ_data_element(buf, pos):
     '''
+    Skip over a Sequence of Items with undefined length, starting right after 
+    the SQ element header.
+
+    Items are skipped by their length if it is defined, otherwise their data elements 
+    are walked (recursively for nested sequences) until the Item Delimitation Item.
+    Nothing is decoded.
+
     We only support Data Element with Explicit VR at present (Table 7.1-2).
-    We don't support nested Item at present (2018-09-26).
+
+    Returns
+    -------
+    pos : int
+        Position right after the Sequence Delimitation Item, or -1 if `buf` 
+        ends before the sequence does.
 
     References
     ----------
     [1] http://dicom.nema.org/Dicom/2013/output/chtml/part05/chapter_7.html
     '''
-    while True:
+    end = len(buf)
+    while pos + 8 <= end:
         # Parse an item
-        item_tag = '{0:04X},{1:04X}'.format(*np.frombuffer(fi.read(4), dtype=np.uint16, count=2))
-        if item_tag == 'FFFE,E000': # Item (Mark the start of an item)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            if item_length == 4294967295: # 0xFFFFFFFF: Undefined Length
-                # Bruteforce scan the byte stream until we hit "FFFE,E00D"
-                # Bug: However, this may fail if the payload also contains item with undefined length!
-                while True:
-                    # Until we hit "FFFE,E00D"
-                    if fi.read(2) == b'\xfe\xff':
-                        if fi.read(2) == b'\x0d\xe0':
-                            if fi.read(4) == b'\x00\x00\x00\x00':
-                                break
-            else:
-                fi.seek(item_length, 1)
-        elif item_tag == 'FFFE,E00D': # Item Delimitation Item (Mark the end of an item with undefined length)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            assert(item_length == 0)
-        elif item_tag == 'FFFE,E0DD': # Sequence Delimitation Item (Mark the end of an SQ with undefined length)
-            item_length = int.from_bytes(fi.read(4), byteorder='little', signed=False)
+        item_tag = buf[pos:pos+4]
+        item_length = _uint32_struct.unpack_from(buf, pos+4)[0]
+        pos += 8
+        if item_tag == SEQUENCE_DELIMITATION: # Sequence Delimitation Item (Mark the end of an SQ with undefined length)
             assert(item_length == 0)
-            break
+            return pos
+        elif item_tag == ITEM: # Item (Mark the start of an item)
+            if item_length == UNDEFINED_LENGTH:
+                pos = _skip_item(buf, pos)
+                if pos < 0:
+                    return -1
+            else:
+                pos += item_length
+        # else: Item Delimitation Item (Mark the end of an item with undefined length), whose length is 0
+    return -1
 
 
-def parse_dicom_header(fname, search_for_tags=None, **kwargs):
+def _skip_item(buf, pos):
+    '''Skip the data elements of an item with undefined length, including its Item Delimitation Item.'''
+    end = len(buf)
+    while pos + 8 <= end:
+        group, element, VR, length = _element_struct.unpack_from(buf, pos)
+        if group == 0xFFFE and element == 0xE00D: # Item Delimitation Item (no VR)
+            return pos + 8
+        if VR in long_VRs:
+            if pos + 12 > end:
+                return -1
+            length = _uint32_struct.unpack_from(buf, pos+8)[0]
+            pos += 12
+        else:
+            pos += 8
+        if length == UNDEFINED_LENGTH:
+            if VR == b'SQ':
+                pos = parse_SQ_data_element(buf, pos)
+                if pos < 0:
+                    return -1
+            else:
+                raise NotImplementedError('** Undefined Length')
+        else:
+            pos += length
+    return -1
+
+
+def parse_data_elements(buf, pos, header, table=None, search_for_tags=None, stop_after=None):
+    '''
+    Walk through the (Explicit VR Little Endian) data elements in `buf` starting 
+    from `pos`, until pixel data, or until all `search_for_tags` are seen.
+
+    Elements not in `table` are skipped by their length without being decoded.
+
+    Parameters
+    ----------
+    buf : bytes
+    header : dict
+        Parsed fields are written into `header` in place.
+    table : dict
+        {int_tag: (name, parser)}, default is `get_tag_table()`.
+    search_for_tags : set of int
+        Tags that are seen are removed from the set in place, so that the walk
+        can be resumed with a longer `buf`.
+    stop_after : int
+        Stop as soon as a tag larger than this is met. As data elements are stored 
+        in ascending tag order, this bounds the walk even if some tags are absent.
+
+    Returns
+    -------
+    pos : int
+        Position where the walk stopped.
+    done : bool
+        False if `buf` ends in the middle of the header, in which case `pos` 
+        is the start of the first incomplete element.
+    '''
+    if table is None:
+        table = get_tag_table()
+    end = len(buf)
+    while pos + 8 <= end:
+        start = pos
+        group, element, VR, length = _element_struct.unpack_from(buf, pos)
+        tag = group << 16 | element
+        if tag == PIXEL_DATA or (stop_after is not None and tag > stop_after):
+            return pos, True
+        if VR in long_VRs:
+            if pos + 12 > end:
+                return start, False
+            length = _uint32_struct.unpack_from(buf, pos+8)[0]
+            pos += 12
+        else:
+            pos += 8
+        if length == UNDEFINED_LENGTH:
+            if VR == b'SQ':
+                pos = parse_SQ_data_element(buf, pos)
+                if pos < 0:
+                    return start, False
+            else:
+                raise NotImplementedError('** Undefined Length')
+        elif pos + length > end:
+            return start, False
+        else:
+            if tag in table:
+                name, parser = table[tag]
+                header[name] = parser(buf[pos:pos+length])
+            pos += length
+        if search_for_tags is not None and tag in search_for_tags:
+            search_for_tags.remove(tag)
+            if not search_for_tags:
+                return pos, True
+    return pos, False
+
+
+class GzipPrefixReader(object):
+    '''
+    Minimal read-only gzip stream that only decompresses as much as has been requested.
+
+    Unlike `gzip.open`, compressed input is consumed in small pieces and output is 
+    bounded by `max_length`, so reading the header of a large .dcm.gz file costs about 
+    the same as reading the header itself, regardless of the size of the pixel data.
+    The CRC of the (never fully read) member is not checked.
+    '''
+    def __init__(self, fname, input_size=4096):
+        self.fi = open(fname, 'rb')
+        self.input_size = input_size
+        self.decompressor = zlib.decompressobj(16+zlib.MAX_WBITS) # Expect gzip header
+
+    def read(self, size=-1):
+        if size is None or size < 0: # Read till the end
+            size = float('inf')
+        chunks = []
+        while size > 0:
+            d = self.decompressor
+            if d.unconsumed_tail:
+                data = d.unconsumed_tail
+            elif d.eof: # Concatenated gzip members
+                data = d.unused_data + self.fi.read(self.input_size)
+                if not data:
+                    break
+                self.decompressor = d = zlib.decompressobj(16+zlib.MAX_WBITS)
+            else:
+                data = self.fi.read(self.input_size)
+                if not data:
+                    break
+            chunk = d.decompress(data, size if size != float('inf') else 0)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.fi.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_dicom(fname):
+    if fname.endswith('.gz'):
+        return GzipPrefixReader(fname)
+    else:
+        return open(fname, 'rb')
+
+
+def parse_dicom_header(fname, search_for_tags=None, search_only=False, **kwargs):
     '''
     Parameters
     ----------
@@ -199,6 +499,10 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
         Search for specific dicom tags, and stop file scanning early if all tags of interest are seen.
         e.g., search_for_tags={'0020,0011', '0020,0013'} will search for SeriesNumber and InstanceNumber.
         This will save you some time, esp. when the remote file is accessed via slow data link.
+    search_only : bool
+        Only decode `search_for_tags` (plus fields derived from them), and skip all other 
+        elements, including sequences and CSA headers, by their length. Scanning also stops 
+        once past the largest tag of interest, even if some of the tags are absent.
     **kwargs : 
         This is only for backward compatibility.
 
@@ -208,56 +512,41 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
     (see Section 7.5). Whether a Data Set uses Explicit or Implicit VR, among other characteristics, 
     is determined by the negotiated Transfer Syntax (see Section 10 and Annex A)." [1]
 
+    The header is read with a single `read(HEADER_CHUNK_SIZE)` in most cases (the buffer 
+    is only grown for unusually long headers), and walked in memory with the precompiled 
+    `tag_table` (see `get_tag_table`). Pixel data is never read.
+    For .gz files, only the prefix needed for the header is decompressed, starting from 
+    `GZIP_CHUNK_SIZE` and growing as needed (see `GzipPrefixReader`).
+
     References
     ----------
     [1] http://dicom.nema.org/Dicom/2013/output/chtml/part05/chapter_7.html
     [2] https://stackoverflow.com/questions/119684/parse-dicom-files-in-native-python
     '''
-    elements = []
     header = OrderedDict()
-    n_tags_seen = 0
-    tag_parsers.update(Siemens_parsers)
-    if fname.endswith('.gz'):
-        opener = gzip.open
-    else:
-        opener = open
-    with opener(fname, 'rb') as fi:
+    table = get_tag_table() # Follows runtime changes to `tag_parsers`
+    stop_after = None
+    if search_for_tags is not None:
+        search_for_tags = {int(tag[:4], 16) << 16 | int(tag[-4:], 16) for tag in search_for_tags}
+        if search_only and search_for_tags:
+            table = {tag: table[tag] for tag in search_for_tags if tag in table}
+            stop_after = max(search_for_tags)
+    with open_dicom(fname) as fi:
+        buf = fi.read(GZIP_CHUNK_SIZE if fname.endswith('.gz') else HEADER_CHUNK_SIZE)
         # The preamble
-        fi.seek(128) # The first 128 bytes are 0x00
-        assert(fi.read(4).decode(encoding) == 'DICM') # The next 4 bytes are "DICM"
+        # The first 128 bytes are 0x00, and the next 4 bytes are "DICM"
+        assert(buf[128:132] == b'DICM')
         # Data Elements
+        pos = 132
         while True:
-            element = {}
-            group = fi.read(2)
-            if not group:
+            pos, done = parse_data_elements(buf, pos, header, table, search_for_tags, stop_after)
+            if done:
                 break
-            element['group'] = '{0:04X}'.format(int.from_bytes(group, byteorder='little', signed=False))
-            element['element'] = '{0:04X}'.format(int.from_bytes(fi.read(2), byteorder='little', signed=False))
-            tag = ','.join((element['group'], element['element']))
-            # print(tag, end='')
-            element['VR'] = fi.read(2).decode(encoding)
-            # print(':', element['VR'])
-            if element['VR'] in ['OB', 'OW', 'OF', 'SQ', 'UT', 'UN']:
-                fi.seek(2, 1)
-                element['length'] = int.from_bytes(fi.read(4), byteorder='little', signed=False)
-            else:
-                element['length'] = int.from_bytes(fi.read(2), byteorder='little', signed=False)
-            if element['length'] == 4294967295: # 0xFFFFFFFF: Undefined Length
-                if element['VR'] == 'SQ':
-                    parse_SQ_data_element(fi)
-                else:
-                    # print(element['VR'])
-                    raise NotImplementedError('** Undefined Length')
-            elif tag in tag_parsers:
-                header[tag_parsers[tag][0]] = tag_parsers[tag][1](fi.read(element['length']))
-            else:
-                fi.seek(element['length'], 1)
-            elements.append(element)
-            if search_for_tags is not None and tag in search_for_tags:
-                n_tags_seen += 1
-                if n_tags_seen == len(search_for_tags):
-                    break
-    # elements = pd.DataFrame(elements, columns=['group', 'element', 'VR', 'length'])
+            more = fi.read(len(buf)) # Double the buffer for long headers
+            if not more: # End of file
+                break
+            buf = buf[pos:] + more
+            pos = 0
     # Custom header fields
     for field, parser in custom_parsers.items():
         try:
@@ -268,33 +557,364 @@ def parse_dicom_header(fname, search_for_tags=None, **kwargs):
     return header
 
 
-def sort_dicom_series(folder):
+def _to_json(x):
+    '''
+    Header values as JSON-compatible objects, with numpy, datetime, bytes, tuple and (unordered) dict values 
+    tagged (e.g., {"__ndarray__": dtype, "data": [...]}), so that `_from_json` restores their types.
+    Raise TypeError for anything else, which is then not indexed.
+    '''
+    if isinstance(x, np.ndarray) and x.dtype.kind in 'biufU':
+        return {'__ndarray__': x.dtype.str, 'shape': x.shape, 'data': x.tolist()}
+    elif isinstance(x, np.generic) and x.dtype.kind in 'biufU': # Before float/int, as np.float64 is also a float
+        return {'__npscalar__': x.dtype.str, 'data': x.item()}
+    elif x is None or isinstance(x, (bool, int, float, six.string_types)):
+        return x
+    elif isinstance(x, dict) and all(isinstance(k, six.string_types) for k in x):
+        d = OrderedDict((k, _to_json(v)) for k, v in x.items())
+        return d if isinstance(x, OrderedDict) else {'__dict__': d}
+    elif isinstance(x, list):
+        return [_to_json(v) for v in x]
+    elif isinstance(x, tuple):
+        return {'__tuple__': [_to_json(v) for v in x]}
+    elif isinstance(x, datetime): # Before date, as datetime is also a date
+        return {'__datetime__': x.isoformat()}
+    elif isinstance(x, date):
+        return {'__date__': x.isoformat()}
+    elif isinstance(x, time):
+        return {'__time__': x.isoformat()}
+    elif isinstance(x, bytes):
+        return {'__bytes__': base64.b64encode(x).decode('ascii')}
+    else:
+        raise TypeError('** Cannot index value of type {0}'.format(type(x).__name__))
+
+
+_json_tags = {
+    '__ndarray__': lambda d: np.array(d['data'], dtype=d['__ndarray__']).reshape(d['shape']),
+    '__npscalar__': lambda d: np.dtype(d['__npscalar__']).type(d['data']),
+    '__tuple__': lambda d: tuple(d['__tuple__']),
+    '__dict__': lambda d: dict(d['__dict__']),
+    '__datetime__': lambda d: datetime.fromisoformat(d['__datetime__']),
+    '__date__': lambda d: date.fromisoformat(d['__date__']),
+    '__time__': lambda d: time.fromisoformat(d['__time__']),
+    '__bytes__': lambda d: base64.b64decode(d['__bytes__']),
+}
+
+def _from_json(pairs):
+    '''object_pairs_hook for json.loads, reversing `_to_json`.'''
+    d = OrderedDict(pairs)
+    tag = next(iter(d), None)
+    return _json_tags[tag](d) if tag in _json_tags else d
+
+
+INDEX_FILE = '.mripy_dicom_index.sqlite'
+INDEX_VERSION = 4 # Bump this whenever the fields returned by the parsers change
+
+class HeaderIndex(object):
+    '''
+    Persistent index of parsed dicom headers, stored as an SQLite database 
+    (INDEX_FILE) within the raw data folder.
+
+    Entries are keyed by file name, size and mtime, so that repeated calls 
+    only need to parse files that are new or have been modified.
+    Headers are stored as JSON (see `_to_json`) rather than pickled, because the 
+    data folder may be shared, and loading a pickle could run arbitrary code.
+    '''
+    def __init__(self, folder):
+        self.folder = path.realpath(folder)
+        self.fname = path.join(self.folder, INDEX_FILE)
+        self.db = sqlite3.connect(self.fname, timeout=30)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS headers')
+            self.db.execute('PRAGMA user_version = {0:d}'.format(INDEX_VERSION))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS headers (name TEXT, parser TEXT, 
+            size INTEGER, mtime INTEGER, header BLOB, PRIMARY KEY (name, parser))''')
+        self.db.commit()
+
+    @classmethod
+    def open(cls, folder):
+        '''Return None instead of raising if the index cannot be created (e.g., read-only folder).'''
+        try:
+            return cls(folder)
+        except sqlite3.Error:
+            return None
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _query(self, names, keys):
+        cached = {}
+        for k in range(0, len(names), 500): # Stay within SQLite's limit on the number of host parameters
+            chunk = names[k:k+500]
+            rows = self.db.execute('SELECT name, parser, size, mtime, header FROM headers WHERE parser IN ({0}) AND name IN ({1})'.format(
+                ','.join('?'*len(keys)), ','.join('?'*len(chunk))), keys + chunk)
+            for name, key, size, mtime, blob in rows:
+                cached.setdefault(name, {})[key] = (size, mtime, blob)
+        return cached
+
+    def parse(self, files, parser=None, n_jobs=None, **kwargs):
+        '''
+        Parameters
+        ----------
+        files : list
+            Dicom files within `self.folder`.
+        parser : callable
+            Default is `parse_dicom_header`. Headers from different parsers are indexed separately.
+        n_jobs : int
+            Number of processes for parsing new files (see `parse_in_parallel`).
+        **kwargs :
+            Passed to the parser, e.g., `search_for_tags` and `search_only`. 
+            Headers parsed with different kwargs are indexed separately, 
+            and a cached full header also satisfies a partial request.
+
+        Returns
+        -------
+        headers : list
+        '''
+        if parser is None:
+            parser = parse_dicom_header
+        keys = ['{0}.{1}'.format(parser.__module__, parser.__qualname__)]
+        if kwargs:
+            keys.append(keys[0] + '?' + '&'.join('{0}={1}'.format(k, ','.join(sorted(v)) 
+                if isinstance(v, (set, frozenset, list, tuple)) else v) for k, v in sorted(kwargs.items())))
+        names = [path.basename(f) for f in files]
+        cached = self._query(names, keys)
+        headers = [None] * len(files)
+        stats = {}
+        for k, (f, name) in enumerate(zip(files, names)):
+            st = os.stat(f)
+            for key in keys: # Full header takes precedence
+                size, mtime, blob = cached.get(name, {}).get(key, (None, None, None))
+                if size == st.st_size and mtime == st.st_mtime_ns:
+                    try: # JSON rather than pickle, so that a tampered index cannot run code
+                        headers[k] = json.loads(blob, object_pairs_hook=_from_json)
+                    except (ValueError, TypeError, KeyError):
+                        continue
+                    if 'filename' in headers[k]:
+                        headers[k]['filename'] = path.join(self.folder, name)
+                    break
+            else:
+                stats[k] = st
+        missing = sorted(stats)
+        parsed = parse_in_parallel([files[k] for k in missing], parser, kwargs, n_jobs=n_jobs)
+        updated = []
+        for k, header in zip(missing, parsed):
+            headers[k] = header
+            try:
+                updated.append((names[k], keys[-1], stats[k].st_size, stats[k].st_mtime_ns, json.dumps(_to_json(header))))
+            except (TypeError, ValueError): # E.g., values of a custom parser that have no JSON form
+                pass
+        if updated:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO headers VALUES (?,?,?,?,?)', updated)
+                self.db.commit()
+            except sqlite3.Error: # E.g., an existing index in a read-only folder
+                pass
+        return headers
+
+
+def _parse_chunk(parser, files, kwargs):
+    return [parser(f, **kwargs) for f in files]
+
+
+def parse_in_parallel(files, parser=None, kwargs=None, n_jobs=None, chunk_size=256):
+    '''
+    Parse dicom headers across a process pool, in chunks of files.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of processes. Default is 3/4 of the CPUs. 
+        Small lists (less than two chunks) are always parsed serially 
+        because spawning the pool would cost more than it saves.
+    chunk_size : int
+        Maximal number of files sent to a worker at once. The actual chunk 
+        size is reduced for shorter lists to keep all workers busy.
+    '''
+    if parser is None:
+        parser = parse_dicom_header
+    if kwargs is None:
+        kwargs = {}
+    if n_jobs is None:
+        n_jobs = max(multiprocessing.cpu_count() * 3 // 4, 1)
+    if n_jobs <= 1 or len(files) < 2*chunk_size:
+        return _parse_chunk(parser, files, kwargs)
+    chunk_size = min(chunk_size, -(-len(files) // (n_jobs*4))) # ceil
+    chunks = [files[k:k+chunk_size] for k in range(0, len(files), chunk_size)]
+    with multiprocessing.Pool(n_jobs) as pool:
+        parsed = pool.starmap(_parse_chunk, [(parser, chunk, kwargs) for chunk in chunks])
+    return list(itertools.chain.from_iterable(parsed))
+
+
+def parse_dicom_headers(files, parser=None, use_index=True, n_jobs=None, **kwargs):
+    '''
+    Parse dicom headers of a list of files (in parallel), reusing (and updating) 
+    the HeaderIndex of each folder if `use_index` is True.
+
+    **kwargs are passed to the parser, e.g., `search_for_tags` and `search_only`.
+    '''
+    if parser is None:
+        parser = parse_dicom_header
+    if not use_index:
+        return parse_in_parallel(files, parser, kwargs, n_jobs=n_jobs)
+    folders = OrderedDict()
+    for k, f in enumerate(files):
+        folders.setdefault(path.dirname(f), []).append(k)
+    headers = [None] * len(files)
+    for folder, indices in folders.items():
+        subset = [files[k] for k in indices]
+        index = HeaderIndex.open(folder if folder else '.')
+        if index is None:
+            parsed = parse_in_parallel(subset, parser, kwargs, n_jobs=n_jobs)
+        else:
+            with index:
+                parsed = index.parse(subset, parser=parser, n_jobs=n_jobs, **kwargs)
+        for k, header in zip(indices, parsed):
+            headers[k] = header
+    return headers
+
+
+DICOM_EXTS = ['.IMA', '.dcm', '.dcm.gz']
+SORT_TAGS = {'0020,0010', '0020,0011', '0020,0013'} # StudyID, SeriesNumber, InstanceNumber
+
+def _group_studies(grouped):
+    '''{study_id: {series_id: [(InstanceNumber, name), ...]}} -> [{'0001': [names], ...}, ...]'''
+    studies = []
+    for study_id in sorted(grouped):
+        study = OrderedDict()
+        for series_id, series in sorted(grouped[study_id].items()):
+            series.sort(key=lambda x: x[0]) # Stable, so files with the same InstanceNumber keep their order
+            study['{0:04d}'.format(series_id)] = [x[1] for x in series]
+        studies.append(study)
+    return studies
+
+
+def sort_dicom_series(folder, use_index=True, n_jobs=None):
     '''
     Parameters
     ----------
     folder : string
         Path to the folder containing all the dicom files.
+    use_index : bool
+        Reuse headers parsed by previous calls (see HeaderIndex).
+    n_jobs : int
+        Number of processes for parsing headers (see `parse_in_parallel`).
 
     Returns
     -------
     studies : list of dicts
         [{'0001': [file0, file1, ...], '0002': [files], ...}, {study1}, ...]
     '''
-    exts = ['.IMA', '.dcm', '.dcm.gz']
-    files = sorted(itertools.chain.from_iterable(glob.glob(path.join(folder, '*'+ext)) for ext in exts))
-    headers = [parse_dicom_header(f, search_for_tags={'0020,0010', '0020,0011', '0020,0013'}) for f in files]
-    studies = []
-    for study_id in np.unique([header['StudyID'] for header in headers]):
-        study = OrderedDict()
-        for series_id in np.unique([header['SeriesNumber'] for header in headers if header['StudyID'] == study_id]):
-            series = sorted([(path.basename(header['filename']), header['InstanceNumber']) for header in headers \
-                if header['StudyID']==study_id and header['SeriesNumber']==series_id], key=lambda x: x[1])
-            study['{0:04d}'.format(series_id)] = [x[0] for x in series]
-        studies.append(study)
-    return studies
+    files = sorted(itertools.chain.from_iterable(glob.glob(path.join(folder, '*'+ext)) for ext in DICOM_EXTS))
+    headers = parse_dicom_headers(files, search_for_tags=SORT_TAGS, search_only=True, use_index=use_index, n_jobs=n_jobs)
+    # Group files by study and series in a single pass
+    grouped = {}
+    for f, header in zip(files, headers):
+        series = grouped.setdefault(header['StudyID'], {}).setdefault(header['SeriesNumber'], [])
+        series.append((header['InstanceNumber'], path.basename(f)))
+    return _group_studies(grouped)
+
 
+class DicomFolderCursor(object):
+    '''
+    Incrementally sort dicom files into studies and series as they arrive in a folder
+    (e.g., during scanning), so that each call to `update()` only needs to deal with
+    files that are new since the last call.
+
+    The cursor itself is the (name, size, mtime) of every file that has been sorted.
+    Headers are looked up from the HeaderIndex of the folder, so a restarted cursor 
+    catches up quickly without parsing the files again.
 
-def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=False):
+    Examples
+    --------
+    >>> cursor = DicomFolderCursor('raw_fmri')
+    >>> while scanning:
+    ...     for (study_id, series_id), files in cursor.update().items():
+    ...         copy_files(files)
+    ...     time.sleep(5)
+    '''
+    def __init__(self, folder, use_index=True, n_jobs=None):
+        self.folder = folder
+        self.use_index = use_index
+        self.n_jobs = n_jobs
+        self.seen = {} # name -> (size, mtime)
+        self.grouped = {} # study_id -> series_id -> [(InstanceNumber, name), ...]
+        self.location = {} # name -> (study_id, series_id)
+
+    def _parse(self, files):
+        try:
+            return parse_dicom_headers(files, search_for_tags=SORT_TAGS, search_only=True, use_index=self.use_index, n_jobs=self.n_jobs)
+        except Exception: # Some file is still being written, so try them one by one
+            headers = []
+            for f in files:
+                try:
+                    headers.extend(parse_dicom_headers([f], search_for_tags=SORT_TAGS, search_only=True, use_index=self.use_index, n_jobs=1))
+                except Exception:
+                    headers.append(None)
+            return headers
+
+    def update(self, settle=2.0):
+        '''
+        Sort files that are new (or modified) since the last update.
+
+        Parameters
+        ----------
+        settle : float
+            Files modified within the last `settle` seconds are left for the next 
+            update, as they may still be being written.
+
+        Returns
+        -------
+        new_files : OrderedDict
+            {(study_id, series_id): [file0, file1, ...]} for newly sorted files, 
+            where series_id is formatted like '0001'.
+        '''
+        now = datetime.now().timestamp()
+        candidates = []
+        for f in sorted(itertools.chain.from_iterable(glob.glob(path.join(self.folder, '*'+ext)) for ext in DICOM_EXTS)):
+            try:
+                st = os.stat(f)
+            except OSError: # Removed in the meantime
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if self.seen.get(path.basename(f)) != state and now - st.st_mtime > settle:
+                candidates.append((f, state))
+        new_files = OrderedDict()
+        if not candidates:
+            return new_files
+        headers = self._parse([f for f, state in candidates])
+        for (f, state), header in zip(candidates, headers):
+            if header is None or not all(k in header for k in ['StudyID', 'SeriesNumber', 'InstanceNumber']):
+                continue # Incomplete file, which will be retried next time
+            name = path.basename(f)
+            if name in self.location: # Modified file
+                study_id, series_id = self.location[name]
+                self.grouped[study_id][series_id] = [x for x in self.grouped[study_id][series_id] if x[1] != name]
+            study_id, series_id = header['StudyID'], header['SeriesNumber']
+            self.grouped.setdefault(study_id, {}).setdefault(series_id, []).append((header['InstanceNumber'], name))
+            self.location[name] = (study_id, series_id)
+            self.seen[name] = state
+            new_files.setdefault((study_id, '{0:04d}'.format(series_id)), []).append((header['InstanceNumber'], name))
+        for key, series in new_files.items():
+            series.sort(key=lambda x: x[0])
+            new_files[key] = [path.join(self.folder, x[1]) for x in series]
+        return new_files
+
+    def study_ids(self):
+        return sorted(self.grouped)
+
+    def studies(self):
+        '''All files sorted so far, in the same format as `sort_dicom_series`.'''
+        return _group_studies({study_id: {series_id: list(series) for series_id, series in study.items()} 
+            for study_id, study in self.grouped.items()})
+
+
+def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=False, use_index=True):
     '''
     Parameters
     ----------
@@ -302,6 +922,8 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
         A list of dicom files (e.g., as provided by sort_dicom_series), or
         a folder that contains a single series (e.g., "../raw_fmri/func01"), or 
         a single dicom file.
+    use_index : bool
+        Reuse headers parsed by previous calls (see HeaderIndex).
     '''
     if dicom_ext is None:
         dicom_ext = '.IMA'
@@ -314,7 +936,7 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
         else:
             dicom_files = [dicom_files]
     # Parse dicom headers
-    headers = [parser(f) for f in dicom_files]
+    headers = parse_dicom_headers(dicom_files, parser=parser, use_index=use_index)
     info = OrderedDict(headers[0])
     assert(np.all(np.array([header['StudyID'] for header in headers])==info['StudyID']))
     assert(np.all(np.array([header['SeriesNumber'] for header in headers])==info['SeriesNumber']))
@@ -344,6 +966,178 @@ def parse_series_info(dicom_files, dicom_ext=None, parser=None, return_headers=F
     return info
 
 
+# ========== Volume assembly ==========
+def read_dicom_pixels(fname, header=None):
+    '''
+    Read the pixel data of a single dicom file as a (Rows, Columns) array.
+
+    Only uncompressed (native) pixel data in Explicit VR Little Endian is supported.
+
+    Parameters
+    ----------
+    fname : str
+    header : dict
+        Header as returned by `parse_dicom_header` (parsed anew if not provided).
+    '''
+    if header is None:
+        header = parse_dicom_header(fname)
+    with open_dicom(fname) as fi:
+        buf = fi.read()
+    pos, done = parse_data_elements(buf, 132, {}, table={})
+    if not done or _element_struct.unpack_from(buf, pos)[:2] != (PIXEL_DATA >> 16, PIXEL_DATA & 0xFFFF):
+        raise ValueError('** Cannot find pixel data in "{0}"'.format(fname))
+    length = _uint32_struct.unpack_from(buf, pos+8)[0]
+    if length == UNDEFINED_LENGTH:
+        raise NotImplementedError('** Encapsulated (compressed) pixel data is not supported')
+    dtype = '<{0}{1}'.format('i' if header.get('PixelRepresentation', 0) else 'u', header.get('BitsAllocated', 16)//8)
+    n_pixels = header['Rows'] * header['Columns']
+    return np.frombuffer(buf, dtype=dtype, count=n_pixels, offset=pos+12).reshape(header['Rows'], header['Columns'])
+
+
+def _read_pixels_chunk(files, headers):
+    return [read_dicom_pixels(f, header) for f, header in zip(files, headers)]
+
+
+def demosaic(pixels, n_slices):
+    '''
+    Split a Siemens mosaic image of shape (Rows, Columns) into (n_slices, rows, columns) slices,
+    which are tiled row by row in a ceil(sqrt(n_slices)) x ceil(sqrt(n_slices)) grid.
+    '''
+    n_tiles = int(np.ceil(np.sqrt(n_slices)))
+    rows, columns = pixels.shape[0]//n_tiles, pixels.shape[1]//n_tiles
+    tiles = pixels.reshape(n_tiles, rows, n_tiles, columns).swapaxes(1, 2).reshape(-1, rows, columns)
+    return tiles[:n_slices]
+
+
+def get_slice_normal(header):
+    '''
+    Direction (LPS) in which the slices are stored, from the CSA SliceNormalVector if available.
+
+    The cross product of the row and column cosines only gives the axis. The slices of 
+    a mosaic may run in the opposite direction (e.g., descending slice order, and some 
+    sagittal/coronal mosaics), which is only recorded in the CSA Image Header.
+    '''
+    iop = np.asarray(header['ImageOrientationPatient'], dtype=float).reshape(2,3)
+    normal = np.cross(iop[0], iop[1])
+    csa_normal = header.get('CSA', {}).get('SliceNormalVector')
+    if csa_normal is not None and np.dot(normal, csa_normal) < 0:
+        normal = -normal
+    return normal
+
+
+def get_dicom_affine(header, n_slices=None, slice_spacing=None):
+    '''
+    Voxel to world (RAS+, as in NIFTI) affine for the data arrays returned by
+    `read_dicom_volume`, whose axes are (column, row, slice), as nibabel does.
+
+    Parameters
+    ----------
+    header : dict
+        Header of the first slice (or of the mosaic).
+    n_slices : int
+        Number of slices in the mosaic. The ImagePositionPatient of a mosaic refers to 
+        the whole mosaic, and is shifted to the first slice here.
+    slice_spacing : float
+        Default is SpacingBetweenSlices if available, otherwise SliceThickness.
+
+    References
+    ----------
+    [1] https://nipy.org/nibabel/dicom/dicom_orientation.html
+    [2] https://nipy.org/nibabel/dicom/dicom_mosaic.html
+    '''
+    iop = np.asarray(header['ImageOrientationPatient'], dtype=float).reshape(2,3).T # Row cosine, column cosine
+    normal = get_slice_normal(header)
+    row_spacing, column_spacing = np.asarray(header['PixelSpacing'], dtype=float)
+    if slice_spacing is None:
+        slice_spacing = float(header.get('SpacingBetweenSlices', header['SliceThickness']))
+    position = np.asarray(header['ImagePositionPatient'], dtype=float)
+    if n_slices is not None: # Mosaic
+        n_tiles = int(np.ceil(np.sqrt(n_slices)))
+        shift = np.r_[header['Columns'] - header['Columns']/n_tiles, header['Rows'] - header['Rows']/n_tiles] / 2
+        position = position + np.dot(iop * [column_spacing, row_spacing], shift)
+    affine = np.eye(4)
+    affine[:3,:3] = np.c_[iop, normal] * [column_spacing, row_spacing, slice_spacing]
+    affine[:3,3] = position
+    return np.diag([-1, -1, 1, 1]).dot(affine) # LPS to RAS
+
+
+def read_dicom_volume(dicom_files, headers=None, use_index=True, n_jobs=None):
+    '''
+    Assemble the dicom files of a single series into a (x, y, z, t) array,
+    without calling external programs (e.g., Dimon/to3d) or writing temp files.
+
+    Both Siemens mosaic (one volume per file) and single slice (one slice per file)
+    series are supported. Slices are sorted by their position along the slice normal,
+    and volumes by InstanceNumber.
+
+    Parameters
+    ----------
+    dicom_files : list or str
+        A list of dicom files (e.g., as provided by sort_dicom_series), or
+        a folder that contains a single series.
+    headers : list
+        Parsed headers of `dicom_files` (see parse_dicom_headers).
+    n_jobs : int
+        Number of processes for reading pixel data (only used for many files).
+
+    Returns
+    -------
+    vol : 4D array
+    affine : 4x4 array
+        In RAS+ (i.e., NIFTI) convention.
+    info : dict
+        TR (in sec), and slice_timing (in sec, only for mosaic).
+    '''
+    if isinstance(dicom_files, six.string_types):
+        dicom_files = sorted(glob.glob(path.join(dicom_files, '*.IMA')))
+    if headers is None:
+        headers = parse_dicom_headers(dicom_files, use_index=use_index, n_jobs=n_jobs)
+    order = sorted(range(len(headers)), key=lambda k: headers[k]['InstanceNumber'])
+    dicom_files = [dicom_files[k] for k in order]
+    headers = [headers[k] for k in order]
+    h0 = headers[0]
+    mosaic = h0.get('n_slices', 1) > 1 # NumberOfImagesInMosaic
+    # Read pixel data
+    if n_jobs is None:
+        n_jobs = max(multiprocessing.cpu_count() * 3 // 4, 1)
+    if n_jobs > 1 and len(dicom_files) >= 4*n_jobs:
+        chunks = [(dicom_files[k::n_jobs], headers[k::n_jobs]) for k in range(n_jobs)]
+        with multiprocessing.Pool(n_jobs) as pool:
+            res = pool.starmap(_read_pixels_chunk, chunks)
+        pixels = [None] * len(dicom_files)
+        for k, chunk in enumerate(res):
+            pixels[k::n_jobs] = chunk
+    else:
+        pixels = _read_pixels_chunk(dicom_files, headers)
+    info = OrderedDict()
+    if mosaic:
+        n_slices = int(h0['n_slices'])
+        vol = np.stack([demosaic(p, n_slices) for p in pixels], axis=-1) # z, row, column, t
+        vol = vol.transpose(2, 1, 0, 3)
+        affine = get_dicom_affine(h0, n_slices=n_slices)
+        if 'MosaicRefAcqTimes' in h0:
+            info['slice_timing'] = np.atleast_1d(h0['MosaicRefAcqTimes']) / 1000
+    else:
+        normal = get_slice_normal(h0) # Slices are sorted along this direction, as in the affine
+        d = np.round([np.dot(normal, header['ImagePositionPatient']) for header in headers], 4)
+        z = np.unique(d)
+        if len(headers) % len(z):
+            raise ValueError('** The number of files ({0}) is not a multiple of the number of slices ({1})'.format(len(headers), len(z)))
+        n_volumes = len(headers) // len(z)
+        vol = np.zeros((h0['Columns'], h0['Rows'], len(z), n_volumes), dtype=pixels[0].dtype)
+        count = np.zeros(len(z), dtype=int)
+        for p, k in zip(pixels, np.searchsorted(z, d)):
+            vol[:,:,k,count[k]] = p.T
+            count[k] += 1
+        first = headers[int(np.argmin(d))]
+        affine = get_dicom_affine(first, slice_spacing=np.median(np.diff(z)) if len(z) > 1 else None)
+    info['TR'] = float(h0['RepetitionTime']) / 1000
+    slope, intercept = h0.get('RescaleSlope'), h0.get('RescaleIntercept')
+    if slope is not None or intercept is not None:
+        info['scl_slope'] = float(slope) if slope is not None else 1.0
+        info['scl_inter'] = float(intercept) if intercept is not None else 0.0
+    return vol, affine, info
+
 
 if __name__ == '__main__':
     print(parse_dicom_header('20180626_S18_EP2DBR_S07.MR.S18_APPROVED.0010.0001.2018.06.26.12.47.59.31250.120791562.IMA'))
@@ -3,7 +3,6 @@
 import inspect, re, glob
 from os import path
 from collections import OrderedDict
-import pandas as pd
 from . import dicom
 
 
@@ -76,6 +75,7 @@ def report_parameters(dicom_folder, preset=None, return_preset=False, return_inf
 
 
 def inspect_mp2rage(data_dir, subdir_pattern='T1??'):
+    import pandas as pd
     sess_dirs = sorted([f for f in glob.glob(f"{data_dir}/*") if path.isdir(f)])
     df = []
     for sess_dir in sess_dirs:
@@ -3,8 +3,6 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import time
 import numpy as np
-from scipy import optimize, stats
-from deepdish import io as dio
 from . import utils, math
 
 
@@ -245,6 +243,7 @@ class BayesianChannelModel(BaseModel):
         # Store params
         self.W_ = W
         # Step 2: Estimate tau, rho, sigma by ML optimization (gradient-based)
+        from scipy import optimize
         z = b - W @ fs # n_voxels * n_trials
         # Initial params
         tau0 = np.std(b, axis=1)
@@ -400,6 +399,7 @@ class BayesianChannelModel(BaseModel):
         tau = np.random.rand(n_voxels)
         rho = 0.5
         sigma = 0.1
+        from scipy import stats
         mv_norm = stats.multivariate_normal(np.zeros(n_voxels), self._calc_Omega(W, tau, rho, sigma))
         np.testing.assert_allclose(self._calc_L(z, W, tau, rho, sigma),
             np.sum(mv_norm.logpdf(z.T)), rtol=1e-6)
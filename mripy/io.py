@@ -1,15 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import sys, os, subprocess
+import sys, os, subprocess, multiprocessing, sqlite3
 import re, glob, shlex, shutil, tempfile, warnings
 import collections, itertools, copy
 import random, string
 from os import path
 from datetime import datetime
 import numpy as np
-from scipy import ndimage
-from . import six, utils, afni, math, paraproc
+from . import six, utils, afni, math, paraproc, dicom
 # For accessing NIFTI files
 try:
     import nibabel
@@ -57,41 +56,71 @@ def mmn2dt(mmn, date=None, timestamp=False):
 
 
 # Physiological data
+_physio_data_end = re.compile(rb'5003(?:\r\n|\n|\r|$)') # The first line ending with 5003 ends the data line(s)
+
+def _strip_physio_messages(data):
+    '''
+    Equivalent to re.findall/re.sub with r'\s5002\s(.+?)\s6002', but using bytes.find, 
+    which is much faster than regex for the few messages within millions of samples.
+    '''
+    messages, chunks = [], []
+    pos = search = 0
+    while True:
+        start = data.find(b'5002', search)
+        if start < 0:
+            break
+        if start == 0 or not data[start-1:start].isspace() or not data[start+4:start+5].isspace():
+            search = start + 1
+            continue
+        stop = data.find(b'6002', start+7) # At least one character in between
+        while stop >= 0 and not data[stop-1:stop].isspace():
+            stop = data.find(b'6002', stop+1)
+        if stop < 0:
+            break
+        messages.append(data[start+5:stop-1])
+        chunks.append(data[pos:start-1])
+        pos = search = stop + 4
+    chunks.append(data[pos:])
+    return messages, b''.join(chunks)
+
+
 def _parse_physio_raw(fname):
     # print('Parsing "{0}"...'.format(fname))
     n_pre = {'ecg': 5, 'ext': 4, 'puls': 4, 'resp': 4}
-    with open(fname, 'r') as fin:
-        info = {}
-        ch = path.splitext(fname)[1][1:]
-        info['file'] = path.realpath(fname)
-        info['channel'] = ch
-        lines = fin.read().splitlines() # Without \n unlike fin.readlines()
-        if len(lines) == 0:
-            print('*+ WARNING: "{0}" seems be empty...'.format(fname), file=sys.stderr)
-            return None
-        k = 0
-        # Data line(s)
-        while lines[k][-4:] != '5003': # There can be more than one data lines
-            k += 1
-            if k >= len(lines): # The file does not contain 5003
-                print('*+ WARNING: "{0}" might be broken...'.format(fname), file=sys.stderr)
-                return None
-        else:
+    with open(fname, 'rb') as fin:
+        raw = fin.read()
+    info = {}
+    ch = path.splitext(fname)[1][1:]
+    info['file'] = path.realpath(fname)
+    info['channel'] = ch
+    if len(raw) == 0:
+        print('*+ WARNING: "{0}" seems be empty...'.format(fname), file=sys.stderr)
+        return None
+    # Data line(s)
+    match = _physio_data_end.search(raw) # There can be more than one data lines
+    if match is None: # The file does not contain 5003
+        print('*+ WARNING: "{0}" might be broken...'.format(fname), file=sys.stderr)
+        return None
+    data_line = raw[:match.start()+4].replace(b'\r', b'').replace(b'\n', b'') # Lines are joined without separator
+    messages, data_line = _strip_physio_messages(data_line) # Remove messages inserted between 5002/6002
+    info['messages'] = [m.decode('utf-8') for m in messages]
+    if len(data_line.translate(None, b'0123456789 \t-')) == 0:
+        # Tokenize and convert the whole sample stream in C, which is several times faster than str.split()
+        info['rawdata'] = np.fromstring(data_line, dtype=np.int_, sep=' ')[n_pre[ch]:-1]
+    else: # Unexpected characters, let int() complain about them
+        info['rawdata'] = np.int_(data_line.split()[n_pre[ch]:-1])
+    # Timing lines
+    lines = raw[match.end():].decode('utf-8').splitlines()
+    k = 0
+    items = ['LogStartMDHTime', 'LogStopMDHTime', 'LogStartMPCUTime', 'LogStopMPCUTime']
+    for item in items:
+        while True:
+            match = re.match('({0}):\s+(\d+)'.format(item), lines[k])
             k += 1
-            data_line = ''.join(lines[:k])
-            info['messages'] = re.findall('\s5002\s(.+?)\s6002', data_line)
-            data_line = re.sub('\s5002\s(.+?)\s6002', '', data_line) # Remove messages inserted between 5002/6002
-            info['rawdata'] = np.int_(data_line.split()[n_pre[ch]:-1])
-        # Timing lines
-        items = ['LogStartMDHTime', 'LogStopMDHTime', 'LogStartMPCUTime', 'LogStopMPCUTime']
-        for item in items:
-            while True:
-                match = re.match('({0}):\s+(\d+)'.format(item), lines[k])
-                k += 1
-                if match:
-                    info[match.group(1)] = int(match.group(2))
-                    break
-        return info
+            if match:
+                info[match.group(1)] = int(match.group(2))
+                break
+    return info
 
 
 def parse_physio_file(fname, date=None):
@@ -142,18 +171,21 @@ def parse_physio_file(fname, date=None):
     if ch != 'ecg':
         # y = x.copy()
         # y = x[x!=trig_value] # Strip trigger value (5000)
-        y = x[~np.in1d(x, tag_values)] # Strip all tag values (5000, 6000, ...)
+        is_trig = (x == trig_value)
+        is_tag = is_trig | (x == tag_values[1])
+        y = x[~is_tag] # Strip all tag values (5000, 6000, ...)
         trig = np.zeros_like(x)
-        trig[np.nonzero(x==trig_value)[0]-1] = 1
-        trig = trig[x!=trig_value]
+        trig[np.nonzero(is_trig)[0]-1] = 1
+        trig = trig[~is_trig]
     else:
         y = x[:len(x)//2*2].reshape(-1,2)
         trig = np.zeros_like(y)
     info['data'] = y
     info['trig'] = trig
+    info['n_samples'] = len(y)
     info['t'] = info['start'] + np.arange(len(y)) / fs[ch]
     try:
-        assert(max(y) < 4096) # Valid data range is [0, 4095]
+        assert(np.max(y) < 4096) # Valid data range is [0, 4095]
     except AssertionError as err:
         print('\n** Invalid data value detected: {0}'.format(np.unique(y[y>4095])))
         raise err
@@ -166,42 +198,220 @@ def parse_physio_file(fname, date=None):
     return info
 
 
-def parse_physio_files(fname, date=None, channels=None):
+PHYSIO_INDEX_FILE = '.mripy_physio_index.sqlite'
+PHYSIO_INDEX_VERSION = 1 # Bump this whenever the fields returned by parse_physio_file change
+PHYSIO_INDEX_FIELDS = ['channel', 'fs', 'LogStartMDHTime', 'LogStopMDHTime', 'LogStartMPCUTime', 'LogStopMPCUTime', 'n_samples']
+
+class PhysioInfo(dict):
     '''
+    Info of a single physio file as returned by `parse_physio_file`, whose timing is 
+    restored from the PhysioIndex, and whose samples (data, trig, t, etc.) are only 
+    parsed from the file when they are first accessed.
     '''
-    if channels is None:
-        channels = ['ecg', 'ext', 'puls', 'resp']
-    stem = path.splitext(fname)[0]
-    info = collections.OrderedDict()
-    for ch in channels:
-        info[ch] = parse_physio_file('.'.join((stem, ch)), date=date)
-        if info[ch] is None:
-            print('*+ WARNING: "{0}" info is missing. Skip "{1}"...'.format(ch, stem), file=sys.stderr)
+    def __init__(self, fname, date, *args, **kwargs):
+        super(PhysioInfo, self).__init__(*args, **kwargs)
+        self.fname = fname
+        self.date = date
+
+    def __missing__(self, key):
+        if key in ['rawdata', 'messages', 'data', 'trig', 't']:
+            info = parse_physio_file(self.fname, date=self.date)
+            if info is None:
+                raise ValueError('** Failed to load samples from "{0}"'.format(self.fname))
+            self.update(info)
+            return self[key]
+        raise KeyError(key)
+
+    def __reduce__(self): # Pickle (e.g., for multiprocessing) as a plain dict, plus attributes
+        return (self.__class__, (self.fname, self.date, dict(self)))
+
+
+class PhysioIndex(object):
+    '''
+    Persistent index of the timing of physio files (see PHYSIO_INDEX_FIELDS), stored as 
+    an SQLite database (PHYSIO_INDEX_FILE) within the physio folder (like dicom.HeaderIndex).
+
+    Entries are keyed by file name, size and mtime, so that matching physio files with 
+    series doesn't have to parse the full logs again.
+    '''
+    def __init__(self, folder):
+        self.folder = path.realpath(folder)
+        self.fname = path.join(self.folder, PHYSIO_INDEX_FILE)
+        self.db = sqlite3.connect(self.fname, timeout=30)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != PHYSIO_INDEX_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS physio')
+            self.db.execute('PRAGMA user_version = {0:d}'.format(PHYSIO_INDEX_VERSION))
+        self.db.execute('''CREATE TABLE IF NOT EXISTS physio (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, 
+            {0})'''.format(', '.join(PHYSIO_INDEX_FIELDS)))
+        self.db.commit()
+
+    @classmethod
+    def open(cls, folder):
+        '''Return None instead of raising if the index cannot be created (e.g., read-only folder).'''
+        try:
+            return cls(folder)
+        except sqlite3.Error:
             return None
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, files):
+        '''Return {file: {field: value}} for indexed files that have not been modified since.'''
+        names = {path.basename(f): f for f in files}
+        found = {}
+        keys = list(names)
+        for k in range(0, len(keys), 500): # Stay within SQLite's limit on the number of host parameters
+            chunk = keys[k:k+500]
+            rows = self.db.execute('SELECT * FROM physio WHERE name IN ({0})'.format(','.join('?'*len(chunk))), chunk)
+            for row in rows:
+                f = names[row[0]]
+                st = os.stat(f)
+                if row[1] == st.st_size and row[2] == st.st_mtime_ns:
+                    found[f] = dict(zip(PHYSIO_INDEX_FIELDS, row[3:]))
+        return found
+
+    def update(self, infos):
+        rows = []
+        for info in infos:
+            st = os.stat(info['file'])
+            rows.append([path.basename(info['file']), st.st_size, st.st_mtime_ns] 
+                + [info[field] for field in PHYSIO_INDEX_FIELDS])
+        if rows:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO physio VALUES ({0})'.format(','.join('?'*len(rows[0]))), rows)
+                self.db.commit()
+            except sqlite3.Error: # E.g., an existing index in a read-only folder
+                pass
+
+
+def _physio_info_from_index(fname, date, fields):
+    info = PhysioInfo(fname, date, fields)
+    info['file'] = path.realpath(fname)
+    info['start'] = mmn2dt(info['LogStartMDHTime'], date, timestamp=True)
+    info['stop'] = mmn2dt(info['LogStopMDHTime'], date, timestamp=True)
     return info
 
 
+def parse_physio_files(fname, date=None, channels=None, n_jobs=None, use_index=True):
+    '''
+    Parameters
+    ----------
+    fname : str or list
+        Any file of a physio recording, e.g., "Physio_20170222_101010.resp", 
+        whose other channels share the same stem.
+        If a list of recordings is provided, all files (i.e., recordings x channels) 
+        are parsed in parallel across a process pool, and a list of infos is returned.
+    n_jobs : int
+        Number of processes (only used for a list of recordings).
+    use_index : bool
+        Restore the timing of previously parsed files from their PhysioIndex, 
+        and only parse their samples when accessed (see PhysioInfo), 
+        e.g., after they are matched with some series.
+    '''
+    if channels is None:
+        channels = ['ecg', 'ext', 'puls', 'resp']
+    if isinstance(fname, six.string_types):
+        return parse_physio_files([fname], date=date, channels=channels, n_jobs=1, use_index=use_index)[0]
+    stems = [path.splitext(f)[0] for f in fname]
+    files = ['.'.join((stem, ch)) for stem in stems for ch in channels]
+    parsed = {}
+    indices = {}
+    if use_index:
+        for folder in set(path.dirname(f) for f in files):
+            index = PhysioIndex.open(folder or '.')
+            if index is not None:
+                indices[folder] = index
+                existing = [f for f in files if path.dirname(f) == folder and path.exists(f)]
+                for f, fields in index.lookup(existing).items():
+                    parsed[f] = _physio_info_from_index(f, date, fields)
+    jobs = [(f, date) for f in files if f not in parsed]
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count() * 3 // 4
+    if n_jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(n_jobs, len(jobs))) as pool:
+            parsed.update(zip([job[0] for job in jobs], pool.starmap(parse_physio_file, jobs, chunksize=1)))
+    else:
+        parsed.update((job[0], parse_physio_file(*job)) for job in jobs)
+    for folder, index in indices.items():
+        with index:
+            index.update([parsed[job[0]] for job in jobs if path.dirname(job[0]) == folder and parsed[job[0]] is not None])
+    infos = []
+    for stem in stems:
+        info = collections.OrderedDict()
+        for ch in channels:
+            info[ch] = parsed['.'.join((stem, ch))]
+            if info[ch] is None:
+                print('*+ WARNING: "{0}" info is missing. Skip "{1}"...'.format(ch, stem), file=sys.stderr)
+                info = None
+                break
+        infos.append(info)
+    return infos
+
+
 def match_physio_with_series(physio_infos, series_infos, channel=None, method='cover'):
+    '''
+    Parameters
+    ----------
+    method : str
+        'cover': The physio log must cover the whole series.
+            If there is more than one (which should not be the case), use only the first one.
+        'overlap': The physio log must overlap with the series.
+            If there is more than one, use the one with largest overlap.
+
+    Implementation notes
+    --------------------
+    The time spans of physio logs are sorted once, so that each series is matched
+    with np.searchsorted in O(log n) rather than compared against all physio logs.
+    This requires the physio logs to be non-overlapping in time (as they are 
+    recorded sequentially), otherwise all logs are checked for each series.
+    '''
     if channel is None:
         channel = 'resp'
-    physio_t = np.array([[p[channel]['start'], p[channel]['stop']] if p is not None else [0, 0] for p in physio_infos])
-    physio = []
-    series = []
-    for k, s in enumerate(series_infos):
+    valid = np.nonzero([p is not None for p in physio_infos])[0]
+    physio_t = np.array([[physio_infos[k][channel]['start'], physio_infos[k][channel]['stop']] for k in valid]).reshape(-1,2)
+    series_t = np.array([[s['start'], s['stop']] for s in series_infos]).reshape(-1,2)
+    # Sorted interval index over physio time spans
+    order = np.argsort(physio_t[:,0], kind='stable')
+    starts, stops = physio_t[order,0], physio_t[order,1]
+    indices = valid[order] # Original indices into physio_infos
+    matched = np.full(len(series_t), -1)
+    if len(order) == 0:
+        pass
+    elif np.all(stops[:-1] <= starts[1:]): # Non-overlapping, so that stops are also sorted
         if method == 'cover':
-            p_idx = (physio_t[:,0] < s['start']) & (s['stop'] < physio_t[:,1])
-            if np.any(p_idx):
-                # If there is more than one (which should not be the case), use only the first one
-                physio.append(physio_infos[np.nonzero(p_idx)[0][0]])
-                series.append(s)
+            # Only the last log starting before the series can possibly cover it
+            k = np.maximum(np.searchsorted(starts, series_t[:,0], side='left') - 1, 0)
+            covered = (starts[k] < series_t[:,0]) & (series_t[:,1] < stops[k])
+            matched[covered] = indices[k[covered]]
         elif method == 'overlap':
-            p_idx = (physio_t[:,0] < s['stop']) & (s['start'] < physio_t[:,1]) # Thanks to Prof. Zhang Jun
-            if np.any(p_idx):
-                # If there is more than one (which should not be the case), use the one with largest overlap
-                overlap = np.maximum(physio_t[p_idx,0], s['start']) - np.minimum(physio_t[p_idx,1], s['stop'])
-                idx = np.nonzero(p_idx)[0][np.argmax(overlap)]
-                physio.append(physio_infos[idx])
-                series.append(s)
+            first = np.searchsorted(stops, series_t[:,0], side='right') # Logs stopping after the series starts: [first:]
+            last = np.searchsorted(starts, series_t[:,1], side='left') # Logs starting before the series stops: [:last]
+            for j in np.nonzero(first < last)[0]:
+                c = np.arange(first[j], last[j])
+                c = c[np.argsort(indices[c])] # Break ties by the original order
+                overlap = np.minimum(stops[c], series_t[j,1]) - np.maximum(starts[c], series_t[j,0])
+                matched[j] = indices[c[np.argmax(overlap)]]
+    else:
+        for j, (s_start, s_stop) in enumerate(series_t):
+            if method == 'cover':
+                c = np.nonzero((starts < s_start) & (s_stop < stops))[0]
+                if len(c) > 0:
+                    matched[j] = np.min(indices[c])
+            elif method == 'overlap':
+                c = np.nonzero((starts < s_stop) & (s_start < stops))[0] # Thanks to Prof. Zhang Jun
+                if len(c) > 0:
+                    c = c[np.argsort(indices[c])]
+                    overlap = np.minimum(stops[c], s_stop) - np.maximum(starts[c], s_start)
+                    matched[j] = indices[c[np.argmax(overlap)]]
+    physio = [physio_infos[k] for k in matched if k >= 0]
+    series = [s for s, k in zip(series_infos, matched) if k >= 0]
     return physio, series
 
 
@@ -503,8 +713,15 @@ def filter_dicom_files(files, series_numbers=None, instance_numbers=None, series
 
 
 def parse_slice_order(dicom_files):
+    '''
+    Slice timing (in sec) is taken from the MosaicRefAcqTimes of the first file 
+    if available, otherwise Dimon is run on the first two files in a temp dir.
+    '''
     t = None
-    if len(dicom_files) > 1:
+    header = dicom.parse_dicom_header(dicom_files[0]) if len(dicom_files) > 0 else {}
+    if 'MosaicRefAcqTimes' in header and np.size(header['MosaicRefAcqTimes']) > 1:
+        t = np.atleast_1d(header['MosaicRefAcqTimes']) / 1000
+    elif len(dicom_files) > 1:
         temp_dir = 'temp_pares_slice_order'
         os.makedirs(temp_dir)
         for k, f in enumerate(dicom_files[:2]):
@@ -530,9 +747,13 @@ def parse_slice_order(dicom_files):
     return order, t
 
 
-def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SERIES_PATTERN, fields=None, parser=None):
+def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SERIES_PATTERN, fields=None, parser=None, use_index=True):
     '''
     Potential bug: `dicom.parse_dicom_header` doesn't support `fields` as kwargs 
+
+    use_index : bool
+        Reuse headers parsed by previous calls (see dicom.HeaderIndex).
+        Headers requested with additional `fields` are always parsed anew.
     '''
     if isinstance(fname, six.string_types): # A single file or a folder
         if path.isdir(fname):
@@ -548,16 +769,21 @@ def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SE
         findex = 0
     if parser is None:
         parser = parse_dicom_header
+    def parse(files):
+        if fields is None:
+            return dicom.parse_dicom_headers(files, parser=parser, use_index=use_index)
+        else:
+            return [parser(f, fields=fields) for f in files]
     info = collections.OrderedDict()
     if timestamp:
         parse_list = range(len(files))
     else:
         parse_list = [0, -1]
-    headers = [parser(files[k], fields=fields) for k in parse_list]
+    headers = parse([files[k] for k in parse_list])
     if headers[0]['StudyID'] != headers[-1]['StudyID']:
         # There are more than one series (from different studies) sharing the same series number
         if parse_list == [0, -1]:
-            headers = [headers[0]] + [parser(f) for f in files[1:-1]] + [headers[-1]]
+            headers = [headers[0]] + parse(files[1:-1]) + [headers[-1]]
         if findex is None:
             findex = files.index(fname)
         selected = [k for k, header in enumerate(headers) if header['StudyID']==headers[findex]['StudyID']]
@@ -588,7 +814,20 @@ def parse_series_info(fname, timestamp=False, shift_time=None, series_pattern=SE
     return info
 
 
-def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
+def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False, method=None, n_jobs=None):
+    '''
+    Parameters
+    ----------
+    method : str
+        'native' assembles the volume in python from the dicom headers and pixel data
+        (see dicom.read_dicom_volume), without spawning any process or writing temp files.
+        'Dimon' uses AFNI's uniq_images and Dimon.
+        Default is 'native' for *.nii and *.nii.gz, and 'Dimon' otherwise (e.g., dset+orig),
+        or if the series cannot be converted natively (e.g., multiband slice timing, 
+        implicit VR, or compressed pixel data).
+    n_jobs : int
+        Number of processes for reading pixel data (only for 'native').
+    '''
     if dicom_ext is None:
         dicom_ext = '.IMA'
     if out_file is None:
@@ -599,6 +838,19 @@ def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
         os.makedirs(out_dir)
     if prefix == '*': # Take the dicom folder name by default
         prefix = path.split(dicom_dir)[1]
+    auto = method is None
+    if method is None:
+        method = 'native' if ext in ['.nii', '.nii.gz'] else 'Dimon'
+    if method == 'native':
+        dicom_files = sorted(glob.glob(path.join(dicom_dir, '*'+dicom_ext)))
+        try:
+            write_dicom_nii(path.join(out_dir, prefix+ext), dicom_files, n_jobs=n_jobs, require_slice_timing=auto)
+            return
+        except (ValueError, KeyError, IndexError, NotImplementedError, AssertionError) as err:
+            # e.g., multiband slice timing, missing tags (implicit VR), compressed pixel data, or no "DICM" preamble
+            if not auto:
+                raise
+            print('*+ WARNING: {0!r}. Fallback to Dimon for "{1}"'.format(err, dicom_dir))
     old_path = os.getcwd()
     try:
         os.chdir(dicom_dir)
@@ -612,7 +864,58 @@ def convert_dicom(dicom_dir, out_file=None, dicom_ext=None, interactive=False):
         os.chdir(old_path)
 
 
-def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom_ext='.IMA', **kwargs):
+def write_dicom_nii(fname, dicom_files, headers=None, n_jobs=None, require_slice_timing=False):
+    '''
+    Write the dicom files of a single series as a NIFTI dataset (see dicom.read_dicom_volume).
+
+    Duplicated images (i.e., with the same InstanceNumber) are only used once, like uniq_images.
+    Unsigned 16-bit pixels are stored as int16 (or float32 if out of range), which AFNI can handle.
+    Slice timing (from MosaicRefAcqTimes) is stored as slice_code and slice_duration,
+    which AFNI (e.g., 3dTshift) reads like the TAXIS_OFFSETS written by Dimon.
+
+    Parameters
+    ----------
+    require_slice_timing : bool
+        Raise ValueError if the slice timing cannot be expressed by slice_code 
+        (e.g., multiband), rather than writing the dataset without it.
+    '''
+    if headers is None:
+        headers = dicom.parse_dicom_headers(dicom_files, n_jobs=n_jobs)
+    uniq = collections.OrderedDict()
+    for f, header in zip(dicom_files, headers):
+        uniq.setdefault(header['InstanceNumber'], (f, header))
+    dicom_files, headers = zip(*uniq.values())
+    vol, affine, info = dicom.read_dicom_volume(list(dicom_files), headers=list(headers), n_jobs=n_jobs)
+    if vol.shape[-1] == 1:
+        vol = vol[...,0]
+    if vol.dtype == np.uint16: # Not a native AFNI datum
+        vol = vol.astype(np.int16 if vol.max() <= np.iinfo(np.int16).max else np.float32)
+    img = nibabel.Nifti1Image(vol, affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    if vol.ndim > 3:
+        img.header.set_zooms(img.header.get_zooms()[:3] + (info['TR'],))
+        if 'slice_timing' in info and len(info['slice_timing']) == vol.shape[2]:
+            img.header.set_dim_info(slice=2)
+            try:
+                img.header.set_slice_times(info['slice_timing'])
+            except nibabel.spatialimages.HeaderDataError: # E.g., multiband
+                img.header.set_dim_info(slice=None)
+                img.header['slice_code'] = 0
+                if require_slice_timing:
+                    raise ValueError('Slice timing cannot be stored as NIFTI slice_code: {0}'.format(info['slice_timing']))
+                print('*+ WARNING: Slice timing cannot be stored as NIFTI slice_code, and is left out of "{0}"'.format(fname))
+    if 'scl_slope' in info:
+        img.header.set_slope_inter(info['scl_slope'], info['scl_inter'])
+    img.header['sform_code'] = 1 # Scanner
+    img.header['qform_code'] = 1
+    nibabel.save(img, fname)
+
+
+def _convert_dicom_job(args, kwargs):
+    return convert_dicom(*args, **kwargs)
+
+
+def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom_ext='.IMA', n_jobs=None, **kwargs):
     '''
     Parameters
     ----------
@@ -625,6 +928,9 @@ def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom
         Output directory for converted datasets, default is current directory.
         The output would look like:
             out_dir/anat.nii, out_dir/func01.nii, out_dir/func02.nii, etc.
+    n_jobs : int
+        Number of series converted in parallel (within a single process pool).
+        Default is 1 for method='Dimon' (which is already a separate process).
     '''
     original_dicom_dirs = dicom_dirs
     if isinstance(dicom_dirs, six.string_types):
@@ -636,11 +942,23 @@ def convert_dicoms(dicom_dirs, out_dir=None, prefix=None, out_type='.nii', dicom
         warnings.warn(f"\n>> Cannot find any dicom file to convert. Is the following path correct?\n{original_dicom_dirs}")
     if out_dir is None:
         out_dir = '.'
-    idx = 0
+    jobs = []
     for f in dicom_dirs:
         if path.isdir(f) and len(glob.glob(path.join(f, '*'+dicom_ext))) > 0:
-            idx += 1
-            convert_dicom(f, path.join(out_dir, '*'+out_type if prefix is None else '{0}{1:02d}{2}'.format(prefix, idx, out_type)), dicom_ext=dicom_ext, **kwargs)
+            jobs.append((f, path.join(out_dir, '*'+out_type if prefix is None else '{0}{1:02d}{2}'.format(prefix, len(jobs)+1, out_type))))
+    if n_jobs is None:
+        method = kwargs.get('method')
+        if method is None: # Same default as convert_dicom
+            method = 'native' if out_type in ['.nii', '.nii.gz'] else 'Dimon'
+        n_jobs = 1 if method == 'Dimon' else multiprocessing.cpu_count() * 3 // 4
+    n_jobs = min(n_jobs, len(jobs))
+    if n_jobs > 1:
+        kwargs['n_jobs'] = 1 # Parallel across series rather than within series
+        with multiprocessing.Pool(n_jobs) as pool:
+            pool.starmap(_convert_dicom_job, [((f, out_file), dict(kwargs, dicom_ext=dicom_ext)) for f, out_file in jobs], chunksize=1)
+    else:
+        for f, out_file in jobs:
+            convert_dicom(f, out_file, dicom_ext=dicom_ext, **kwargs)
 
 
 # ========== Generic read/write ==========
@@ -658,6 +976,57 @@ def write_vol(fname, vol, base_img=None):
         write_afni(fname, vol, base_img)
 
 
+def memmap_vol(fname, shape, dtype=np.float32, base_img=None, space=None):
+    '''
+    Create a dataset of zeros on disk, and return its data as a writable memmap,
+    so that a (large 4D) result can be filled in volume by volume without holding 
+    it in memory, e.g., via `Mask.undump(None, x, out=vol[...,k])`.
+
+    Parameters
+    ----------
+    fname : str
+        An uncompressed NIFTI file (*.nii), or else an AFNI dataset (HEAD/BRIK).
+    shape : tuple
+        (x, y, z) or (x, y, z, t)
+    dtype : dtype
+        For AFNI datasets, one of uint8, int16, float32 or complex64.
+    base_img : nibabel image, file name or 4x4 array
+        Provides the affine (default is identity).
+    space : int
+        NIFTI sform_code (default is 1, scanner).
+
+    Returns
+    -------
+    vol : memmap
+        Flush (or delete) it to make sure the data are written to disk.
+    '''
+    affine = _base_affine(base_img)
+    dtype = np.dtype(dtype)
+    if fname.endswith('.nii'):
+        img = nibabel.Nifti1Image(np.zeros([1]*len(shape), dtype=dtype), affine)
+        header = img.header
+        header.set_data_shape(shape)
+        header['sform_code'] = 1 if space is None else space
+        header.set_data_offset(352) # 348 bytes of header + 4 bytes of extension flag
+        with open(fname, 'wb') as fo:
+            header.write_to(fo)
+            fo.truncate(header.get_data_offset() + int(np.prod(shape))*dtype.itemsize) # Zeros without writing them
+        offset = header.get_data_offset()
+    elif fname.endswith('.nii.gz'):
+        raise ValueError('Compressed NIFTI cannot be memory-mapped: "{0}"'.format(fname))
+    else:
+        prefix, view = _split_afni_prefix(fname)
+        datum = {np.dtype(v[1]): k for k, v in AFNI_DATUM.items()}.get(dtype)
+        if datum is None:
+            raise ValueError('AFNI datasets cannot store {0} data'.format(dtype))
+        _write_afni_HEAD(f"{prefix}{view}.HEAD", tuple(shape[:3]) + (int(np.prod(shape[3:])),), affine, view, AFNI_DATUM[datum][0])
+        fname = f"{prefix}{view}.BRIK"
+        with open(fname, 'wb') as fo:
+            fo.truncate(int(np.prod(shape))*dtype.itemsize)
+        offset = 0
+    return np.memmap(fname, dtype=dtype, mode='r+', offset=offset, shape=tuple(shape), order='F')
+
+
 def read_surf_mesh(fname, return_img=False, **kwargs):
     if fname.endswith('.asc'):
         verts, faces = read_asc(fname, **kwargs)
@@ -730,7 +1099,7 @@ def read_nii(fname, return_img=False):
     if fname[-4:] != '.nii' and fname[-7:] != '.nii.gz':
         fname = fname + '.nii'
     img = nibabel.load(fname)
-    vol = img.get_data()
+    vol = np.asanyarray(img.dataobj) # Same as the deprecated get_data(): a memmap if unscaled and uncompressed
     return (vol, img) if return_img else vol
 
 
@@ -847,6 +1216,9 @@ def change_dim_order(in_file, out_file=None, dim_order=None, method='afni'):
 
 # ========== AFNI HEAD/BRIK ==========
 def read_afni(fname, remove_nii=True, return_img=False):
+    '''
+    Read an AFNI dataset via nibabel, which memory-maps unscaled uncompressed BRIK files.
+    '''
     try:
         if fname[-5:] in ['.HEAD', '.BRIK']:
             pass
@@ -855,10 +1227,11 @@ def read_afni(fname, remove_nii=True, return_img=False):
         else:
             fname = fname + '.HEAD'
         img = nibabel.load(fname) # Start from nibabel 2.3.0 (with brikhead.py)
-        # vol = img.get_data().squeeze()
-        vol = img.get_data()
+        vol = np.asanyarray(img.dataobj) # Scaled data, or a memmap if unscaled (same as the deprecated get_data())
         return (vol, img) if return_img else vol
-    except nibabel.filebasedimages.ImageFileError:
+    except (nibabel.filebasedimages.ImageFileError, OSError):
+        if not path.exists(fname):
+            raise
         print('*+ WARNING: Fail to open "{0}" with nibabel, fallback to 3dAFNItoNIFTI'.format(fname)) 
         match = re.match('(.+)\+', fname)
         nii_fname = match.group(1) + '.nii'
@@ -869,11 +1242,110 @@ def read_afni(fname, remove_nii=True, return_img=False):
         return res
 
 
-def write_afni(prefix, vol, base_img=None):
-    nii_fname = prefix + '.nii'
-    write_nii(nii_fname, vol, base_img)
-    subprocess.check_call(['3dcopy', nii_fname, prefix+'+orig', '-overwrite'])
-    os.remove(nii_fname)
+def _split_afni_prefix(prefix):
+    '''"dset+tlrc.HEAD" -> ("dset", "+tlrc"). The view defaults to +orig.'''
+    match = re.match(r'(.+?)(\+(?:orig|acpc|tlrc))?(?:\.|\.HEAD|\.BRIK)?$', prefix)
+    return match.group(1), (match.group(2) if match.group(2) else '+orig')
+
+
+def _base_affine(base_img):
+    '''The (RAS+) affine of a nibabel image or file name, or an affine itself (default is identity).'''
+    if base_img is None:
+        return np.eye(4)
+    elif isinstance(base_img, six.string_types):
+        return nibabel.load(base_img).affine
+    elif isinstance(base_img, np.ndarray):
+        return base_img
+    else:
+        return base_img.affine
+
+
+AFNI_DATUM = {'byte': (0, np.uint8), 'short': (1, np.int16), 'float': (3, np.float32), 'complex': (5, np.complex64)} # BRICK_TYPES
+
+def _write_afni_HEAD(fname, shape, affine, view, code, facs=None, stats=None, labels=None, TR=None):
+    '''shape : (x, y, z, n_bricks), code : BRICK_TYPES of all sub-bricks'''
+    attributes = collections.OrderedDict()
+    attributes['TYPESTRING'] = '3DIM_HEAD_ANAT'
+    attributes['IDCODE_STRING'] = 'MRIPY_' + ''.join(random.choice(string.ascii_letters + string.digits) for k in range(16))
+    attributes['IDCODE_DATE'] = datetime.now().strftime('%a %b %d %H:%M:%S %Y')
+    is_time = TR is not None and shape[3] > 1
+    attributes['SCENE_DATA'] = np.int_([{'+orig': 0, '+acpc': 1, '+tlrc': 2}[view], 2 if is_time else 11, 0, -999, -999, -999, -999, -999]) # ANAT_EPI_TYPE or ANAT_BUCK_TYPE
+    attributes['DATASET_RANK'] = np.int_([3, shape[3], 0, 0, 0, 0, 0, 0])
+    attributes['DATASET_DIMENSIONS'] = np.int_(list(shape[:3]) + [0, 0])
+    geometry, oblique = afni.affine_to_attributes(affine)
+    attributes.update(geometry)
+    attributes['BYTEORDER_STRING'] = 'LSB_FIRST' if sys.byteorder == 'little' else 'MSB_FIRST'
+    attributes['BRICK_TYPES'] = np.int_([code] * shape[3])
+    attributes['BRICK_FLOAT_FACS'] = facs if facs is not None else np.zeros(shape[3])
+    if stats is not None:
+        attributes['BRICK_STATS'] = stats
+    if labels is None:
+        labels = [f"#{k}" for k in range(shape[3])]
+    attributes['BRICK_LABS'] = '~'.join(labels)
+    if is_time:
+        attributes['TAXIS_NUMS'] = np.int_([shape[3], 0, 77002, -999, -999, -999, -999, -999]) # UNITS_SEC_TYPE
+        attributes['TAXIS_FLOATS'] = np.float_([0, TR, 0, 0, 0, -999999, -999999, -999999])
+    afni.write_HEAD(fname, attributes)
+
+
+def write_afni(prefix, vol, base_img=None, labels=None, TR=None, datum=None):
+    '''
+    Write an AFNI dataset (HEAD/BRIK) directly, without going through NIFTI and 3dcopy.
+
+    Parameters
+    ----------
+    prefix : str
+        E.g., "dset", "dset+tlrc" or "dset+orig.HEAD". The view defaults to +orig.
+    vol : array, x * y * z [* t]
+    base_img : nibabel image or file name
+        Provides the affine (default is identity). Oblique affines are kept in 
+        IJK_TO_DICOM_REAL, with the closest cardinal orientation.
+    labels : list of str
+        Sub-brick labels.
+    TR : float
+        Repetition time in sec. If given, the dataset is written as a time series.
+    datum : str, {'byte', 'short', 'float', 'complex'}
+        Default is byte/short/complex if the data type fits, otherwise float.
+        Other data stored as byte/short are scaled per sub-brick (BRICK_FLOAT_FACS),
+        unless they are integers within range.
+        Note that nibabel (up to at least 4.0) misreads 'complex' as complex128.
+    '''
+    prefix, view = _split_afni_prefix(prefix)
+    affine = _base_affine(base_img)
+    vol = np.asanyarray(vol)
+    shape = vol.shape[:3] + (int(np.prod(vol.shape[3:])),)
+    vol = vol.reshape(shape[:3] + (-1,)) if vol.ndim != 4 else vol
+    if datum is None:
+        if vol.dtype in [np.bool_, np.uint8]:
+            datum = 'byte'
+        elif vol.dtype in [np.int8, np.int16]:
+            datum = 'short'
+        elif np.issubdtype(vol.dtype, np.complexfloating):
+            datum = 'complex'
+        else:
+            datum = 'float'
+    code, dtype = AFNI_DATUM[datum]
+    dtype = np.dtype(dtype)
+    # Convert and write sub-bricks one at a time, in Fortran order
+    facs, stats = np.zeros(shape[3]), np.zeros(shape[3]*2)
+    with open(f"{prefix}{view}.BRIK", 'wb') as fo:
+        for k in range(shape[3]):
+            brick = vol[...,k]
+            if dtype.kind in 'iu':
+                info = np.iinfo(dtype)
+                vmin, vmax = np.min(brick), np.max(brick)
+                if (brick.dtype.kind in 'biu' or np.all(np.mod(brick, 1) == 0)) and info.min <= vmin and vmax <= info.max:
+                    brick = brick.astype(dtype)
+                else: # Scale to fit
+                    facs[k] = max(abs(vmin) if info.min < 0 else 0, abs(vmax)) / info.max
+                    brick = np.round(np.clip(brick, info.min*facs[k], info.max*facs[k]) / (facs[k] if facs[k] else 1)).astype(dtype)
+            else:
+                brick = brick.astype(dtype)
+            if dtype.kind != 'c':
+                stats[k*2:k*2+2] = np.r_[np.min(brick), np.max(brick)] * (facs[k] if facs[k] else 1)
+            fo.write(brick.tobytes(order='F'))
+    _write_afni_HEAD(f"{prefix}{view}.HEAD", shape, affine, view, code, facs=facs,
+        stats=(stats if dtype.kind != 'c' else None), labels=labels, TR=TR)
 
 
 
@@ -1194,32 +1666,189 @@ def read_register_dat(fname):
     return mat
 
 
+DUMP_CHUNK_SIZE = 2**25 # Bytes of (scaled) input data read at a time by Mask.dump
+
+def _afni_head(fname):
+    '''"dset+orig", "dset+orig." or "dset+orig.BRIK" -> "dset+orig.HEAD"'''
+    return fname if fname[-5:] in ['.HEAD', '.BRIK'] else (fname + 'HEAD' if fname[-1] == '.' else fname + '.HEAD')
+
+
+def _open_volume(fname):
+    '''
+    Return an array-like whose data are only read from disk when sliced: a memmap 
+    for unscaled uncompressed NIFTI/BRIK files, or else a nibabel ArrayProxy 
+    (which reads the requested slices and applies the scaling on access).
+    '''
+    if re.search(r"[\[\]<>{}]", fname):
+        raise ValueError('** Sub-brick/range selectors are not supported here, '
+            'please extract them into a dataset first (e.g., with 3dbucket): "{0}"'.format(fname))
+    # Keep a single file handle, so that reading a compressed file chunk by chunk
+    # carries on decompressing from the last chunk instead of from the beginning
+    if not (fname.endswith('.nii') or fname.endswith('.nii.gz')):
+        head = _afni_head(fname)
+        try:
+            proxy = nibabel.load(head, keep_file_open=True).dataobj
+        except (nibabel.filebasedimages.ImageFileError, OSError):
+            if not path.exists(head):
+                raise
+            return read_afni(fname) # Fallback to 3dAFNItoNIFTI (e.g., for an unsupported datum or compression)
+    else:
+        proxy = nibabel.load(fname, keep_file_open=True).dataobj
+    if getattr(proxy, 'scaling', None) is None and proxy.slope == 1 and proxy.inter == 0 \
+        and isinstance(proxy.file_like, six.string_types) and not proxy.file_like.endswith(('.gz', '.bz2', '.zst')):
+        return np.asanyarray(proxy) # A memmap (nothing is read yet)
+    return proxy
+
+
+def dump_masks(masks, fname, dtype=None, chunk_size=None):
+    '''
+    Gather the values of several masks (e.g., all ROIs of an atlas) from one or more 
+    (3D or 4D) datasets, reading each dataset only once.
+
+    Each chunk of data (see `Mask.dump`) is read once, the union of all mask voxels 
+    is gathered from it, and then scattered into the outputs of the individual masks.
+
+    Parameters
+    ----------
+    masks : list or dict of Mask
+        All masks are assumed to share the same grid.
+    fname : str or list
+        A file name (or glob pattern), or a list of file names.
+    dtype : dtype
+        Data type of the outputs. Default is that of the (scaled) data.
+    chunk_size : int
+        Approximate number of bytes of input data to read at a time.
+        Default is DUMP_CHUNK_SIZE.
+
+    Returns
+    -------
+    xs : list (or OrderedDict if `masks` is a dict) of arrays, n_voxels * n_timepoints (squeezed)
+    '''
+    if isinstance(masks, dict):
+        return collections.OrderedDict(zip(masks.keys(), dump_masks(list(masks.values()), fname, dtype, chunk_size)))
+    assert(all(mask.compatible(masks[0]) for mask in masks[1:]))
+    files = (glob.glob(fname) or [fname]) if isinstance(fname, six.string_types) else fname # Also AFNI style "dset+orig"
+    if chunk_size is None:
+        chunk_size = DUMP_CHUNK_SIZE
+    if len(masks) == 1:
+        index, positions = masks[0].index, [slice(None)]
+    else: # Union of all mask voxels, and where each mask's voxels are within the union
+        index = np.unique(np.concatenate([mask.index for mask in masks]))
+        positions = [np.searchsorted(index, mask.index) for mask in masks]
+    sources = [_open_volume(f) for f in files]
+    n_ts = [int(np.prod(src.shape[3:])) for src in sources]
+    if dtype is None:
+        dtype = np.result_type(*[np.asanyarray(src[(slice(0,1),)*src.ndim]).dtype for src in sources])
+    xs = [np.zeros([len(mask.index), sum(n_ts)], dtype=dtype) for mask in masks]
+    def scatter(values, t0, t1):
+        for x, pos in zip(xs, positions):
+            x[:,t0:t1] = values[pos]
+    t = 0
+    for src, n_t in zip(sources, n_ts):
+        ijk = np.unravel_index(index, src.shape[:3], order='F')
+        if src.ndim == 3:
+            scatter(np.asanyarray(src)[ijk][:,np.newaxis], t, t+1)
+        elif src.ndim == 4:
+            n_chunk = max(1, chunk_size // (int(np.prod(src.shape[:3])) * np.dtype(dtype).itemsize))
+            for t0 in range(0, n_t, n_chunk):
+                chunk = np.asanyarray(src[...,t0:t0+n_chunk]) # Only these volumes are read (or paged in)
+                scatter(chunk[ijk], t+t0, t+t0+chunk.shape[-1])
+        else: # Higher dimensions are flattened in C order, as before
+            scatter(np.asanyarray(src).reshape(src.shape[:3]+(-1,))[ijk], t, t+n_t)
+        t += n_t
+    return [x.squeeze() for x in xs]
+
+
 class MaskDumper(object):
+    '''
+    Dump and undump the voxels of a mask dataset, like 3dmaskdump and 3dUndump,
+    but in process with binary arrays (no text files in between).
+    '''
     def __init__(self, mask_file):
         self.mask_file = mask_file
-        self.temp_file = 'tmp.dump.txt'
-        subprocess.check_call(['3dmaskdump', '-mask', self.mask_file, '-index', '-xyz',
-            '-o', self.temp_file, self.mask_file])
-        x = np.loadtxt(self.temp_file)
-        self.index = x[:,0].astype(int)
-        self.ijk = x[:,1:4].astype(int)
-        self.xyz = x[:,4:7]
-        self.mask = x[:,7].astype(int)
-        os.remove(self.temp_file)
-
-    def dump(self, fname):
-        files = glob.glob(fname) if isinstance(fname, six.string_types) else fname
-        subprocess.check_call(['3dmaskdump', '-mask', self.mask_file, '-noijk',
-            '-o', self.temp_file, ' '.join(files)])
-        x = np.loadtxt(self.temp_file)
-        os.remove(self.temp_file)
-        return x
+        mask = Mask(None)
+        mask.master = mask_file
+        mask._infer_geometry(mask_file)
+        value = np.asanyarray(_open_volume(mask_file)).reshape(-1, order='F')[:np.prod(mask.IJK)]
+        mask.index = np.flatnonzero(value) # Nonzero voxels as in 3dmaskdump (whereas Mask takes positive voxels)
+        mask.value = np.array(value[mask.index])
+        try: # The master's own (possibly oblique) affine, which "3dUndump -master" would copy
+            self.affine = nibabel.load(mask_file if mask_file.endswith(('.nii', '.nii.gz')) else _afni_head(mask_file)).affine
+        except (nibabel.filebasedimages.ImageFileError, OSError):
+            self.affine = mask.affine_nifti # The cardinal grid (as from 3dAttribute)
+        self._mask = mask
+        self.index = mask.index
+        self.ijk = mask.ijk
+        self.xyz = mask.xyz # DICOM's RAI, as "3dmaskdump -xyz"
+        self.mask = mask.value.astype(int)
+
+    def dump(self, fname, dtype=float):
+        '''
+        Returns
+        -------
+        x : array, n_voxels * n_timepoints (squeezed)
+            Default dtype is float (as parsed from 3dmaskdump text before). Use None for the data type of the data.
+        '''
+        return self._mask.dump(fname, dtype=dtype)
 
     def undump(self, prefix, x):
-        np.savetxt(self.temp_file, np.c_[self.ijk, x])
-        subprocess.check_call(['3dUndump', '-master', self.mask_file, '-ijk',
-            '-prefix', prefix, '-overwrite', self.temp_file])
-        os.remove(self.temp_file)
+        if not (prefix.endswith('.nii') or prefix.endswith('.nii.gz')) and re.search(r'\+(orig|acpc|tlrc)', prefix) is None:
+            match = re.search(r'\+(orig|acpc|tlrc)', self.mask_file) # 3dUndump writes in the view of the master
+            if match is not None:
+                prefix += match.group(0)
+        self._mask.undump(prefix, x, base_img=self.affine)
+
+
+def _sorted(index, value=None):
+    '''Sort voxel indices (and their values), which are almost always already sorted.'''
+    if len(index) < 2 or np.all(index[1:] > index[:-1]):
+        return index if value is None else (index, value)
+    order = np.argsort(index, kind='stable')
+    return index[order] if value is None else (index[order], value[order])
+
+
+def _merge_sorted(a, b):
+    '''
+    Merge two sorted arrays of unique voxel indices in linear time (timsort merges presorted runs).
+
+    Returns
+    -------
+    merged : array
+        Sorted np.r_[a, b], with shared voxels appearing twice.
+    order : array
+        Indices into np.r_[a, b] that give the merged array.
+    shared : array, bool
+        Whether each element of the merged array (but the last) equals the next one.
+        Ties are stable, so for such a pair order[k] is from `a` and order[k+1] is from `b`.
+    '''
+    merged = np.concatenate([a, b])
+    order = np.argsort(merged, kind='stable')
+    merged = merged[order]
+    return merged, order, merged[1:] == merged[:-1]
+
+
+def _isin_sorted(a, b):
+    '''
+    Whether each element of `a` is in sorted `b` (both unique), via a linear merge,
+    or a binary search of the shorter one in the longer one.
+    `a` may be in any order (e.g., after Mask.pick with a permutation).
+    '''
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(len(a), dtype=bool)
+    if len(a) * np.log2(len(b)) < len(a) + len(b):
+        return b[np.minimum(np.searchsorted(b, a), len(b)-1)] == a
+    isin = np.zeros(len(a), dtype=bool)
+    if len(b) * np.log2(len(a)) < len(a) + len(b):
+        order = None if np.all(a[1:] > a[:-1]) else np.argsort(a, kind='stable')
+        sorted_a = a if order is None else a[order]
+        pos = np.minimum(np.searchsorted(sorted_a, b), len(a)-1)
+        found = pos[sorted_a[pos] == b]
+        isin[found if order is None else order[found]] = True
+    else: # The merge sorts np.r_[a, b] as a whole, so `a` needs not be sorted
+        merged, order, shared = _merge_sorted(a, b)
+        isin[order[:-1][shared]] = True
+    return isin
+
 
 
 class Mask(object):
@@ -1228,20 +1857,20 @@ class Mask(object):
         self.value = None
         if self.master is not None:
             self._infer_geometry(self.master)
-            if master.endswith('.nii') or master.endswith('.nii.gz'):
-                self.value = read_nii(self.master).ravel('F') # [x,y,z], x changes the fastest. Also, NIFTI read/write data in 'F'.
-            else:
-                self.value = read_afni(self.master).ravel('F')
+            n_voxels = np.prod(self.IJK)
+            # [x,y,z], x changes the fastest. Also, NIFTI/BRIK store data in 'F', so this is a view of the memmap if possible.
+            self.value = np.asanyarray(_open_volume(self.master)).reshape(-1, order='F')[:n_voxels] # The 1st sub-brick
             if kind == 'mask':
-                idx = self.value > 0 # afni uses Fortran index here
-                self.value = self.value[idx]
-                self.index = np.arange(np.prod(self.IJK))[idx]
+                self.index = np.flatnonzero(self.value > 0) # afni uses Fortran index here
+                self.value = np.array(self.value[self.index])
             elif kind == 'full':
-                self.index = np.arange(np.prod(self.IJK))
+                self.index = np.arange(n_voxels)
+                self.value = np.array(self.value) # Not a view of the memmap, which would follow (and lock) the master file
 
     def _infer_geometry(self, fname):
-        self.IJK = afni.get_DIMENSION(fname)[:3]
-        self.MAT = afni.get_affine(fname)
+        attributes = afni.read_header(fname) # Parsed once (and cached), without spawning 3dAttribute
+        self.IJK = afni.get_DIMENSION(fname, attributes=attributes)[:3]
+        self.MAT = afni.get_affine(fname, attributes=attributes)
 
     def to_dict(self):
         return dict(master=self.master, value=self.value, index=self.index, IJK=self.IJK, MAT=self.MAT)
@@ -1260,8 +1889,7 @@ class Mask(object):
         mask.master = master
         mask._infer_geometry(master)
         data = {v: read_vol(f).squeeze() for v, f in kwargs.items()}
-        idx = eval(expr, data).ravel('F') > 0
-        mask.index = np.arange(np.prod(mask.IJK))[idx]
+        mask.index = np.flatnonzero(eval(expr, data).ravel('F') > 0)
         return mask
 
     @classmethod
@@ -1284,24 +1912,32 @@ class Mask(object):
         return 'Mask ({0} voxels)'.format(len(self.index))
 
     def __add__(self, other):
-        '''Mask union. Both masks are assumed to share the same grid.'''
+        '''Mask union (values of shared voxels are summed). Both masks are assumed to share the same grid.'''
         assert(self.compatible(other))
         mask = copy.deepcopy(self)
-        mask.index = np.union1d(self.index, other.index)
-        value_dict = {idx: val for idx, val in zip(self.index, self.value)}
-        for idx, val in zip(other.index, other.value):
-            if idx in value_dict:
-                value_dict[idx] += val
-            else:
-                value_dict[idx] = val
-        mask.value = np.array([value_dict[idx] for idx in mask.index])
+        # Values are no longer aligned with indices after e.g. pick() or constrain()
+        has_value = all(m.value is not None and len(m.value) == len(m.index) for m in [self, other])
+        if has_value:
+            (index, value), (other_index, other_value) = _sorted(self.index, self.value), _sorted(other.index, other.value)
+            merged, order, shared = _merge_sorted(index, other_index)
+        else:
+            merged, order, shared = _merge_sorted(_sorted(self.index), _sorted(other.index))
+        first = np.concatenate([[True], ~shared]) # First occurrence of each voxel
+        mask.index = merged[first]
+        if has_value:
+            merged_value = np.concatenate([value, other_value])[order]
+            merged_value[:-1][shared] += merged_value[1:][shared]
+            mask.value = merged_value[first]
         return mask
 
     def __mul__(self, other):
         '''Mask intersection. Both masks are assumed to share the same grid.'''
         assert(self.compatible(other))
         mask = copy.deepcopy(self)
-        mask.index = np.intersect1d(self.index, other.index)
+        index, other_index = _sorted(self.index), _sorted(other.index)
+        if len(index) > len(other_index): # Same (sorted) result, but cheaper to search the shorter one
+            index, other_index = other_index, index
+        mask.index = index[_isin_sorted(index, other_index)]
         return mask
 
     def __sub__(self, other):
@@ -1311,12 +1947,12 @@ class Mask(object):
         '''
         assert(self.compatible(other))
         mask = copy.deepcopy(self)
-        mask.index = mask.index[~np.in1d(self.index, other.index, assume_unique=True)]
+        mask.index = mask.index[~_isin_sorted(self.index, _sorted(other.index))]
         return mask
 
     def __contains__(self, other):
         assert(self.compatible(other))
-        return np.all(np.in1d(other.index, self.index, assume_unique=True))
+        return np.all(_isin_sorted(other.index, _sorted(self.index)))
 
     def pick(self, selector, inplace=False):
         mask = self if inplace else copy.deepcopy(self)
@@ -1339,7 +1975,7 @@ class Mask(object):
 
     def infer_selector(self, smaller):
         assert(smaller in self)
-        selector = np.in1d(self.index, smaller.index, assume_unique=True)
+        selector = _isin_sorted(self.index, _sorted(smaller.index))
         return selector
 
     def near(self, x, y, z, r, **kwargs):
@@ -1371,47 +2007,84 @@ class Mask(object):
         func = (lambda X, Y, Z: (x1<X)&(X<x2) & (y1<Y)&(Y<y2) & (z1<Z)&(Z<z2))
         return self.constrain(func, **kwargs)
 
-    def dump(self, fname, dtype=None):
-        files = glob.glob(fname) if isinstance(fname, six.string_types) else fname
-        # return np.vstack(read_afni(f).T.flat[self.index] for f in files).T.squeeze() # Cannot handle 4D...
-        data = []
-        for f in files:
-            if f.endswith('.nii') or f.endswith('.nii.gz'):
-                vol = read_nii(f)
-            else:
-                vol = read_afni(f)
-            if dtype is not None:
-                vol = vol.astype(dtype)
-            S = vol.shape
-            T = list(range(vol.ndim))
-            T[:3] = T[:3][::-1]
-            data.append(vol.transpose(*T).reshape(np.prod(S[:3]),int(np.prod(S[3:])))[self.index,:])
-        return np.hstack(data).squeeze()
-
-    def undump(self, prefix, x, method='nibabel', space=None):
+    def dump(self, fname, dtype=None, chunk_size=None):
+        '''
+        Gather the values of the mask voxels from one or more (3D or 4D) datasets.
+
+        Each dataset is read chunk by chunk over time (memory-mapped for uncompressed 
+        NIFTI/BRIK files) into a preallocated (n_voxels, n_timepoints) output, so that 
+        peak memory is bounded by the output size rather than by the 4D inputs.
+
+        Parameters
+        ----------
+        fname : str or list
+            A file name (or glob pattern), or a list of file names.
+        dtype : dtype
+            Data type of the output. Default is that of the (scaled) data.
+        chunk_size : int
+            Approximate number of bytes of input data to read at a time.
+            Default is DUMP_CHUNK_SIZE.
+
+        Returns
+        -------
+        x : array, n_voxels * n_timepoints (squeezed)
+
+        See `dump_masks` for gathering several masks in a single pass over the data.
+        '''
+        return dump_masks([self], fname, dtype=dtype, chunk_size=chunk_size)[0]
+
+    def undump(self, prefix, x, method='nibabel', space=None, out=None, base_img=None):
+        '''
+        Put the values of the mask voxels back into a volume.
+
+        Parameters
+        ----------
+        prefix : str or None
+            Output file, NIFTI (*.nii, *.nii.gz) or else AFNI. If None, nothing is written,
+            which is useful for filling `out` in place.
+        x : array, n_voxels [* n_timepoints]
+        method : str, {'nibabel', '3dUndump'}
+        space : int
+            NIFTI sform_code (default is 1, scanner).
+        out : array, x * y * z [* t]
+            A preallocated (e.g., reused across calls, or memory-mapped from `memmap_vol`)
+            volume to put the values into, instead of a new array of zeros.
+            Only the mask voxels are overwritten.
+        base_img : nibabel image, file name or 4x4 array
+            Provides the affine of the output, e.g., the master's oblique affine.
+            Default is the (cardinal) grid of the mask.
+
+        Returns
+        -------
+        vol : array (only for method='nibabel')
+        '''
         if method == 'nibabel': # Much faster
-            temp_file = 'tmp.%s.nii' % next(tempfile._get_candidate_names())
-            vol = np.zeros(self.IJK) # Don't support int64?？
-            assert(self.index.size==x.size)
-            vol.T.flat[self.index] = x
-            mat = np.dot(np.diag([-1,-1, 1]), self.MAT) # AFNI uses DICOM's RAI, but NIFTI uses LPI aka RAS+
-            aff = nibabel.affines.from_matvec(mat[:,:3], mat[:,3])
-            img = nibabel.Nifti1Image(vol, aff)
-            # https://afni.nimh.nih.gov/afni/community/board/read.php?1,149338,149340#msg-149340
-            # 0 (unknown) sform not defined
-            # 1 (scanner) RAS+ in scanner coordinates
-            # 2 (aligned) RAS+ aligned to some other scan
-            # 3 (talairach) RAS+ in Talairach atlas space
-            # 4 (mni) RAS+ in MNI atlas space
-            if space is None:
-                space = 1
-            img.header['sform_code'] = space
-            if prefix.endswith('.nii'):
-                nibabel.save(img, prefix)
-            else:
-                nibabel.save(img, temp_file)
-                subprocess.check_call(['3dcopy', temp_file, prefix+'+orig', '-overwrite']) # However, still TLRC inside...
-                os.remove(temp_file)
+            x = np.asanyarray(x)
+            if x.size == self.index.size:
+                x = x.ravel()
+            assert(x.shape[0] == self.index.size)
+            vol = np.zeros(tuple(self.IJK) + x.shape[1:], order='F') if out is None else out # Don't support int64?？
+            flat = vol.reshape((-1,) + x.shape[1:], order='F')
+            if np.may_share_memory(flat, vol): # A view, e.g., for F-contiguous (incl. memmap) volumes
+                flat[self.index] = x
+            else: # In place for any other memory layout
+                vol[np.unravel_index(self.index, self.IJK, order='F')] = x
+            if prefix is not None:
+                img = nibabel.Nifti1Image(vol, self.affine_nifti if base_img is None else _base_affine(base_img))
+                # https://afni.nimh.nih.gov/afni/community/board/read.php?1,149338,149340#msg-149340
+                # 0 (unknown) sform not defined
+                # 1 (scanner) RAS+ in scanner coordinates
+                # 2 (aligned) RAS+ aligned to some other scan
+                # 3 (talairach) RAS+ in Talairach atlas space
+                # 4 (mni) RAS+ in MNI atlas space
+                if space is None:
+                    space = 1
+                img.header['sform_code'] = space
+                if prefix.endswith('.nii') or prefix.endswith('.nii.gz'):
+                    nibabel.save(img, prefix)
+                else:
+                    write_afni(prefix, vol, base_img=img) # Write HEAD/BRIK directly, without a temp NIFTI and 3dcopy
+            return vol
         elif method == '3dUndump': # More robust
             temp_file = 'tmp.%s.txt' % next(tempfile._get_candidate_names())
             ijk = np.c_[np.unravel_index(self.index, self.IJK, order='F')]
@@ -1432,6 +2105,20 @@ class Mask(object):
     def xyz_nifti(self):
         return self.xyz * np.r_[-1,-1,1] # AFNI uses DICOM's RAI, but NIFTI uses LPI aka RAS+
 
+    @property
+    def affine_nifti(self):
+        mat = np.dot(np.diag([-1,-1, 1]), self.MAT) # AFNI uses DICOM's RAI, but NIFTI uses LPI aka RAS+
+        return nibabel.affines.from_matvec(mat[:,:3], mat[:,3])
+
+    def memmap_vol(self, fname, n_t=None, dtype=np.float32, space=None):
+        '''
+        Create a volume (x * y * z [* n_t]) of zeros on disk on the same grid as the mask, 
+        and return it as a writable memmap, to be filled by `undump(None, x, out=vol[...,k])`.
+        See `memmap_vol`.
+        '''
+        shape = tuple(self.IJK) + (() if n_t is None else (n_t,))
+        return memmap_vol(fname, shape, dtype=dtype, base_img=self.affine_nifti, space=space)
+
 
 class BallMask(Mask):
     def __init__(self, master, c, r):
@@ -1461,6 +2148,7 @@ def filter_cluster(in_file, out_file, top=None, neighbor=2):
     d = np.mgrid[-1:2,-1:2,-1:2]
     structure = (np.linalg.norm(d, axis=0) <= (neighbor+1)/2).astype(int)
     im, img = read_vol(in_file, return_img=True)
+    from scipy import ndimage
     label, n = ndimage.label(im, structure)
     vol = [np.sum(label==k) for k in range(1, n+1)]
     if top is not None:
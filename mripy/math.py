@@ -4,9 +4,6 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 from collections import OrderedDict
 import numpy as np
 from numpy.polynomial import polynomial
-from scipy import stats
-import pandas as pd
-from sklearn import linear_model
 from . import six, utils
 
 
@@ -63,10 +60,12 @@ def polyfit3d(x, y, z, f, deg, method=None):
     if method == 'ols':
         c = np.linalg.lstsq(vander, f.ravel(), rcond=None)[0]
     elif method == 'ridge':
+        from sklearn import linear_model
         model = linear_model.Ridge(fit_intercept=False)
         model.fit(vander, f.ravel())
         c = model.coef_
     elif method == 'lasso':
+        from sklearn import linear_model
         model = linear_model.Lasso(fit_intercept=False)
         model.fit(vander, f.ravel())
         c = model.coef_
@@ -156,6 +155,7 @@ def circular_corrcoef(x1, x2, domain=None, n_perm=1000, ci=0.95, n_boot=None):
         Y1 = y1[np.random.choice(np.arange(n), size=[n_perm,n], replace=True)]
         Y2 = y2[np.random.choice(np.arange(n), size=[n_perm,n], replace=True)]
         R = f(Y1, Y2, axis=1)
+        from scipy import stats
         p = 1 - stats.percentileofscore(np.abs(R), rM)/100
     else:
         p = None
@@ -236,6 +236,7 @@ def tsarray2df(tsarray, t=None, ts_name='value', t_name='time', trial_name='tria
     tsarray = tsarray.ravel()
     t = np.tile(t, [n_trials, 1]).ravel()
     trials = np.repeat(np.arange(n_trials), n_times)
+    import pandas as pd
     df = pd.DataFrame(OrderedDict([(trial_name, trials), (t_name, t), (ts_name, tsarray)]))
     if trial_df is not None:
         df = pd.concat([df, trial_df.iloc[trials].reset_index(drop=True)], axis=1)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import os, glob, shutil, shlex, re, subprocess, multiprocessing, warnings, time
+import os, glob, shutil, shlex, re, subprocess, multiprocessing, time
 import json, copy
 from os import path
 from collections import OrderedDict
@@ -10,16 +10,6 @@ from numpy.polynomial import polynomial
 from scipy import stats
 from scipy.ndimage import interpolation
 import scipy.io as scio
-from sklearn import mixture
-try:
-    import pandas as pd
-except ImportError:
-    warnings.warn('Cannot import pandas, which is required for some functions.', ImportWarning)
-import matplotlib.pyplot as plt
-try:
-    import seaborn as sns
-except ImportError:
-    warnings.warn('Cannot import seaborn, which is required for some functions.', ImportWarning)
 import nibabel
 from . import six, afni, io, utils, dicom, dicom_report, math
 
@@ -40,6 +30,7 @@ def parse_seq_info(raw_dir, return_dataframe=True):
     seq_dirs = [f for f in os.listdir(raw_dir) if path.isdir(path.join(raw_dir, f)) and not f.startswith('.')]
     seq_info = OrderedDict([(seq_dir, io.parse_series_info(path.join(raw_dir, seq_dir))) for seq_dir in seq_dirs])
     if return_dataframe:
+        import pandas as pd
         return pd.DataFrame(list(seq_info.values()), index=list(seq_info.keys()))
     else:
         return seq_info
@@ -1141,6 +1132,7 @@ def find_epi_dark_voxel_threshold(v, method='Liu2020'):
     '''
     v = v[v>0]
     if method.lower() == 'kay2019':
+        from sklearn import mixture
         model = mixture.GaussianMixture(n_components=2)
         model.fit(v.reshape(-1,1))
         comps = np.argsort(model.means_.ravel()) # Components as sorted by mean value (ascending)
@@ -1187,6 +1179,7 @@ def create_vessel_mask_EPI(mean_epi, ribbon, out_file, corr_file=None, th=None):
     fitted = polynomial.polyval3d(x,p, z, c)
     divided = epi/fitted
     # Fit Gaussian mixture model to determine the threshold to classify "dark voxels" as vessels
+    from sklearn import mixture
     model = mixture.GaussianMixture(n_components=2)
     model.fit(divided.reshape(-1,1))
     comps = np.argsort(model.means_.ravel()) # Components as sorted by mean value (ascending)
@@ -1201,6 +1194,8 @@ def create_vessel_mask_EPI(mean_epi, ribbon, out_file, corr_file=None, th=None):
     ribbon.undump(outputs['out_file'], divided<th)
     ribbon.undump(outputs['corr_file'], divided)
     # Save inspect figure
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     sns.distplot(divided, color='purple', hist=False)
     predicted = model.predict(divided.reshape(-1,1))
     p1 = np.array([np.sum(predicted==k)/len(predicted) for k in range(model.n_components)]) # Probability of generating a specific class label
@@ -2302,11 +2297,9 @@ def align_center(base_file, in_file, out_file):
     }
 
     centerize = lambda n, d: -(n-1)*d/2
-    data = np.float_(utils.run(f"3dinfo -n4 -d3 -o3 {base_file}", verbose=0)['output'][-1].split())
-    nb, db, ob = data[:3].astype(int), data[4:7], data[7:10]
+    nb, db, ob = afni.get_dims(base_file)[:3], afni.get_DELTA(base_file), afni.get_ORIGIN(base_file)
     cb = centerize(nb, db)
-    data = np.float_(utils.run(f"3dinfo -n4 -d3 -o3 {in_file}", verbose=0)['output'][-1].split())
-    ni, di, oi = data[:3].astype(int), data[4:7], data[7:10]
+    ni, di, oi = afni.get_dims(in_file)[:3], afni.get_DELTA(in_file), afni.get_ORIGIN(in_file)
     ci = centerize(ni, di)
     oo = ci + (ob - cb)
     utils.run(f"3dcopy {in_file} {outputs['out_file']} -overwrite")
@@ -37,6 +37,15 @@ def plot_match(physio_infos, series_infos):
     plt.show()
 
 
+def write_1D(fname, x):
+    '''Same output as np.savetxt(fname, x, fmt='%d') for 1D or 2D int arrays (e.g., ecg), but without formatting row by row.'''
+    x = np.asarray(x)
+    with open(fname, 'w') as fo:
+        if len(x) > 0:
+            rows = x.tolist() if x.ndim == 1 else [' '.join(map(str, row)) for row in x.tolist()]
+            fo.write('\n'.join(map(str, rows)) + '\n')
+
+
 if __name__ == '__main__':
     import script_utils # Append mripy to Python path
     from mripy import io, utils, six
@@ -66,6 +75,8 @@ if __name__ == '__main__':
     parser.add_argument('-g', '--graph', action='store_true', help='plot match between physio and dicom')
     parser.add_argument('-m', '--match', default='cover', help='matching method: (cover)|overlap')
     parser.add_argument('-M', '--CMRR', action='store_true', help='CMRR MB acquisition time correction')
+    parser.add_argument('-b', '--binary', choices=['npy', 'npz'], help='also write binary outputs: one *.npy per channel per run, or one *.npz (with all channels) per run')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes for parsing physio files, default: 3/4 of cpu cores')
     args = parser.parse_args()
     if args.output_dir == 'default':
         args.output_dir = path.join(args.physio, 'physio')
@@ -95,7 +106,7 @@ if __name__ == '__main__':
     print('Parsing physiological info...', end='', flush=True)
     physio_files = sorted(glob.glob(path.join(args.physio, '*.resp')))
     date = series_infos[0]['date'] # Potential bug: Assume there is no cross-day experiment
-    physio_infos = [io.parse_physio_files(f, date=date, channels=args.channels) for f in physio_files]
+    physio_infos = io.parse_physio_files(physio_files, date=date, channels=args.channels, n_jobs=args.jobs)
     print(' ({0} files)'.format(len(physio_infos)))
     if len(physio_infos) == 0:
         print('No physiological file found in "{0}". Use -p to specify physiological input dir.'
@@ -126,7 +137,12 @@ if __name__ == '__main__':
                     fname = '{0}_{1}.1D'.format(ch, dicom_folder_name)
                 else:
                     fname = '{0}{1:02d}.1D'.format(ch, k+1)
-                np.savetxt(path.join(args.output_dir, fname), res[c], fmt=str('%d')) # Use str() because npyio.py is not 2/3 compatible
+                write_1D(path.join(args.output_dir, fname), res[c])
+                if args.binary == 'npy':
+                    np.save(path.join(args.output_dir, path.splitext(fname)[0]+'.npy'), res[c])
+            if args.binary == 'npz':
+                fname = 'physio_{0}.npz'.format(dicom_folder_name) if args.name_by_folder else 'physio{0:02d}.npz'.format(k+1)
+                np.savez(path.join(args.output_dir, fname), **dict(zip(args.channels, res)))
     # Copy raw physio files
     if args.copy is not None:
         print('Copying raw physio files...')
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import sys, argparse, textwrap, shlex, os, shutil, collections
+import sys, argparse, textwrap, shlex, os, shutil, collections, time
 from os import path
+from multiprocessing.pool import ThreadPool
 
 
 def parse_copy(args_copy):
@@ -23,6 +24,50 @@ def parse_copy(args_copy):
     return to_copy
 
 
+def copy_files(jobs, n_jobs=None):
+    '''Copy [(src, dst_dir), ...] with parallel workers (copying is I/O bound, so threads suffice).'''
+    if n_jobs is None or n_jobs <= 1 or len(jobs) <= 1:
+        for src, dst in jobs:
+            shutil.copy(src, dst)
+    else:
+        with ThreadPool(min(n_jobs, len(jobs))) as pool:
+            pool.starmap(shutil.copy, jobs, chunksize=1)
+
+
+def watch_and_copy(args, to_copy, print=print):
+    '''
+    Keep sorting newly arrived files in args.input_dir (see dicom.DicomFolderCursor), 
+    and copy those of the requested series as soon as they settle, until Ctrl-C.
+    '''
+    dest = {}
+    for kind, seqs in to_copy.items():
+        for k, sn in enumerate(seqs):
+            dest[sn] = path.join(args.output_dir, '{0}{1:02d}'.format(kind, k+1) if len(seqs) > 1 else kind)
+    cursor = dicom.DicomFolderCursor(args.input_dir)
+    n_copied = collections.Counter()
+    print('>> Watching "{0}" for new dicom files every {1:g} s... (Ctrl-C to stop)'.format(path.realpath(args.input_dir), args.watch))
+    try:
+        while True:
+            new_files = cursor.update()
+            study_ids = cursor.study_ids()
+            selected = study_ids[args.select] if -len(study_ids) <= args.select < len(study_ids) else None
+            jobs = []
+            for (study_id, sn), files in new_files.items():
+                if args.list:
+                    print('study {0}, series {1}: +{2} files'.format(study_id, sn, len(files)))
+                if study_id == selected and sn in dest:
+                    if not path.exists(dest[sn]):
+                        os.makedirs(dest[sn])
+                    jobs.extend((f, dest[sn]) for f in files)
+                    n_copied[sn] += len(files)
+            copy_files(jobs, args.jobs)
+            if jobs:
+                print('- ' + ', '.join('{0} -> {1} ({2})'.format(sn, path.basename(dest[sn]), n_copied[sn]) for sn in sorted(n_copied)))
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        print('>> Stop watching ({0} files copied)'.format(sum(n_copied.values())))
+
+
 if __name__ == '__main__':
     import script_utils # Append mripy to Python path
     from mripy import io, utils, afni, dicom
@@ -35,7 +80,9 @@ if __name__ == '__main__':
                 $ sort_dicom.py -l -i ~/raw_data
               2) Copy 0002 to ~/sorted_data/anat, 0003-0006 to ~/sorted_data/func01-04,
                  0008 as func05, 0010 as func06, 0012 as func07
-                $ extract_phys.py -i ~/raw_data -o ~/sorted_data -a 2 -f 3-6 8..12(2)\
+                $ extract_phys.py -i ~/raw_data -o ~/sorted_data -a 2 -f 3-6 8..12(2)
+              3) Sort and copy files as they arrive during scanning (checking every 5 s)
+                $ sort_dicom.py -i ~/raw_data -o ~/sorted_data -a 2 -f 3-6 -w\
             '''))
     parser.add_argument('-i', '--input', dest='input_dir', default='.', metavar='path/to/input/dir', help='path/to/input/dir containing raw dicom files, default: pwd')
     parser.add_argument('-o', '--output', dest='output_dir', default=None, help='path/to/output/dir, mkdir if not exists, default: same as input')
@@ -44,9 +91,11 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--func', nargs='+', default=[], help='func datasets to copy (e.g., -f 3-6 9..15(2))')
     parser.add_argument('-c', '--copy', nargs='+', default=[], help='other datasets to copy (e.g., -c reverse 3 13 forward 4 14)')
     parser.add_argument('-g', '--log', nargs='?', help='write log to (specified) file') # Will be None whether you set -g, unless you specify -g a/new/path
-    parser.add_argument('-s', '--select', default=-1, help='select which study to copy, default: last study (-1)')
+    parser.add_argument('-s', '--select', type=int, default=-1, help='select which study to copy, default: last study (-1)')
     parser.add_argument('--pattern', default=io.SERIES_PATTERN, help='regular expression pattern capturing dataset index')
     parser.add_argument('-m', '--method', default='filename', help='method used to sort dicom files: [filename]|header')
+    parser.add_argument('-w', '--watch', nargs='?', type=float, const=5.0, default=None, metavar='SECONDS', help='keep watching input dir, and incrementally sort and copy newly arrived files (every 5 s by default), until Ctrl-C')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of parallel copy workers, default: 4')
     args = parser.parse_args()
     # args, unknowns = parser.parse_known_args()
     if args.output_dir is None:
@@ -62,6 +111,14 @@ if __name__ == '__main__':
         args.log = path.join(args.output_dir, 'sort_dicom.log')
     if args.select > 0:
         args.select -= 1 # From one-based index to zero-based index
+    # Incrementally sort and copy files as they arrive
+    if args.watch is not None:
+        if args.log is not None:
+            print = script_utils.get_log_printer(args.log)[0]
+            print('# {0}'.format(os.getcwd()))
+            print('# {0}'.format(' '.join([path.basename(sys.argv[0])] + sys.argv[1:])))
+        watch_and_copy(args, to_copy, print=print)
+        exit()
     # Sort files into studies of series
     if args.method == 'filename':
         studies = io.sort_dicom_series(args.input_dir)
@@ -80,7 +137,7 @@ if __name__ == '__main__':
         if args.list and len(studies) > 1:
             print('===== study #{0} ====='.format(k+1))
         for sn, files in study.items():
-            if afni.has_afni:
+            if afni.check_afni():
                 info = io.parse_series_info(files, parser=dicom_parser)
                 desc = '{0} ({1}): {2}, {3}{4}'.format(sn,
                     info['n_volumes'] if info['n_volumes']>1 else len(files),
@@ -106,5 +163,4 @@ if __name__ == '__main__':
             if not path.exists(d):
                 os.makedirs(d)
             print('- {0}'.format(descriptions[args.select][sn]))
-            for f in studies[args.select][sn]:
-                shutil.copy(f, d)
+            copy_files([(f, d) for f in studies[args.select][sn]], args.jobs)
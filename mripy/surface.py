@@ -7,7 +7,7 @@ import parser
 from itertools import chain
 from scipy import spatial
 import numpy as np
-from . import six, afni, io, utils, _with_pylab
+from . import six, afni, io, utils
 
 
 def map_sequence(seq1, seq2):
@@ -386,6 +386,7 @@ def _surface_calc(expr=None, out_file=None, **kwargs):
         # TODO: There could be more direct check by looking at the header of the dataset
         assert(np.all(nodes[shared]==shared_nodes)) 
         variables[var] = values[shared]
+    from . import _with_pylab # `from pylab import *` is slow, thus only imported when needed
     v = _with_pylab.pylab_eval(expr, **variables)
     if out_file is not None:
         io.write_surf_data(out_file, shared_nodes, v)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Throughput (files/sec) of dicom header parsing on a synthetic corpus.
+
+Usage:
+    cd mripy/tests; python benchmark_dicom.py --n-series 8 --n-volumes 250 --csa-size 60000
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+import argparse, tempfile, shutil, os
+from os import path
+from timeit import default_timer
+try:
+    from .synthetic_dicom import make_dicom_corpus # If mripy is importable: python -m mripy.tests.benchmark_dicom
+except (ValueError, ImportError): # If not importable: cd mripy/tests; python benchmark_dicom.py
+    import context # Put the package "mripy" on sys.path
+    from synthetic_dicom import make_dicom_corpus
+from mripy import dicom
+
+
+def timeit(func, n_files, repeat=3):
+    '''Best of `repeat` runs, in files/sec.'''
+    best = float('inf')
+    for k in range(repeat):
+        start = default_timer()
+        func()
+        best = min(best, default_timer() - start)
+    return n_files / best
+
+
+def run_benchmarks(folder, n_jobs=None, repeat=3):
+    files = sorted(f for f in os.listdir(folder) if not f.startswith('.'))
+    files = [path.join(folder, f) for f in files]
+    index_file = path.join(folder, dicom.INDEX_FILE)
+    def drop_index():
+        if path.exists(index_file):
+            os.remove(index_file)
+    def sort_cold():
+        drop_index()
+        dicom.sort_dicom_series(folder, n_jobs=n_jobs)
+    results = [
+        ('parse_dicom_header (full)', lambda: [dicom.parse_dicom_header(f) for f in files]),
+        ('parse_dicom_header (search_only)', lambda: [dicom.parse_dicom_header(f,
+            search_for_tags=dicom.SORT_TAGS, search_only=True) for f in files]),
+        ('sort_dicom_series (no index)', lambda: dicom.sort_dicom_series(folder, use_index=False, n_jobs=n_jobs)),
+        ('sort_dicom_series (cold index)', sort_cold),
+        ('sort_dicom_series (warm index)', lambda: dicom.sort_dicom_series(folder, n_jobs=n_jobs)),
+    ]
+    for name, func in results:
+        print('{0:<36s}{1:>12.0f} files/sec'.format(name, timeit(func, len(files), repeat)))
+    studies = dicom.sort_dicom_series(folder, n_jobs=n_jobs)
+    series = [[path.join(folder, f) for f in s] for study in studies for s in study.values()]
+    drop_index()
+    print('{0:<36s}{1:>12.0f} files/sec'.format('parse_series_info (no index)',
+        timeit(lambda: [dicom.parse_series_info(s, use_index=False) for s in series], len(files), repeat)))
+    [dicom.parse_series_info(s) for s in series] # Warm up the index
+    print('{0:<36s}{1:>12.0f} files/sec'.format('parse_series_info (warm index)',
+        timeit(lambda: [dicom.parse_series_info(s) for s in series], len(files), repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark dicom header parsing on a synthetic corpus.')
+    parser.add_argument('--n-studies', type=int, default=1)
+    parser.add_argument('--n-series', type=int, default=4)
+    parser.add_argument('--n-volumes', type=int, default=250)
+    parser.add_argument('--n-slices', type=int, default=16)
+    parser.add_argument('--csa-size', type=int, default=30000, help='padding in each CSA header (bytes)')
+    parser.add_argument('--sq-items', type=int, default=0, help='number of items in a nested sequence')
+    parser.add_argument('--sq-depth', type=int, default=0, help='nesting depth of the sequence')
+    parser.add_argument('--gzip', action='store_true', help='write *.dcm.gz instead of *.IMA')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes for parsing')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--keep', default=None, help='generate (or reuse) the corpus in this folder instead of a temp folder')
+    args = parser.parse_args()
+    folder = args.keep if args.keep is not None else tempfile.mkdtemp(prefix='mripy_dicom_')
+    try:
+        if not path.exists(folder) or len(os.listdir(folder)) == 0:
+            start = default_timer()
+            files = make_dicom_corpus(folder, n_studies=args.n_studies, n_series=args.n_series, n_volumes=args.n_volumes,
+                n_slices=args.n_slices, compress=args.gzip, csa_size=args.csa_size, sq_items=args.sq_items, sq_depth=args.sq_depth)
+            print('>> {0} files generated in {1:.1f} s ({2})'.format(len(files), default_timer()-start, folder))
+        run_benchmarks(folder, n_jobs=args.jobs, repeat=args.repeat)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(folder)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Cold start time of importing mripy modules, as measured by `python -X importtime`
+in a fresh interpreter for each module.
+
+Usage:
+    cd mripy/tests; python benchmark_import.py mripy.io mripy.afni --top 5
+    python benchmark_import.py --max-ms 500 # Exit with 1 if any module is slower
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+import sys, subprocess, argparse
+from os import path
+
+
+MODULES = ['mripy', 'mripy.afni', 'mripy.dicom', 'mripy.utils', 'mripy.math', 'mripy.io',
+    'mripy.timecourse', 'mripy.encoding', 'mripy.decoding', 'mripy.vis', 'mripy.preprocess']
+# Imported only on first use (e.g., Savable, plotting or CV), thus should never show up at import time
+HEAVY_MODULES = ['matplotlib', 'pylab', 'seaborn', 'sklearn', 'pandas', 'tables', 'deepdish']
+
+
+def importtime(module):
+    '''
+    Returns
+    -------
+    total : float
+        Cumulative import time of `module` in ms.
+    imported : dict
+        {name: (self_ms, cumulative_ms)} for every module imported along the way.
+    '''
+    root = path.dirname(path.dirname(path.dirname(path.realpath(__file__))))
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root, check=True)
+    entries = []
+    for line in res.stderr.decode('utf-8').splitlines():
+        if line.startswith('import time:') and not line.endswith('| imported package'):
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            entries.append((name.strip(), len(name) - len(name.lstrip()), int(self_us)/1000, int(cumulative_us)/1000))
+    # Entries are listed children first, so the subtree of `module` directly precedes it (excluding interpreter startup)
+    k = [name for name, depth, self_ms, cumulative_ms in entries].index(module)
+    imported = {}
+    for name, depth, self_ms, cumulative_ms in reversed(entries[:k]):
+        if depth <= entries[k][1]:
+            break
+        imported[name] = (self_ms, cumulative_ms)
+    return entries[k][3], imported
+
+
+def heavy_imports(imported):
+    return sorted(name for name in imported if name.split('.')[0] in HEAVY_MODULES and '.' not in name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cold start time of importing mripy modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=0, help='also show the N slowest imports (cumulative) of each module')
+    parser.add_argument('--max-ms', type=float, default=None, help='exit with 1 if any module takes longer than this')
+    args = parser.parse_args()
+    too_slow = []
+    for module in args.modules:
+        total, imported = min((importtime(module) for k in range(args.repeat)), key=lambda x: x[0])
+        heavy = heavy_imports(imported)
+        print('{0:<24s}{1:>10.1f} ms{2}'.format(module, total, '  (heavy: {0})'.format(', '.join(heavy)) if heavy else ''))
+        for name, (self_ms, cumulative_ms) in sorted(imported.items(), key=lambda x: -x[1][1])[:args.top]:
+            print('    {0:<36s}{1:>10.1f} ms'.format(name, cumulative_ms))
+        if args.max_ms is not None and total > args.max_ms:
+            too_slow.append(module)
+    if too_slow:
+        print('** ERROR: Import takes longer than {0:g} ms: {1}'.format(args.max_ms, ', '.join(too_slow)))
+        sys.exit(1)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Generate synthetic Siemens-like dicom files (Explicit VR Little Endian) for
+testing and benchmarking `mripy.dicom`, without any real (and private) data.
+
+The files contain the fields parsed by `mripy.dicom.tag_parsers` (including
+CSA2 with a MrPhoenixProtocol), optional nested sequences of undefined length,
+and a Siemens mosaic as pixel data.
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, gzip, struct
+from os import path
+from datetime import datetime, timedelta
+import numpy as np
+
+
+ASCCONV = '''### ASCCONV BEGIN object=MrProtDataImpl@MrProtocolData version=41340006 converter=%MEASCONST%/ConverterList/Prot_Converter.txt ###
+ulVersion                                = 0x14b44b6
+tSequenceFileName                        = ""%SiemensSeq%\\ep2d_bold""
+lTotalScanTimeSec                        = {total_scan_time}
+sTXSPEC.asNucleusInfo[0].tNucleus        = ""1H""
+sTXSPEC.asNucleusInfo[0].flReferenceAmplitude = {reference_amplitude}
+sKSpace.ucPhasePartialFourier            = {phase_partial_fourier}
+sKSpace.ucSlicePartialFourier            = 0x10
+sPat.lAccelFactPE                        = 2
+sPat.lRefLinesPE                         = 24
+sPat.ucPATMode                           = 0x2
+sPat.ucRefScanMode                       = 0x4
+### ASCCONV END ###'''
+
+
+def _element(group, element, VR, value):
+    VR = VR.encode('ascii')
+    if isinstance(value, str):
+        value = value.encode('ascii')
+        if len(value) % 2:
+            value += b'\x00' if VR in [b'UI', b'OB'] else b' '
+    if len(value) % 2:
+        value += b'\x00'
+    if VR in [b'OB', b'OW', b'OF', b'SQ', b'UT', b'UN']:
+        return struct.pack('<HH2s2xI', group, element, VR, len(value)) + value
+    else:
+        return struct.pack('<HH2sH', group, element, VR, len(value)) + value
+
+
+def _sequence(group, element, n_items, depth):
+    '''An SQ with undefined length, whose items (also with undefined length) may nest further SQs.'''
+    items = b''
+    for k in range(n_items):
+        payload = _element(0x0008, 0x1150, 'UI', '1.2.840.10008.5.1.4.1.1.4') \
+            + _element(0x0008, 0x1155, 'UI', '1.3.12.2.1107.5.2.{0}.{1}'.format(depth, k))
+        if depth > 1:
+            payload += _sequence(0x0008, 0x1140, n_items, depth-1)
+        items += struct.pack('<HHI', 0xFFFE, 0xE000, 0xFFFFFFFF) + payload + struct.pack('<HHI', 0xFFFE, 0xE00D, 0)
+    return struct.pack('<HH2s2xI', group, element, b'SQ', 0xFFFFFFFF) + items + struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+
+
+def _CSA2(tags):
+    '''
+    Siemens CSA2 ("SV10") layout: a 16-byte preamble, followed by n_tags tags, each
+    with a fixed-size description and n_items length-prefixed (4-byte aligned) items.
+    '''
+    blob = b'SV10' + b'\x04\x03\x02\x01' + struct.pack('<2I', len(tags), 77)
+    for name, VR, values in tags:
+        blob += struct.pack('<64si4s3i', name.encode('ascii'), 1, VR.encode('ascii'), 0, len(values), 77)
+        for value in values:
+            value = value.encode('latin-1') if isinstance(value, str) else value
+            blob += struct.pack('<4i', len(value), len(value), 77, len(value))
+            blob += value + b'\x00' * (-len(value) % 4)
+    return blob
+
+
+def make_mosaic(slices):
+    '''Tile (n_slices, rows, columns) slices into a Siemens mosaic, row by row.'''
+    n_slices, rows, columns = slices.shape
+    n_tiles = int(np.ceil(np.sqrt(n_slices)))
+    tiles = np.zeros((n_tiles**2, rows, columns), dtype=slices.dtype)
+    tiles[:n_slices] = slices
+    return tiles.reshape(n_tiles, n_tiles, rows, columns).swapaxes(1, 2).reshape(n_tiles*rows, n_tiles*columns)
+
+
+def make_dicom(series=1, instance=1, acquisition=1, study=1, n_slices=16,
+    start=None, TR=2.0, csa_size=0, sq_items=0, sq_depth=0, matrix=(64,64), pixel_data=True,
+    position=(-64, -64, 0), pixels=None, slice_normal=None, slice_times=None):
+    '''
+    Return the bytes of a synthetic Siemens-like dicom file.
+
+    Parameters
+    ----------
+    n_slices : int
+        NumberOfImagesInMosaic, with MosaicRefAcqTimes in ascending order (unless `slice_times`).
+    csa_size : int
+        Extra bytes of padding in the CSA headers (real ones are tens of KB).
+    sq_items, sq_depth : int
+        Number of items in (and nesting depth of) a sequence of undefined length.
+    matrix : tuple
+        Rows and Columns of the (mosaic) image.
+    pixels : 2D array
+        Pixel data (uint16) of shape `matrix`, default is zeros.
+    slice_normal : tuple
+        SliceNormalVector (LPS) in the CSA Image Header, e.g., (0,0,-1) for descending slices.
+        Default is to omit it.
+    slice_times : array
+        MosaicRefAcqTimes (ms), e.g., repeated times for multiband.
+    '''
+    if slice_times is None:
+        slice_times = np.arange(n_slices) * TR*1000/n_slices
+    if start is None:
+        start = datetime(2020, 1, 1, 9, 0, 0)
+    t = start + timedelta(seconds=TR*(acquisition-1))
+    meta = _element(0x0002, 0x0010, 'UI', '1.2.840.10008.1.2.1') + _element(0x0002, 0x0013, 'SH', 'SYNTHETIC_MRIPY')
+    b = b'\x00'*128 + b'DICM' + _element(0x0002, 0x0000, 'UL', struct.pack('<I', len(meta))) + meta
+    b += _element(0x0008, 0x0022, 'DA', t.strftime('%Y%m%d'))
+    b += _element(0x0008, 0x0032, 'TM', t.strftime('%H%M%S.%f'))
+    b += _element(0x0008, 0x103E, 'LO', 'ep2d_bold_{0:02d}'.format(series))
+    if sq_items > 0:
+        b += _sequence(0x0008, 0x1140, sq_items, max(sq_depth, 1))
+    b += _element(0x0010, 0x0010, 'PN', 'SYNTHETIC^SUBJECT')
+    b += _element(0x0010, 0x0040, 'CS', 'O')
+    b += _element(0x0018, 0x0020, 'CS', 'EP')
+    b += _element(0x0018, 0x0021, 'CS', 'SK')
+    b += _element(0x0018, 0x0023, 'CS', '2D')
+    b += _element(0x0018, 0x0024, 'SH', '*epfid2d1_64')
+    b += _element(0x0018, 0x0050, 'DS', '2')
+    b += _element(0x0018, 0x0080, 'DS', '{0:g}'.format(TR*1000))
+    b += _element(0x0018, 0x0081, 'DS', '30')
+    b += _element(0x0018, 0x0084, 'DS', '297.2')
+    b += _element(0x0018, 0x0087, 'DS', '7')
+    b += _element(0x0018, 0x0095, 'DS', '1500')
+    b += _element(0x0018, 0x1030, 'LO', 'ep2d_bold')
+    b += _element(0x0018, 0x1310, 'US', struct.pack('<4H', 0, matrix[0], matrix[1], 0))
+    b += _element(0x0018, 0x1314, 'DS', '70')
+    b += _element(0x0019, 0x0010, 'LO', 'SIEMENS MR HEADER')
+    b += _element(0x0019, 0x100A, 'US', struct.pack('<H', n_slices))
+    b += _element(0x0019, 0x1029, 'FD', np.asarray(slice_times).astype('<f8').tobytes())
+    b += _element(0x0020, 0x0010, 'SH', str(study))
+    b += _element(0x0020, 0x0011, 'IS', str(series))
+    b += _element(0x0020, 0x0012, 'IS', str(acquisition))
+    b += _element(0x0020, 0x0013, 'IS', str(instance))
+    b += _element(0x0020, 0x0032, 'DS', '\\'.join('{0:g}'.format(x) for x in position))
+    b += _element(0x0020, 0x0037, 'DS', '1\\0\\0\\0\\1\\0')
+    b += _element(0x0020, 0x4000, 'LT', 'Unaliased MB3/PE2 SENSE1')
+    b += _element(0x0028, 0x0010, 'US', struct.pack('<H', matrix[0]))
+    b += _element(0x0028, 0x0011, 'US', struct.pack('<H', matrix[1]))
+    b += _element(0x0028, 0x0030, 'DS', '2\\2')
+    b += _element(0x0028, 0x0100, 'US', struct.pack('<H', 16))
+    b += _element(0x0029, 0x0010, 'LO', 'SIEMENS CSA HEADER')
+    CSA = [('ImaPATModeText', 'LO', ['p2'])]
+    if slice_normal is not None:
+        CSA.append(('SliceNormalVector', 'FD', ['{0:.8f}'.format(x) for x in slice_normal]))
+    b += _element(0x0029, 0x1010, 'OB', _CSA2(CSA + [('Padding', 'UN', ['\x00'*csa_size])]))
+    protocol = ASCCONV.format(total_scan_time=int(TR*100), reference_amplitude='245.7', phase_partial_fourier='0x8')
+    b += _element(0x0029, 0x1020, 'OB', _CSA2([('UsedPatientWeight', 'IS', ['70']),
+        ('MrPhoenixProtocol', 'UN', ['<XProtocol> padding ' + 'x'*csa_size + '\n' + protocol + '\n'])]))
+    b += _element(0x0051, 0x0010, 'LO', 'SIEMENS MR HEADER')
+    b += _element(0x0051, 0x100E, 'SH', 'Tra>Cor(-2.1)')
+    b += _element(0x0051, 0x1011, 'SH', 'p2')
+    b += _element(0x0051, 0x1016, 'SH', 'p2 M/DIS2D')
+    if pixel_data:
+        if pixels is None:
+            pixels = np.zeros(matrix, dtype='<u2')
+        b += _element(0x7FE0, 0x0010, 'OW', np.asarray(pixels, dtype='<u2').tobytes())
+    return b
+
+
+def make_dicom_corpus(folder, n_studies=1, n_series=4, n_volumes=10, n_slices=16,
+    compress=False, shuffle=False, **kwargs):
+    '''
+    Write a folder of synthetic mosaic EPI files, named like Siemens exports, e.g.,
+    "SYNTHETIC.MR.MRIPY.0002.0010.2020.01.01.09.00.00.000000.0.IMA".
+
+    Parameters
+    ----------
+    compress : bool
+        Write *.dcm.gz instead of *.IMA.
+    shuffle : bool
+        Name files in random order, so that they can only be sorted by their headers.
+    **kwargs :
+        Passed to `make_dicom`, e.g., csa_size, sq_items, sq_depth, matrix.
+
+    Returns
+    -------
+    files : list
+    '''
+    if not path.exists(folder):
+        os.makedirs(folder)
+    n_files = n_studies * n_series * n_volumes
+    order = np.random.RandomState(0).permutation(n_files) if shuffle else np.arange(n_files)
+    files = []
+    k = 0
+    for study in range(1, n_studies+1):
+        for series in range(1, n_series+1):
+            start = datetime(2020, 1, study, 9, 0, 0) + timedelta(minutes=10*series)
+            for volume in range(1, n_volumes+1):
+                b = make_dicom(series=series, instance=volume, acquisition=volume, study=study,
+                    n_slices=n_slices, start=start, **kwargs)
+                name = 'SYNTHETIC.MR.MRIPY.{0:04d}.{1:04d}.{2}.{3}'.format(series, volume,
+                    start.strftime('%Y.%m.%d.%H.%M.%S.%f'), order[k]) if not shuffle else 'IM{0:06d}'.format(order[k])
+                fname = path.join(folder, name + ('.dcm.gz' if compress else '.IMA'))
+                if compress:
+                    with gzip.open(fname, 'wb') as fo:
+                        fo.write(b)
+                else:
+                    with open(fname, 'wb') as fo:
+                        fo.write(b)
+                files.append(fname)
+                k += 1
+    return files
+
+
+if __name__ == '__main__':
+    pass
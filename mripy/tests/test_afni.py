@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import unittest
+import unittest, tempfile
+from os import path
 import numpy as np
 from mripy import afni, math
 
@@ -45,6 +46,82 @@ class test_afni(unittest.TestCase):
         mat = afni.get_affine(f"{res_dir}/ASL.nii.gz")
         assert(np.allclose(math.apply_affine(mat, np.reshape([0,0,0], [-1,1])), np.reshape([46,0,23], [-1,1]), atol=1))
         assert(np.allclose(math.apply_affine(mat, np.reshape([319,319,0], [-1,1])), np.reshape([46,94,-72], [-1,1]), atol=1))
+    def test_read_header(self):
+        head = '''
+type = string-attribute
+name = BRICK_LABS
+count = 10
+'a~b#0~c d~
+
+type = integer-attribute
+name = ORIENT_SPECIFIC
+count = 3
+ 1 2 4
+
+type = float-attribute
+name = ORIGIN
+count = 3
+ 90 126 -72
+
+type = float-attribute
+name = DELTA
+count = 3
+ -2 -2 2
+
+type = integer-attribute
+name = DATASET_DIMENSIONS
+count = 5
+ 91 109 91 0 0
+
+type = integer-attribute
+name = DATASET_RANK
+count = 8
+ 3 2 0 0 0 0 0 0
+
+type = integer-attribute
+name = TAXIS_NUMS
+count = 8
+ 2 0 77001 -999 -999 -999 -999 -999
+
+type = float-attribute
+name = TAXIS_FLOATS
+count = 8
+ 0 1500 0 0 0 -999999 -999999 -999999
+'''
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(path.join(temp_dir, 'dset+tlrc.HEAD'), 'w') as fo:
+                fo.write(head)
+            for fname in ['dset+tlrc', 'dset+tlrc.HEAD', 'dset+tlrc.BRIK.gz']:
+                fname = path.join(temp_dir, fname)
+                self.assertEqual(afni.get_ORIENT(fname), 'LPI')
+                np.testing.assert_array_equal(afni.get_dims(fname), [91, 109, 91, 2])
+                np.testing.assert_allclose(afni.get_affine_nifti(fname), [[2,0,0,-90], [0,2,0,-126], [0,0,2,-72]])
+                self.assertEqual(afni.get_TR(fname), 1.5)
+                self.assertEqual(list(afni.get_brick_labels(fname)), ['a', 'b#0', 'c d'])
+            np.testing.assert_allclose(afni.get_head_extents(fname), [-90, 90, -90, 126, -72, 108])
+            # The cached header is re-read after the dataset is modified
+            self.assertIs(afni.read_header(fname), afni.read_header(fname))
+            with open(path.join(temp_dir, 'dset+tlrc.HEAD'), 'w') as fo:
+                fo.write(head.replace(' 1 2 4', ' 0  3  4')) # Also changes the size
+            self.assertEqual(afni.get_ORIENT(fname), 'RAI')
+        # NIFTI headers are read via nibabel (for non-oblique datasets)
+        attributes = afni.read_header(path.join(path.dirname(__file__), 'testdata/ASR.nii.gz'))
+        self.assertEqual(list(attributes['ORIENT_SPECIFIC']), [3, 5, 0])
+        np.testing.assert_array_equal(attributes['DATASET_DIMENSIONS'], [320, 320, 256, 0, 0])
+
+    def test_nifti_field(self):
+        import nibabel
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fname = path.join(temp_dir, 'dset.nii')
+            nibabel.Nifti1Image(np.zeros((4,5,6,7), dtype=np.float32), np.diag([2,3,4,1])).to_filename(fname)
+            np.testing.assert_array_equal(afni.get_nifti_field(fname, 'dim', 'int'), [4, 4, 5, 6, 7, 1, 1, 1])
+            afni.set_nifti_field(fname, 'dim', [3, 4, 5, 42])
+            afni.set_nifti_field(fname, 'descrip', 'edited')
+            afni.set_nifti_field(fname, 'pixdim', [1, 2.5], out_file=path.join(temp_dir, 'copy.nii'))
+            self.assertEqual(nibabel.load(fname).shape, (4, 5, 42))
+            self.assertEqual(afni.get_nifti_field(fname, 'descrip'), 'edited')
+            np.testing.assert_allclose(nibabel.load(path.join(temp_dir, 'copy.nii')).header.get_zooms(), [2.5, 3, 4])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest
+from unittest import mock
+try:
+    from .synthetic_dicom import make_dicom, make_dicom_corpus, make_mosaic # If mripy is importable: python -m mripy.tests.test_dicom
+except (ValueError, ImportError): # If not importable: cd mripy/tests; python -m test_dicom
+    from synthetic_dicom import make_dicom, make_dicom_corpus, make_mosaic
+from mripy import dicom
+
+from os import path
+import gzip, tempfile, pickle
+from collections import OrderedDict
+import numpy as np
+
+
+class test_dicom(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, b):
+        fname = path.join(self.folder, name)
+        with (gzip.open if name.endswith('.gz') else open)(fname, 'wb') as fo:
+            fo.write(b)
+        return fname
+
+    def test_parse_dicom_header(self):
+        b = make_dicom(series=3, instance=5, csa_size=100000, sq_items=3, sq_depth=2)
+        header = dicom.parse_dicom_header(self.write('a.IMA', b))
+        self.assertEqual((header['StudyID'], header['SeriesNumber'], header['InstanceNumber']), (1, 3, 5))
+        self.assertEqual(header['RepetitionTime'], 2000)
+        self.assertEqual(header['CSA2']['ReferenceAmplitude'], 245.7)
+        self.assertEqual(header['PhasePartialFourier'], '7/8')
+        self.assertEqual(header['RefLinesPE'], 24)
+        np.testing.assert_allclose(header['MosaicRefAcqTimes'], np.arange(16)*125)
+        # Gzipped files give the same header
+        header2 = dicom.parse_dicom_header(self.write('a.dcm.gz', b))
+        self.assertEqual(list(header2), list(header))
+        self.assertEqual(header2['CSA2'], header['CSA2'])
+        # Search only
+        header3 = dicom.parse_dicom_header(path.join(self.folder, 'a.IMA'), search_for_tags=dicom.SORT_TAGS, search_only=True)
+        self.assertEqual([header3[k] for k in ['StudyID', 'SeriesNumber', 'InstanceNumber']], [1, 3, 5])
+        self.assertNotIn('CSA2', header3)
+        # Runtime changes to tag_parsers are followed
+        with mock.patch.dict(dicom.tag_parsers, {'0018,0080': ('TR', lambda x: float(x)/1000)}):
+            self.assertEqual(dicom.parse_dicom_header(path.join(self.folder, 'a.IMA'))['TR'], 2)
+        self.assertNotIn('TR', dicom.parse_dicom_header(path.join(self.folder, 'a.IMA')))
+
+    def test_sort_dicom_series(self):
+        make_dicom_corpus(self.folder, n_studies=2, n_series=3, n_volumes=5, shuffle=True)
+        studies = dicom.sort_dicom_series(self.folder)
+        self.assertEqual(len(studies), 2)
+        self.assertEqual(list(studies[0]), ['0001', '0002', '0003'])
+        headers = dicom.parse_dicom_headers([path.join(self.folder, f) for f in studies[1]['0002']], use_index=False)
+        self.assertEqual([h['InstanceNumber'] for h in headers], [1, 2, 3, 4, 5])
+        self.assertTrue(all(h['StudyID'] == 2 and h['SeriesNumber'] == 2 for h in headers))
+        # The index gives the same result
+        self.assertTrue(path.exists(path.join(self.folder, dicom.INDEX_FILE)))
+        self.assertEqual(dicom.sort_dicom_series(self.folder), studies)
+        self.assertEqual(dicom.sort_dicom_series(self.folder, use_index=False), studies)
+
+    def test_HeaderIndex(self):
+        files = [self.write('{0}.IMA'.format(k), make_dicom(instance=k, slice_normal=(0,0,-1), sq_items=2)) for k in [1, 2]]
+        cold = dicom.parse_dicom_headers(files)
+        warm = dicom.parse_dicom_headers(files)
+        for h1, h2 in zip(cold, warm):
+            self.assertEqual(list(h2), list(h1))
+            for k in h1: # Same values of the same types (e.g., np.uint16, date, nested CSA)
+                self.assertIs(type(h2[k]), type(h1[k]))
+                np.testing.assert_equal(h2[k], h1[k])
+        # Headers are not pickled, so a tampered index cannot run code (only gives a cache miss)
+        with dicom.HeaderIndex(self.folder) as index:
+            index.db.execute('UPDATE headers SET header = ?', (pickle.dumps(OrderedDict(evil=True)),))
+            index.db.commit()
+        self.assertEqual(dicom.parse_dicom_headers(files)[0]['InstanceNumber'], 1)
+
+    def test_DicomFolderCursor(self):
+        cursor = dicom.DicomFolderCursor(self.folder)
+        self.assertEqual(len(cursor.update()), 0)
+        self.write('1.IMA', make_dicom(series=2, instance=2))
+        self.write('2.IMA', make_dicom(series=2, instance=1))
+        self.write('3.IMA', b'\x00'*50) # Incomplete
+        new_files = cursor.update(settle=0)
+        self.assertEqual(list(new_files.items()), [((1, '0002'), [path.join(self.folder, '2.IMA'), path.join(self.folder, '1.IMA')])])
+        self.assertEqual(len(cursor.update(settle=0)), 0)
+        self.write('3.IMA', make_dicom(series=4, instance=1))
+        self.assertEqual(list(cursor.update(settle=0)), [(1, '0004')])
+        self.assertEqual(cursor.studies(), dicom.sort_dicom_series(self.folder))
+
+    def test_read_dicom_volume(self):
+        n_slices, n_volumes = 10, 3
+        for t in range(n_volumes):
+            slices = np.arange(n_slices)[:,np.newaxis,np.newaxis]*100 + t + np.zeros((1,16,16), dtype=int)
+            slices[:,0,1] = 7 # Mark the first row
+            self.write('{0}.IMA'.format(t), make_dicom(instance=n_volumes-t, acquisition=n_volumes-t,
+                n_slices=n_slices, pixels=make_mosaic(slices), position=(-32,-32,0)))
+        vol, affine, info = dicom.read_dicom_volume(self.folder)
+        self.assertEqual(vol.shape, (16, 16, n_slices, n_volumes))
+        np.testing.assert_array_equal(vol[2,2], np.arange(n_slices)[:,np.newaxis]*100 + np.arange(n_volumes)[::-1])
+        self.assertEqual(vol[1,0,0,0], 7) # The first axis runs along the row
+        # Mosaic origin is shifted to the center of the first voxel of the first slice: -32+(64-16)/2*2=16 (RAS)
+        np.testing.assert_allclose(affine, [[-2,0,0,-16], [0,-2,0,-16], [0,0,2,0], [0,0,0,1]])
+        self.assertEqual(info['TR'], 2)
+        np.testing.assert_allclose(info['slice_timing'], np.arange(n_slices)*0.2)
+
+    def test_read_dicom_volume_descending(self):
+        # Slices stored in descending order are only told apart by the CSA SliceNormalVector
+        b = make_dicom(n_slices=4, matrix=(32,32), position=(-32,-32,0), slice_normal=(0,0,-1))
+        self.assertEqual(dicom.parse_dicom_header(self.write('0.IMA', b))['CSA']['SliceNormalVector'].tolist(), [0, 0, -1])
+        vol, affine, info = dicom.read_dicom_volume(self.folder)
+        np.testing.assert_allclose(affine, [[-2,0,0,16], [0,-2,0,16], [0,0,-2,0], [0,0,0,1]]) # -32+(32-16)/2*2=-16 (LPS)
+
+
+if __name__ == '__main__':
+    unittest.main()
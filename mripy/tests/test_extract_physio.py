@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest, sys
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'scripts')) # Scripts are run standalone
+import extract_physio
+
+import tempfile
+import numpy as np
+
+
+class test_extract_physio(unittest.TestCase):
+    def test_write_1D(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rng = np.random.RandomState(0)
+            for x in [rng.randint(0, 4096, size=100), rng.randint(0, 4096, size=(100,2))]: # resp/puls, ecg
+                fname = path.join(temp_dir, 'x.1D')
+                extract_physio.write_1D(fname, x)
+                np.testing.assert_array_equal(np.loadtxt(fname, dtype=int), x)
+                np.savetxt(path.join(temp_dir, 'y.1D'), x, fmt=str('%d'))
+                with open(fname) as f1, open(path.join(temp_dir, 'y.1D')) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
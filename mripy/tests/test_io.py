@@ -2,16 +2,64 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
 import unittest
+from unittest import mock
 from numpy.testing import assert_allclose
 try:
     from .context import data_dir # If mripy is importable: python -m mripy.tests.test_io
+    from .synthetic_dicom import make_dicom
 except ValueError: # Attempted relative import in non-package
     from context import data_dir # If not importable: cd mripy/tests; python -m test_io
-from mripy import io
+    from synthetic_dicom import make_dicom
+from mripy import io, afni
 
 from os import path
-import os, glob, subprocess
+import os, re, glob, subprocess, tempfile
 import numpy as np
+import nibabel
+
+
+def write_physio(fname, n_samples, rng, start=36000000):
+    '''A synthetic Siemens PMU log (*.ecg, *.puls, *.resp), with triggers and a message within multiple data lines.'''
+    ch = path.splitext(fname)[1][1:]
+    fs = {'ecg': 398.4, 'puls': 49.80, 'resp': 49.80}[ch]
+    if ch == 'ecg':
+        tokens = [1, 2, 40, 280, 1] + list(rng.randint(0, 4096, size=n_samples*2))
+    else:
+        tokens = [1, 2, 40, 280] + list(rng.randint(0, 4096, size=n_samples))
+        for k in sorted(rng.choice(np.arange(10, len(tokens)), 5, replace=False))[::-1]:
+            tokens.insert(k, 5000) # Trigger
+    tokens.insert(len(tokens)//2, '5002 LOGVERSION 102 6002')
+    tokens.append(5003)
+    lines = [' '.join(map(str, tokens[k:k+100])) + ' ' for k in range(0, len(tokens), 100)] # Lines are joined without separator
+    stop = start + int(round(n_samples/fs*1000))
+    footer = ['ECG  Freq Per: 0 0', 'LogStartMDHTime:  {0}'.format(start), 'LogStopMDHTime:   {0}'.format(stop),
+        'LogStartMPCUTime: {0}'.format(start-30), 'LogStopMPCUTime:  {0}'.format(stop+40), '6003']
+    with open(fname, 'w') as fo:
+        fo.write('\n'.join(lines)[:-1] + '\n' + '\n'.join(footer) + '\n')
+
+
+def parse_physio_reference(fname, date):
+    '''The original line and regex based parser (before vectorization), as a reference.'''
+    ch = path.splitext(fname)[1][1:]
+    fs = {'ecg': 398.4, 'puls': 49.80, 'resp': 49.80}[ch]
+    with open(fname) as fi:
+        lines = fi.read().splitlines()
+    k = [line[-4:] for line in lines].index('5003') + 1
+    data_line = ''.join(lines[:k])
+    x = np.int_(re.sub(r'\s5002\s(.+?)\s6002', '', data_line).split()[{'ecg': 5}.get(ch, 4):-1])
+    info = {k: int(v) for k, v in re.findall(r'(Log\w+Time):\s+(\d+)', '\n'.join(lines[k:]))}
+    info.update(messages=re.findall(r'\s5002\s(.+?)\s6002', data_line), rawdata=x, fs=fs,
+        start=io.mmn2dt(info['LogStartMDHTime'], date, timestamp=True), stop=io.mmn2dt(info['LogStopMDHTime'], date, timestamp=True))
+    if ch != 'ecg':
+        info['data'] = x[~np.in1d(x, [5000, 6000])]
+        trig = np.zeros_like(x)
+        trig[np.nonzero(x==5000)[0]-1] = 1
+        info['trig'] = trig[x!=5000]
+    else:
+        info['data'] = x[:len(x)//2*2].reshape(-1,2)
+        info['trig'] = np.zeros_like(info['data'])
+    info['t'] = info['start'] + np.arange(len(info['data'])) / fs
+    return info
 
 
 class test_io(unittest.TestCase):
@@ -40,6 +88,262 @@ class test_io(unittest.TestCase):
         for f in glob.glob('test_constrain+orig.*'):
             os.remove(f)
 
+    def test_Mask_dump(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            def save(fname, vol, slope=None):
+                img = nibabel.Nifti1Image(vol, np.diag([-2, -2, 2, 1]))
+                if slope is not None:
+                    img.header.set_slope_inter(*slope)
+                nibabel.save(img, path.join(temp_dir, fname))
+                return path.join(temp_dir, fname)
+            rng = np.random.RandomState(0)
+            mask = io.Mask(save('mask.nii', (rng.rand(10,11,12) > 0.7).astype(np.int16)))
+            vols = [rng.randint(0, 1000, size=(10,11,12,n)).astype(np.int16) for n in [9, 5, 1]]
+            files = [save('a.nii', vols[0]), save('b.nii.gz', vols[1]), save('c.nii', vols[2], slope=(0.5, 3))]
+            vols[2] = vols[2] * 0.5 + 3
+            expected = np.hstack([vol.reshape(-1, vol.shape[-1], order='F')[mask.index] for vol in vols])
+            # Memory-mapped (a.nii), compressed (b.nii.gz) and scaled (c.nii) inputs, read in chunks of 2 volumes
+            x = mask.dump(files, chunk_size=10*11*12*8*2)
+            self.assertEqual(x.shape, (len(mask.index), 15))
+            assert_allclose(x, expected)
+            self.assertEqual(mask.dump(files[:2]).dtype, np.int16)
+            assert_allclose(mask.dump(files[0], dtype=float), expected[:,:9])
+    def test_write_afni(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            prefix = path.join(temp_dir, 'dset')
+            affine = np.array([[-2, 0, 0, 10], [0, 0, 3, -20], [0, 2.5, 0, 5], [0, 0, 0, 1]])
+            base_img = nibabel.Nifti1Image(np.zeros((4,5,6)), affine)
+            vol = np.random.RandomState(0).rand(4,5,6,3).astype(np.float32) * 100
+            io.write_afni(prefix, vol, base_img=base_img, labels=['a', 'b', 'c'], TR=2)
+            x, img = io.read_afni(prefix+'+orig', return_img=True)
+            self.assertIsInstance(x, np.memmap) # Unscaled BRIK is memory-mapped
+            assert_allclose(x, vol)
+            assert_allclose(img.affine, affine)
+            self.assertEqual(list(img.header.get_volume_labels()), ['a', 'b', 'c'])
+            self.assertEqual(afni.get_TR(prefix+'+orig.HEAD'), 2)
+            # Scaled short
+            io.write_afni(prefix+'+tlrc', vol, base_img=base_img, datum='short')
+            assert_allclose(io.read_afni(prefix+'+tlrc'), vol, atol=0.01)
+            # Mask.undump writes AFNI without 3dcopy
+            io.write_nii(path.join(temp_dir, 'mask.nii'), (vol[...,0] > 50).astype(np.int16), base_img)
+            mask = io.Mask(path.join(temp_dir, 'mask.nii'))
+            mask.undump(path.join(temp_dir, 'undump'), vol[...,0].T.flat[mask.index])
+            assert_allclose(io.read_afni(path.join(temp_dir, 'undump+orig'))[...,0], vol[...,0] * (vol[...,0] > 50), rtol=1e-6)
+    def test_Mask_set_operations(self):
+        rng = np.random.RandomState(0)
+        def make_mask(n):
+            mask = io.Mask(None)
+            mask.IJK, mask.MAT = np.r_[20,30,40], np.eye(3,4)
+            mask.index = np.sort(rng.choice(20*30*40, n, replace=False))
+            mask.value = rng.randint(1, 10, n)
+            return mask
+        for n1, n2 in [(1000, 1200), (5000, 50), (50, 5000), (0, 10)]:
+            a, b = make_mask(n1), make_mask(n2)
+            c = a + b
+            np.testing.assert_array_equal(c.index, np.union1d(a.index, b.index))
+            expected = np.zeros(20*30*40, dtype=int)
+            expected[a.index] += a.value
+            expected[b.index] += b.value
+            np.testing.assert_array_equal(c.value, expected[c.index])
+            np.testing.assert_array_equal((a*b).index, np.intersect1d(a.index, b.index))
+            np.testing.assert_array_equal((a-b).index, np.setdiff1d(a.index, b.index))
+            self.assertTrue((a*b) in a and (a*b) in b and (a-b) in a and a in c)
+            self.assertEqual(b in a, len(np.setdiff1d(b.index, a.index)) == 0)
+            np.testing.assert_array_equal(a.infer_selector(a*b), np.in1d(a.index, b.index))
+        # Unsorted indices (e.g., after pick) give the same results
+        a, b = make_mask(1000), make_mask(1000)
+        order = rng.permutation(1000)
+        a2 = a.pick(order)
+        a2.value = a.value[order]
+        np.testing.assert_array_equal((a2+b).index, (a+b).index)
+        np.testing.assert_array_equal((a2+b).value, (a+b).value)
+        np.testing.assert_array_equal((a2*b).index, (a*b).index)
+        # Permuted pick of a large mask, minus (or containing) a small submask
+        a, order = make_mask(5000), rng.permutation(5000)
+        a2, small = a.pick(order), a.pick(np.arange(0, 5000, 100))
+        self.assertEqual(len((a2 - small).index), 4950)
+        np.testing.assert_array_equal((a2 - small).index, a2.index[~np.in1d(a2.index, small.index)])
+        self.assertTrue(small in a2)
+        np.testing.assert_array_equal(a2.infer_selector(small), np.in1d(a2.index, small.index))
+        self.assertEqual(a2.infer_selector(small).sum(), 50)
+    def test_Mask_without_subprocess(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            vol = np.zeros((10,11,12), dtype=np.int16)
+            vol[2:5,3:7,4:9] = 2
+            vol[6,7,8] = 3
+            base_img = nibabel.Nifti1Image(vol, np.diag([-2, -2, 2, 1]))
+            io.write_nii(path.join(temp_dir, 'mask.nii'), vol, base_img)
+            io.write_afni(path.join(temp_dir, 'mask'), vol, base_img)
+            with mock.patch('subprocess.Popen', side_effect=AssertionError('No subprocess should be spawned')):
+                masks = [io.Mask(path.join(temp_dir, 'mask.nii')), io.Mask(path.join(temp_dir, 'mask+orig.HEAD'))]
+                full = io.Mask(path.join(temp_dir, 'mask.nii'), kind='full')
+            for mask in masks:
+                np.testing.assert_array_equal(mask.index, np.flatnonzero(vol.ravel('F')))
+                np.testing.assert_array_equal(mask.value, vol.ravel('F')[mask.index])
+                np.testing.assert_array_equal(mask.IJK, [10, 11, 12])
+                assert_allclose(mask.MAT, [[2, 0, 0, 0], [0, 2, 0, 0], [0, 0, 2, 0]]) # RAI
+            self.assertEqual(len(full.index), 10*11*12)
+            # The values are copied, rather than following later changes of the master
+            self.assertNotIsInstance(full.value, np.memmap)
+            io.write_nii(path.join(temp_dir, 'mask.nii'), vol*2, base_img)
+            self.assertEqual(full.value.sum(), vol.sum())
+            # Selectors are rejected clearly, rather than with a confusing missing file
+            with self.assertRaises(ValueError):
+                masks[0].dump(path.join(temp_dir, 'mask+orig[0]'))
+            with self.assertRaises(FileNotFoundError):
+                masks[0].dump(path.join(temp_dir, 'missing+orig'))
+    def test_dump_masks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rng = np.random.RandomState(0)
+            affine = np.diag([-2, -2, 2, 1])
+            atlas = rng.randint(0, 4, size=(10,11,12)).astype(np.int16)
+            io.write_nii(path.join(temp_dir, 'atlas.nii'), atlas, nibabel.Nifti1Image(atlas, affine))
+            files = [path.join(temp_dir, f) for f in ['a.nii', 'b.nii.gz']]
+            for f in files:
+                io.write_nii(f, rng.rand(10,11,12,7).astype(np.float32), nibabel.Nifti1Image(atlas, affine))
+            full = io.Mask(path.join(temp_dir, 'atlas.nii'))
+            rois = {k: full.pick(full.value==k) for k in [1, 2, 3]}
+            rois['overlap'] = rois[1] + rois[2].ball([0, 0, 0], 6)
+            xs = io.dump_masks(rois, files, chunk_size=10*11*12*4*3)
+            self.assertEqual(list(xs), list(rois))
+            for name, roi in rois.items():
+                self.assertEqual(xs[name].shape, (len(roi.index), 14))
+                np.testing.assert_array_equal(xs[name], roi.dump(files))
+    def test_Mask_undump(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rng = np.random.RandomState(0)
+            affine = np.diag([-2, -2, 2, 1])
+            vol = (rng.rand(10,11,12) > 0.5).astype(np.int16)
+            io.write_nii(path.join(temp_dir, 'mask.nii'), vol, nibabel.Nifti1Image(vol, affine))
+            mask = io.Mask(path.join(temp_dir, 'mask.nii'))
+            x = rng.rand(len(mask.index), 5).astype(np.float32)
+            # Write 4D output volume by volume into a memmap, for both NIFTI and AFNI
+            for fname in ['out.nii', 'out+orig.HEAD']:
+                out = mask.memmap_vol(path.join(temp_dir, fname), n_t=5)
+                for k in range(5):
+                    mask.undump(None, x[:,k], out=out[...,k])
+                out.flush()
+                del out
+                img = nibabel.load(path.join(temp_dir, fname))
+                assert_allclose(img.affine, affine)
+                np.testing.assert_array_equal(mask.dump(path.join(temp_dir, fname)), x)
+            # Reuse a preallocated (C-order) volume, and undump 2D data
+            buffer = np.zeros((10,11,12))
+            self.assertIs(mask.undump(None, x[:,0], out=buffer), buffer)
+            np.testing.assert_array_equal(buffer.ravel('F')[mask.index], x[:,0])
+            mask.undump(path.join(temp_dir, 'out2.nii'), x)
+            np.testing.assert_array_equal(io.read_vol(path.join(temp_dir, 'out2.nii')), io.read_vol(path.join(temp_dir, 'out.nii')))
+    def test_MaskDumper(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rng = np.random.RandomState(0)
+            base_img = nibabel.Nifti1Image(np.zeros((10,11,12)), np.diag([-2, -2, 2, 1]))
+            vol = rng.randint(-1, 3, size=(10,11,12)).astype(np.int16)
+            x = rng.rand(10,11,12,3).astype(np.float32)
+            io.write_afni(path.join(temp_dir, 'mask+tlrc'), vol, base_img)
+            io.write_afni(path.join(temp_dir, 'x+tlrc'), x, base_img)
+            with mock.patch('subprocess.Popen', side_effect=AssertionError('No subprocess should be spawned')):
+                dumper = io.MaskDumper(path.join(temp_dir, 'mask+tlrc'))
+                y = dumper.dump(path.join(temp_dir, 'x+tlrc'))
+                dumper.undump(path.join(temp_dir, 'y'), y)
+            # Nonzero voxels, as in 3dmaskdump
+            np.testing.assert_array_equal(dumper.index, np.flatnonzero(vol.ravel('F')))
+            np.testing.assert_array_equal(dumper.ijk, np.c_[np.nonzero(vol.transpose(2,1,0))[::-1]])
+            assert_allclose(dumper.xyz, dumper.ijk * 2) # RAI
+            np.testing.assert_array_equal(dumper.mask, vol.ravel('F')[dumper.index])
+            self.assertEqual(y.dtype, float)
+            np.testing.assert_array_equal(y, x.reshape(-1, 3, order='F')[dumper.index])
+            np.testing.assert_array_equal(io.read_afni(path.join(temp_dir, 'y+tlrc')), x * (vol != 0)[...,np.newaxis])
+            # Oblique masters keep their affine (IJK_TO_DICOM_REAL), as with "3dUndump -master"
+            c, s = np.cos(np.deg2rad(10)), np.sin(np.deg2rad(10))
+            oblique = np.array([[-2*c, -2*s, 0, 10], [-2*s, 2*c, 0, -5], [0, 0, 2, 3], [0, 0, 0, 1]])
+            io.write_afni(path.join(temp_dir, 'oblique'), vol, oblique)
+            dumper = io.MaskDumper(path.join(temp_dir, 'oblique+orig'))
+            dumper.undump(path.join(temp_dir, 'z'), y)
+            dumper.undump(path.join(temp_dir, 'z.nii'), y)
+            for fname in ['z+orig.HEAD', 'z.nii']:
+                assert_allclose(nibabel.load(path.join(temp_dir, fname)).affine, oblique, atol=1e-6)
+    def test_write_dicom_nii(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            def write_series(name, **kwargs):
+                files = []
+                for t in range(3):
+                    files.append(path.join(temp_dir, '{0}{1}.IMA'.format(name, t)))
+                    with open(files[-1], 'wb') as fo:
+                        fo.write(make_dicom(instance=t+1, acquisition=t+1, n_slices=4, matrix=(32,32), **kwargs))
+                return files
+            io.write_dicom_nii(path.join(temp_dir, 'seq.nii'), write_series('seq'))
+            img = nibabel.load(path.join(temp_dir, 'seq.nii'))
+            self.assertEqual(img.get_data_dtype(), np.int16) # Rather than uint16
+            assert_allclose(img.header.get_slice_times(), np.arange(4)*0.5)
+            # Multiband slice timing cannot be stored as slice_code
+            files = write_series('mb', slice_times=[0, 1000, 0, 1000])
+            with self.assertRaises(ValueError):
+                io.write_dicom_nii(path.join(temp_dir, 'mb.nii'), files, require_slice_timing=True)
+            io.write_dicom_nii(path.join(temp_dir, 'mb.nii'), files)
+            self.assertEqual(nibabel.load(path.join(temp_dir, 'mb.nii')).header['slice_code'], 0)
+    def test_convert_dicom_fallback(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(path.join(path.dirname(nibabel.__file__), 'tests', 'data', '0.dcm'), 'rb') as fi:
+                implicit = fi.read()
+            # Series the native reader cannot handle: implicit VR (without InstanceNumber), no "DICM" preamble
+            for name, content, error in [('implicit', implicit, KeyError), ('no_preamble', b'\x00'*256, AssertionError)]:
+                dicom_dir = path.join(temp_dir, name)
+                os.makedirs(dicom_dir)
+                with open(path.join(dicom_dir, 'x.IMA'), 'wb') as fo:
+                    fo.write(content)
+                with mock.patch('subprocess.check_call') as check_call, mock.patch('mripy.utils.run') as run:
+                    io.convert_dicom(dicom_dir, path.join(temp_dir, name+'.nii'))
+                    self.assertEqual(check_call.call_args[0][0][0], 'uniq_images')
+                    self.assertIn('Dimon', run.call_args[0][0])
+                with self.assertRaises(error): # Unless native is explicitly asked for
+                    io.convert_dicom(dicom_dir, path.join(temp_dir, name+'.nii'), method='native')
+
+    def test_parse_physio_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rng = np.random.RandomState(0)
+            channels = ['ecg', 'puls', 'resp']
+            stems = [path.join(temp_dir, 'Physio_20200101_10000{0}'.format(k)) for k in range(2)]
+            for k, stem in enumerate(stems):
+                for ch, n in zip(channels, [4000, 500, 500]):
+                    write_physio('{0}.{1}'.format(stem, ch), n+k*10, rng, start=36000000+k*600000)
+            def check(infos):
+                self.assertEqual(len(infos), len(stems))
+                for stem, info in zip(stems, infos):
+                    self.assertEqual(list(info), channels)
+                    for ch in channels:
+                        expected = parse_physio_reference('{0}.{1}'.format(stem, ch), '20200101')
+                        for key, value in expected.items():
+                            np.testing.assert_array_equal(info[ch][key], value, err_msg='{0}[{1}]'.format(ch, key))
+                        self.assertEqual(info[ch]['n_samples'], len(expected['data']))
+                        self.assertEqual(info[ch]['file'], path.realpath('{0}.{1}'.format(stem, ch)))
+            # Cold (parsed in parallel, and indexed), same as the original parser
+            cold = io.parse_physio_files([stem+'.resp' for stem in stems], date='20200101', channels=channels, n_jobs=2)
+            self.assertTrue(path.exists(path.join(temp_dir, io.PHYSIO_INDEX_FILE)))
+            check(cold)
+            check(io.parse_physio_files([stem+'.resp' for stem in stems], date='20200101', channels=channels, use_index=False))
+            # Warm: timing from the index, samples only parsed when first accessed
+            warm = io.parse_physio_files([stem+'.resp' for stem in stems], date='20200101', channels=channels, n_jobs=1)
+            for info, info0 in zip(warm, cold):
+                for ch in channels:
+                    self.assertIsInstance(info[ch], io.PhysioInfo)
+                    self.assertNotIn('data', info[ch])
+                    for key in ['file', 'start', 'stop', 'fs', 'n_samples', 'LogStartMPCUTime']:
+                        self.assertEqual(info[ch][key], info0[ch][key])
+            # Matching only needs the timing, and extraction (incl. 2D ecg) loads the samples
+            sinfo = dict(start=cold[1]['resp']['start']+1, stop=cold[1]['resp']['stop']-1, date='20200101')
+            physio, series = io.match_physio_with_series(warm, [sinfo], channel='resp')
+            self.assertNotIn('data', physio[0]['ecg'])
+            res = io.extract_physio(physio[0], sinfo, TR=2, channels=channels, verbose=0)
+            self.assertEqual(res[0].ndim, 2)
+            for x, y in zip(res, io.extract_physio(cold[1], sinfo, TR=2, channels=channels, verbose=0)):
+                np.testing.assert_array_equal(x, y)
+            check(warm)
+            # Modified files are parsed again
+            write_physio(stems[0]+'.puls', 600, rng)
+            again = io.parse_physio_files(stems[0]+'.resp', date='20200101', channels=channels)
+            self.assertNotIsInstance(again['puls'], io.PhysioInfo)
+            self.assertIsInstance(again['resp'], io.PhysioInfo)
+            np.testing.assert_array_equal(again['puls']['data'], parse_physio_reference(stems[0]+'.puls', '20200101')['data'])
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, absolute_import, unicode_literals
-import unittest
+import unittest, sys, subprocess
+from os import path
 from mripy import utils
 
 
@@ -12,6 +13,13 @@ class test_utils(unittest.TestCase):
         self.assertEqual(utils.fname_with_ext('prefix+orig', '+orig.HEAD'), 'prefix+orig.HEAD')
         self.assertEqual(utils.fname_with_ext('prefix+orig.', '+orig.HEAD'), 'prefix+orig.HEAD')
         self.assertEqual(utils.fname_with_ext('prefix+orig.HEAD', '+orig.HEAD'), 'prefix+orig.HEAD')
+    def test_lazy_imports(self):
+        # Heavy optional dependencies are imported on first use only, keeping the cold start of CLI scripts small
+        res = subprocess.run([sys.executable, '-c', "import sys, mripy.io, mripy.preprocess, mripy.timecourse, mripy.decoding, mripy.encoding, mripy.vis; "
+            "print(' '.join(m for m in ['matplotlib', 'seaborn', 'sklearn', 'pandas', 'tables', 'deepdish'] if m in sys.modules))"],
+            stdout=subprocess.PIPE, cwd=path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), check=True)
+        self.assertEqual(res.stdout.decode('utf-8').strip(), '')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,10 +6,7 @@ from os import path
 from collections import OrderedDict
 import itertools
 import numpy as np
-from scipy import stats, signal, interpolate
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
+from scipy import signal, interpolate
 from . import six, afni, io, utils, dicom, math
 
 
@@ -206,6 +203,7 @@ class Raw(utils.Savable, object):
         return _copy(self)
 
     def plot(self, events=None, event_id=None, color=None, palette=None, figsize=None, event_kws=None, **kwargs):
+        import matplotlib.pyplot as plt
         # Plot mean time course
         data = np.mean(self.data, axis=0)
         if events is not None: # If going to plot events, plot data in black by default
@@ -373,6 +371,7 @@ def events_from_dataframe(df, run, time, conditions, duration=None, event_id=Non
 
 
 def events_to_dataframe(events_list, event_id, conditions):
+    import pandas as pd
     id2event = {eid: event.split('/') for event, eid in event_id.items()}
     trials = []
     for rid, events in enumerate(events_list):
@@ -618,6 +617,7 @@ class Epochs(utils.Savable, object):
         '''
         Summary data as a pandas DataFrame.
         '''
+        import pandas as pd
         assert(self.info['conditions'] is not None)
         dfs = []
         for ev in self.event_id:
@@ -639,6 +639,8 @@ class Epochs(utils.Savable, object):
 
     def plot(self, hue=None, style=None, row=None, col=None, hue_order=None, style_order=None, row_order=None, col_order=None,
         palette=None, dashes=None, figsize=None, bbox_to_anchor=None, subplots_kws=None, average_kws=None, **kwargs):
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         assert(self.info['conditions'] is not None)
         conditions = OrderedDict([(condition, np.unique(levels)) for condition, levels in zip(self.info['conditions'], np.array([ev.split('/') for ev in self.event_id]).T)])
         con_sel = [[hue, style, row, col].index(condition) for condition in conditions]
@@ -782,6 +784,7 @@ class Evoked(object):
     shape = property(lambda self: self.data.shape)
 
     def plot(self, color=None, error=True, info=True, error_kws=None, show_n='info', **kwargs):
+        import matplotlib.pyplot as plt
         n_str = rf"$n={self.info['nave']}$"
         label = kwargs.pop('label') if 'label' in kwargs else self.info['condition']
         if show_n == 'label':
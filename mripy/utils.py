@@ -4,14 +4,13 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 import sys, os, re, glob, shlex, string
 import subprocess, multiprocessing, ctypes, time, uuid
 import json
-import tables, warnings
+import warnings
 from datetime import datetime
 from itertools import chain
 from collections import OrderedDict
 from contextlib import contextmanager
 from os import path
 import numpy as np
-from deepdish import io as dio
 from . import six, afni
 
 
@@ -443,20 +442,26 @@ def parallel_3D(cmd, in_file, prefix, n_jobs=1, schema=None, fname_mapper=None,
 
 class Savable(object):
     def save(self, fname):
+        import tables
+        from deepdish import io as dio
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=tables.NaturalNameWarning)
             dio.save(fname, self.to_dict())
 
     @classmethod
     def load(cls, fname):
+        from deepdish import io as dio
         return cls.from_dict(dio.load(fname))
 
 
 class Savable2(object):
     def save(self, fname):
+        import tables
+        from deepdish import io as dio
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=tables.NaturalNameWarning)
             dio.save(fname, self.to_dict())
 
     def load(self, fname):
+        from deepdish import io as dio
         self.from_dict(dio.load(fname))
\ No newline at end of file
@@ -3,8 +3,6 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import glob
 import numpy as np
-from matplotlib import pyplot as plt, transforms
-# from matplotlib import transforms
 from . import six, io
 
 
@@ -22,6 +20,7 @@ def draw_color_circle(cmap, res=512):
     '''
     Draw circular colorbar (color index from 0 to 1) clockwise from 0 to 12 o'clock
     '''
+    from matplotlib import pyplot as plt
     X, Y = np.meshgrid(np.linspace(-1, 1, res), np.linspace(-1, 1, res))
     D = np.sqrt(X**2 + Y**2)
     A = np.rot90((-np.arctan2(-Y, X)+np.pi)/(2*np.pi), 3)
@@ -41,6 +40,7 @@ def plot_volreg(dfiles, convention=None):
     - For 3dAllineate shift_rotate: x-shift  y-shift  z-shift$ z-angle  x-angle$ y-angle$
         Note that the dollar signs in the end indicate parameters that are fixed.
     '''
+    from matplotlib import pyplot as plt, transforms
     files = glob.glob(dfiles) if isinstance(dfiles, six.string_types) else dfiles
     labels = [r'$\Delta$R-L(x) [mm]', r'$\Delta$A-P(y) [mm]', r'$\Delta$I-S(z) [mm]',
               r'Pitch(x) [$^\circ$]', r'Roll(y) [$^\circ$]', r'Yaw(z) [$^\circ$]']